@@ -57,6 +57,11 @@
 # The same policy is applied to the archive repo, if there is one.
 # repo_maxage = 0
 
+# Each run writes diffs from this many of the previous indexes to the new
+# one into repo/diff/, and lists them in entry.jar, so that clients can
+# download only what changed. Set it to 0 to only write the full index.
+# index_delta_count = 10
+
 repo_url = "https://MyFirstFDroidRepo.org/fdroid/repo"
 repo_name = "My First F-Droid Repo Demo"
 repo_icon = "fdroid-icon.png"
@@ -88,6 +93,25 @@ The repository of older versions of applications from the main demo repository.
 #
 # allow_disabled_algorithms = True
 
+# `fdroid update` caches the information it gathers from each APK and
+# other file in the repo in tmp/.  By default, this is an SQLite
+# database where only the entries that changed get written.  It can
+# also be a single JSON file, which is rewritten whenever anything
+# changes.  An existing tmp/apkcache.json is migrated automatically.
+#
+# apkcache_backend = 'json'
+
+# APK signatures are verified with apksigner from the Android SDK.  By
+# default, a single JVM running the same verification code is kept
+# running for the whole run, instead of starting apksigner for each
+# APK.  This requires javac.  Set this to 'apksigner' to always run
+# apksigner for each APK.  Set this to 'python' to run the same checks
+# as apksigner and jarsigner in Python, so that neither Java nor the
+# Android SDK are needed to verify signatures.
+#
+# signature_verifier = 'apksigner'
+# signature_verifier = 'python'
+
 # Normally, all apps are collected into a single app repository, like on
 # https://f-droid.org. For certain situations, it is better to make a repo
 # that is made up of APKs only from a single app. For example, an automated
@@ -99,6 +123,13 @@ The repository of older versions of applications from the main demo repository.
 # this link, uncomment this:
 # make_current_version_link = False
 
+# `fdroid update` writes gzip compressed copies of the index and the other
+# text files in the repo next to them, e.g. index.xml.gz, so the webserver
+# can send those as they are (nginx: gzip_static on). If the brotli Python
+# module is installed, .br copies are written too. To disable this,
+# uncomment this:
+# make_compressed_sidecars = False
+
 # By default, the "current version" link will be based on the "Name" of the
 # app from the metadata. You can change it to use a different field from the
 # metadata here:
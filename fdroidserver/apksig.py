@@ -0,0 +1,1148 @@
+#!/usr/bin/env python3
+#
+# apksig.py - part of the FDroid server tools
+# Copyright (C) 2019, The F-Droid Project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Verify and sign JARs and APKs without running a JVM
+
+This implements the checks of `apksigner verify` for the v1 (JAR), v2
+and v3 APK signature schemes, and the checks of `jarsigner -strict
+-verify` for plain JARs.  JARs like the signed repo indexes can also be
+signed with an RSA key from a JKS or PKCS#12 keystore.  Structures are parsed with pyasn1, digests
+are checked with hashlib, and the RSA, DSA and ECDSA public key math is
+done in plain Python, so this needs nothing beyond what fdroidserver
+already requires.
+
+https://docs.oracle.com/javase/8/docs/technotes/guides/jar/jar.html#Signed_JAR_File
+https://source.android.com/security/apksigning/v2
+https://source.android.com/security/apksigning/v3
+"""
+
+import hashlib
+import os
+import re
+import struct
+import zipfile
+
+from pyasn1.codec.der import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pyasn1.type import univ
+from pyasn1_modules import rfc2315, rfc2437, rfc2459, rfc3279, rfc5208
+
+from . import _
+from . import common
+from .exception import FDroidException, VerificationException
+
+
+# the first Android version that supports APK Signature Scheme v2
+ANDROID_N_SDK_VERSION = 24
+
+HASH_ALGORITHMS = {
+    '1.2.840.113549.2.2': 'md2',
+    '1.2.840.113549.2.5': 'md5',
+    '1.3.14.3.2.26': 'sha1',
+    '2.16.840.1.101.3.4.2.4': 'sha224',
+    '2.16.840.1.101.3.4.2.1': 'sha256',
+    '2.16.840.1.101.3.4.2.2': 'sha384',
+    '2.16.840.1.101.3.4.2.3': 'sha512',
+}
+
+# the digest attribute names used in MANIFEST.MF and .SF files
+MANIFEST_DIGEST_ALGORITHMS = {
+    'md5': 'md5',
+    'sha1': 'sha1',
+    'sha-1': 'sha1',
+    'sha-256': 'sha256',
+    'sha-384': 'sha384',
+    'sha-512': 'sha512',
+}
+
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_DSA = '1.2.840.10040.4.1'
+OID_EC_PUBLIC_KEY = '1.2.840.10045.2.1'
+OID_CONTENT_TYPE = '1.2.840.113549.1.9.3'
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+
+# the key algorithm of the signature algorithms used in PKCS#7 SignerInfos
+SIGNATURE_KEY_ALGORITHMS = {
+    OID_RSA_ENCRYPTION: 'RSA',
+    '1.2.840.113549.1.1.2': 'RSA',  # md2WithRSAEncryption
+    '1.2.840.113549.1.1.4': 'RSA',  # md5WithRSAEncryption
+    '1.2.840.113549.1.1.5': 'RSA',  # sha1WithRSAEncryption
+    '1.2.840.113549.1.1.11': 'RSA',  # sha256WithRSAEncryption
+    '1.2.840.113549.1.1.12': 'RSA',  # sha384WithRSAEncryption
+    '1.2.840.113549.1.1.13': 'RSA',  # sha512WithRSAEncryption
+    '1.2.840.113549.1.1.14': 'RSA',  # sha224WithRSAEncryption
+    OID_DSA: 'DSA',
+    '1.2.840.10040.4.3': 'DSA',  # dsa-with-sha1
+    '2.16.840.1.101.3.4.3.1': 'DSA',  # dsa-with-sha224
+    '2.16.840.1.101.3.4.3.2': 'DSA',  # dsa-with-sha256
+    OID_EC_PUBLIC_KEY: 'EC',
+    '1.2.840.10045.4.1': 'EC',  # ecdsa-with-SHA1
+    '1.2.840.10045.4.3.1': 'EC',  # ecdsa-with-SHA224
+    '1.2.840.10045.4.3.2': 'EC',  # ecdsa-with-SHA256
+    '1.2.840.10045.4.3.3': 'EC',  # ecdsa-with-SHA384
+    '1.2.840.10045.4.3.4': 'EC',  # ecdsa-with-SHA512
+}
+
+# APK Signature Scheme v2/v3 signature algorithm IDs, strongest first:
+# (key algorithm, padding, hash, content digest)
+SCHEME_SIGNATURE_ALGORITHMS = {
+    0x0104: ('RSA', 'PKCS1', 'sha512', 'sha512'),
+    0x0102: ('RSA', 'PSS', 'sha512', 'sha512'),
+    0x0202: ('EC', None, 'sha512', 'sha512'),
+    0x0103: ('RSA', 'PKCS1', 'sha256', 'sha256'),
+    0x0101: ('RSA', 'PSS', 'sha256', 'sha256'),
+    0x0201: ('EC', None, 'sha256', 'sha256'),
+    0x0301: ('DSA', None, 'sha256', 'sha256'),
+}
+
+CONTENT_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+class _Curve:
+    """A NIST prime curve y^2 = x^3 - 3x + b, as used by ECDSA"""
+
+    def __init__(self, p, b, gx, gy, n):
+        self.p = p
+        self.b = b
+        self.g = (gx, gy)
+        self.n = n
+
+    def contains(self, point):
+        x, y = point
+        return 0 <= x < self.p and 0 <= y < self.p \
+            and (y * y - (x * x * x - 3 * x + self.b)) % self.p == 0
+
+    def _double(self, point):
+        x, y, z = point
+        if y == 0 or z == 0:
+            return (0, 1, 0)
+        p = self.p
+        ysq = y * y % p
+        s = 4 * x * ysq % p
+        zsq = z * z % p
+        m = 3 * (x - zsq) * (x + zsq) % p
+        nx = (m * m - 2 * s) % p
+        ny = (m * (s - nx) - 8 * ysq * ysq) % p
+        nz = 2 * y * z % p
+        return (nx, ny, nz)
+
+    def _add(self, a, b):
+        if a[2] == 0:
+            return b
+        if b[2] == 0:
+            return a
+        p = self.p
+        x1, y1, z1 = a
+        x2, y2, z2 = b
+        z1sq = z1 * z1 % p
+        z2sq = z2 * z2 % p
+        u1 = x1 * z2sq % p
+        u2 = x2 * z1sq % p
+        s1 = y1 * z2sq * z2 % p
+        s2 = y2 * z1sq * z1 % p
+        if u1 == u2:
+            if s1 != s2:
+                return (0, 1, 0)
+            return self._double(a)
+        h = (u2 - u1) % p
+        r = (s2 - s1) % p
+        hsq = h * h % p
+        hcu = hsq * h % p
+        nx = (r * r - hcu - 2 * u1 * hsq) % p
+        ny = (r * (u1 * hsq - nx) - s1 * hcu) % p
+        nz = h * z1 * z2 % p
+        return (nx, ny, nz)
+
+    def multiply_add(self, k1, point1, k2, point2):
+        """Calculate k1 * point1 + k2 * point2 in affine coordinates, or None for infinity"""
+        a = (point1[0], point1[1], 1)
+        b = (point2[0], point2[1], 1)
+        ab = self._add(a, b)
+        result = (0, 1, 0)
+        for i in range(max(k1.bit_length(), k2.bit_length()) - 1, -1, -1):
+            result = self._double(result)
+            bits = ((k1 >> i) & 1, (k2 >> i) & 1)
+            if bits == (1, 1):
+                result = self._add(result, ab)
+            elif bits == (1, 0):
+                result = self._add(result, a)
+            elif bits == (0, 1):
+                result = self._add(result, b)
+        x, y, z = result
+        if z == 0:
+            return None
+        zinv = _modinv(z, self.p)
+        return (x * zinv * zinv % self.p, y * zinv * zinv * zinv % self.p)
+
+
+CURVES = {
+    '1.2.840.10045.3.1.7': _Curve(  # NIST P-256
+        p=0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+        b=0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+        gx=0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+        gy=0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5,
+        n=0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551),
+    '1.3.132.0.34': _Curve(  # NIST P-384
+        p=int('fffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffe'
+              'ffffffff0000000000000000ffffffff', 16),
+        b=int('b3312fa7e23ee7e4988e056be3f82d19181d9c6efe8141120314088f5013875a'
+              'c656398d8a2ed19d2a85c8edd3ec2aef', 16),
+        gx=int('aa87ca22be8b05378eb1c71ef320ad746e1d3b628ba79b9859f741e082542a38'
+               '5502f25dbf55296c3a545e3872760ab7', 16),
+        gy=int('3617de4a96262c6f5d9e98bf9292dc29f8f41dbd289a147ce9da3113b5f0b8c0'
+               '0a60b1ce1d7e819d7a431d7c90ea0e5f', 16),
+        n=int('ffffffffffffffffffffffffffffffffffffffffffffffffc7634d81f4372ddf'
+              '581a0db248b0a77aecec196accc52973', 16)),
+    '1.3.132.0.35': _Curve(  # NIST P-521
+        p=2 ** 521 - 1,
+        b=int('0051953eb9618e1c9a1f929a21a0b68540eea2da725b99b315f3b8b489918ef1'
+              '09e156193951ec7e937b1652c0bd3bb1bf073573df883d2c34f1ef451fd46b50'
+              '3f00', 16),
+        gx=int('00c6858e06b70404e9cd9e3ecb662395b4429c648139053fb521f828af606b4d'
+               '3dbaa14b5e77efe75928fe1dc127a2ffa8de3348b3c1856a429bf97e7e31c2e5'
+               'bd66', 16),
+        gy=int('011839296a789a3bc0045c8a5fb42c7d1bd998f54449579b446817afbd17273e'
+               '662c97ee72995ef42640c550b9013fad0761353c7086a272c24088be94769fd1'
+               '6650', 16),
+        n=int('01ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff'
+              'fffa51868783bf2f966b7fcc0148f709a5d03bb5c9b8899c47aebb6fb71e9138'
+              '6409', 16)),
+}
+
+
+def _modinv(a, m):
+    """Modular multiplicative inverse, since pow(a, -1, m) needs Python 3.8"""
+    x0, x1, r0, r1 = 0, 1, m, a % m
+    while r1:
+        q = r0 // r1
+        x0, x1 = x1, x0 - q * x1
+        r0, r1 = r1, r0 - q * r1
+    if r0 != 1:
+        raise ValueError('not invertible')
+    return x0 % m
+
+
+def _digest_info(hash_name, digest, null_parameters=True):
+    """DER-encode a PKCS#1 DigestInfo, which all fit in short-form lengths"""
+    oid = {v: k for k, v in HASH_ALGORITHMS.items()}[hash_name]
+    algorithm = encoder.encode(univ.ObjectIdentifier(oid))
+    if null_parameters:
+        algorithm += b'\x05\x00'
+    algorithm = b'\x30' + bytes([len(algorithm)]) + algorithm
+    octets = b'\x04' + bytes([len(digest)]) + digest
+    return b'\x30' + bytes([len(algorithm) + len(octets)]) + algorithm + octets
+
+
+def _mgf1(seed, length, hash_name):
+    mask = b''
+    counter = 0
+    while len(mask) < length:
+        mask += hashlib.new(hash_name, seed + struct.pack('>I', counter)).digest()
+        counter += 1
+    return mask[:length]
+
+
+class PublicKey:
+    """A parsed RSA, DSA or EC public key from a SubjectPublicKeyInfo"""
+
+    def __init__(self, spki_der):
+        try:
+            spki = decoder.decode(spki_der, asn1Spec=rfc2459.SubjectPublicKeyInfo())[0]
+            self.encoded = spki_der
+            algorithm = str(spki['algorithm']['algorithm'])
+            parameters = spki['algorithm']['parameters']
+            key = spki['subjectPublicKey'].asOctets()
+            if algorithm == OID_RSA_ENCRYPTION:
+                self.algorithm = 'RSA'
+                rsa = decoder.decode(key, asn1Spec=rfc2437.RSAPublicKey())[0]
+                self.n = int(rsa['modulus'])
+                self.e = int(rsa['publicExponent'])
+            elif algorithm == OID_DSA:
+                self.algorithm = 'DSA'
+                if not parameters.isValue:
+                    raise VerificationException(_('DSA public key without parameters'))
+                params = decoder.decode(parameters, asn1Spec=rfc3279.Dss_Parms())[0]
+                self.p = int(params['p'])
+                self.q = int(params['q'])
+                self.g = int(params['g'])
+                self.y = int(decoder.decode(key, asn1Spec=univ.Integer())[0])
+            elif algorithm == OID_EC_PUBLIC_KEY:
+                self.algorithm = 'EC'
+                curve = str(decoder.decode(parameters, asn1Spec=univ.ObjectIdentifier())[0])
+                if curve not in CURVES:
+                    raise VerificationException(_('Unsupported elliptic curve {oid}').format(oid=curve))
+                self.curve = CURVES[curve]
+                self.point = self._decode_point(key)
+            else:
+                raise VerificationException(_('Unsupported public key algorithm {oid}')
+                                            .format(oid=algorithm))
+        except PyAsn1Error as e:
+            raise VerificationException(_('Malformed public key: {error}').format(error=e))
+
+    def _decode_point(self, data):
+        p = self.curve.p
+        size = (p.bit_length() + 7) // 8
+        if len(data) == 1 + 2 * size and data[0] == 4:
+            point = (int.from_bytes(data[1:1 + size], 'big'), int.from_bytes(data[1 + size:], 'big'))
+        elif len(data) == 1 + size and data[0] in (2, 3):
+            x = int.from_bytes(data[1:], 'big')
+            # all supported curves have p = 3 mod 4, so this is the square root
+            y = pow((x * x * x - 3 * x + self.curve.b) % p, (p + 1) // 4, p)
+            if y % 2 != data[0] % 2:
+                y = p - y
+            point = (x, y)
+        else:
+            raise VerificationException(_('Malformed elliptic curve public key'))
+        if not self.curve.contains(point):
+            raise VerificationException(_('Elliptic curve public key is not on the curve'))
+        return point
+
+    @property
+    def size(self):
+        """The size of the key in bits, as used for key size restrictions"""
+        if self.algorithm == 'RSA':
+            return self.n.bit_length()
+        elif self.algorithm == 'DSA':
+            return self.p.bit_length()
+        return self.curve.n.bit_length()
+
+    def verify(self, signature, data, hash_name, padding='PKCS1'):
+        """Check a signature over data, made with this key and the given hash
+
+        :raises: VerificationException if the signature does not match
+        """
+        digest = hashlib.new(hash_name, data).digest()
+        if self.algorithm == 'RSA':
+            valid = self._verify_rsa(signature, digest, hash_name, padding)
+        else:
+            try:
+                rs = decoder.decode(signature, asn1Spec=rfc3279.Dss_Sig_Value())[0]
+            except PyAsn1Error:
+                raise VerificationException(_('Malformed {algorithm} signature')
+                                            .format(algorithm=self.algorithm))
+            r, s = int(rs['r']), int(rs['s'])
+            if self.algorithm == 'DSA':
+                valid = self._verify_dsa(r, s, digest)
+            else:
+                valid = self._verify_ecdsa(r, s, digest)
+        if not valid:
+            raise VerificationException(_('{algorithm} signature does not verify')
+                                        .format(algorithm=self.algorithm))
+
+    def _verify_rsa(self, signature, digest, hash_name, padding):
+        k = (self.n.bit_length() + 7) // 8
+        s = int.from_bytes(signature, 'big')
+        if len(signature) != k or s >= self.n:
+            return False
+        m = pow(s, self.e, self.n)
+        if padding == 'PSS':
+            return self._verify_pss(m, digest, hash_name)
+        em = m.to_bytes(k, 'big')
+        for t in (_digest_info(hash_name, digest), _digest_info(hash_name, digest, False)):
+            padding_length = k - 3 - len(t)
+            if padding_length >= 8 and em == b'\x00\x01' + b'\xff' * padding_length + b'\x00' + t:
+                return True
+        return False
+
+    def _verify_pss(self, m, digest, hash_name):
+        """EMSA-PSS-VERIFY from RFC 8017 with MGF1 and the salt as long as the digest"""
+        hlen = slen = len(digest)
+        embits = self.n.bit_length() - 1
+        emlen = (embits + 7) // 8
+        if m.bit_length() > embits or emlen < hlen + slen + 2:
+            return False
+        em = m.to_bytes(emlen, 'big')
+        if em[-1] != 0xbc:
+            return False
+        masked_db, h = em[:emlen - hlen - 1], em[emlen - hlen - 1:-1]
+        db = bytearray(a ^ b for a, b in zip(masked_db, _mgf1(h, len(masked_db), hash_name)))
+        db[0] &= 0xff >> (8 * emlen - embits)
+        if any(db[:emlen - hlen - slen - 2]) or db[emlen - hlen - slen - 2] != 1:
+            return False
+        salt = bytes(db[-slen:])
+        return h == hashlib.new(hash_name, b'\x00' * 8 + digest + salt).digest()
+
+    def _verify_dsa(self, r, s, digest):
+        if not (0 < r < self.q and 0 < s < self.q):
+            return False
+        z = int.from_bytes(digest, 'big') >> max(0, 8 * len(digest) - self.q.bit_length())
+        w = _modinv(s, self.q)
+        v = pow(self.g, z * w % self.q, self.p) * pow(self.y, r * w % self.q, self.p) % self.p
+        return v % self.q == r
+
+    def _verify_ecdsa(self, r, s, digest):
+        n = self.curve.n
+        if not (0 < r < n and 0 < s < n):
+            return False
+        z = int.from_bytes(digest, 'big') >> max(0, 8 * len(digest) - n.bit_length())
+        w = _modinv(s, n)
+        point = self.curve.multiply_add(z * w % n, self.curve.g, r * w % n, self.point)
+        return point is not None and point[0] % n == r
+
+
+def get_certificate_public_key(cert_der):
+    """Get the PublicKey from a DER-encoded X.509 certificate"""
+    try:
+        cert = decoder.decode(cert_der, asn1Spec=rfc2459.Certificate())[0]
+    except PyAsn1Error as e:
+        raise VerificationException(_('Malformed certificate: {error}').format(error=e))
+    return PublicKey(encoder.encode(cert['tbsCertificate']['subjectPublicKeyInfo']))
+
+
+def _parse_manifest(data):
+    """Parse a JAR manifest or signature file into its sections
+
+    :returns: a list of (attributes, raw bytes) with the main section
+              first, the attribute names are lowercase
+    """
+    sections = []
+    attributes = dict()
+    start = 0
+    key = None
+    for m in re.finditer(b'([^\r\n]*)(\r\n|\r|\n)', data):
+        line = m.group(1)
+        if line == b'':
+            if m.start() > start:
+                sections.append((attributes, data[start:m.end()]))
+            attributes = dict()
+            start = m.end()
+            key = None
+        elif line.startswith(b' ') and key is not None:
+            attributes[key] += line[1:].decode('utf-8')
+        else:
+            k, sep, v = line.partition(b': ')
+            if not sep:
+                raise VerificationException(_('Malformed manifest line: {line}').format(line=line))
+            key = k.decode('utf-8').lower()
+            attributes[key] = v.decode('utf-8')
+    if start < len(data) and data[start:].strip():
+        raise VerificationException(_('Manifest does not end with a line break'))
+    if not sections:
+        sections.append((dict(), b''))
+    return sections
+
+
+def _get_manifest_digests(attributes, suffix):
+    """Get the supported digests from manifest attributes named like SHA-256-Digest
+
+    :returns: dict of hashlib name to base64-encoded digest
+    """
+    digests = dict()
+    for k, v in attributes.items():
+        if k.endswith(suffix):
+            algorithm = MANIFEST_DIGEST_ALGORITHMS.get(k[:-len(suffix)])
+            if algorithm:
+                digests[algorithm] = v
+    return digests
+
+
+def _check_manifest_digests(digests, data, disabled_digests):
+    if not digests:
+        return False
+    for algorithm, value in digests.items():
+        if algorithm in disabled_digests:
+            return False
+        if common.base64.b64encode(hashlib.new(algorithm, data).digest()).decode() != value:
+            return False
+    return True
+
+
+def _is_jar_signature_file(name):
+    """Files which are part of the JAR signature, so are not in the manifest"""
+    if not name.startswith('META-INF/'):
+        return False
+    if name == 'META-INF/MANIFEST.MF':
+        return True
+    basename = name[len('META-INF/'):]
+    if '/' in basename:
+        return False
+    return basename.startswith('SIG-') or basename.upper().endswith(('.SF', '.RSA', '.DSA', '.EC'))
+
+
+def _verify_signature_block(block, sf, disabled_digests, min_key_size):
+    """Check the PKCS#7 signature of a .SF file
+
+    :returns: the DER-encoded certificate of the signer
+    """
+    try:
+        content = decoder.decode(block, asn1Spec=rfc2315.ContentInfo())[0]
+        if content['contentType'] != rfc2315.signedData:
+            raise VerificationException(_('Signature block is not PKCS#7 SignedData'))
+        signed_data = decoder.decode(content['content'], asn1Spec=rfc2315.SignedData())[0]
+        certificates = [c['certificate'] for c in signed_data['certificates']]
+        signer_infos = list(signed_data['signerInfos'])
+    except PyAsn1Error as e:
+        raise VerificationException(_('Malformed signature block: {error}').format(error=e))
+    if len(signer_infos) != 1:
+        raise VerificationException(_('Signature block must have exactly one signer, not {count}')
+                                    .format(count=len(signer_infos)))
+    signer_info = signer_infos[0]
+
+    cert = None
+    serial = signer_info['issuerAndSerialNumber']['serialNumber']
+    issuer = encoder.encode(signer_info['issuerAndSerialNumber']['issuer'])
+    for c in certificates:
+        if c['tbsCertificate']['serialNumber'] == serial \
+           and encoder.encode(c['tbsCertificate']['issuer']) == issuer:
+            cert = encoder.encode(c)
+            break
+    if cert is None:
+        raise VerificationException(_('Signing certificate not found in signature block'))
+    public_key = get_certificate_public_key(cert)
+
+    digest_oid = str(signer_info['digestAlgorithm']['algorithm'])
+    hash_name = HASH_ALGORITHMS.get(digest_oid)
+    if hash_name is None or hash_name in disabled_digests:
+        raise VerificationException(_('Unsupported or disabled digest algorithm {algorithm}')
+                                    .format(algorithm=hash_name or digest_oid))
+    key_algorithm = SIGNATURE_KEY_ALGORITHMS.get(str(signer_info['digestEncryptionAlgorithm']['algorithm']))
+    if key_algorithm != public_key.algorithm:
+        raise VerificationException(_('Signature algorithm does not match the signing key'))
+    if public_key.algorithm == 'RSA' and public_key.size < min_key_size:
+        raise VerificationException(_('RSA key size {size} is below the minimum of {minimum}')
+                                    .format(size=public_key.size, minimum=min_key_size))
+
+    signed = sf
+    attributes = signer_info['authenticatedAttributes']
+    if attributes.isValue and len(attributes) > 0:
+        message_digest = None
+        for attribute in attributes:
+            if str(attribute['type']) == OID_MESSAGE_DIGEST:
+                message_digest = decoder.decode(attribute['values'][0],
+                                                asn1Spec=univ.OctetString())[0].asOctets()
+        if message_digest != hashlib.new(hash_name, sf).digest():
+            raise VerificationException(_('Signature file digest does not match signed attributes'))
+        # the attributes are signed as a SET OF, not with their implicit [0] tag
+        signed = b'\x31' + encoder.encode(attributes)[1:]
+    public_key.verify(signer_info['encryptedDigest'].asOctets(), signed, hash_name)
+    return cert
+
+
+def verify_v1(inspection, disabled_digests=(), min_key_size=0, apk_signature_schemes=None):
+    """Verify the JAR signature of a JAR or APK, like `jarsigner -strict -verify`
+
+    Every file in the ZIP must be listed in META-INF/MANIFEST.MF with
+    a matching digest, and covered by every signer.
+
+    :param inspection: an ApkInspection of the JAR or APK
+    :param disabled_digests: hashlib names of digest algorithms to reject
+    :param min_key_size: reject RSA keys with fewer bits than this
+    :param apk_signature_schemes: for APKs, the APK Signature Scheme versions
+                                  that are present, to detect stripped signatures
+    :returns: the DER-encoded certificates of the signers
+    :raises: VerificationException
+    """
+    zf = inspection.zipfile
+    names = zf.namelist()
+    if len(names) != len(set(names)):
+        raise VerificationException(_('Duplicate ZIP entries'))
+    if 'META-INF/MANIFEST.MF' not in names:
+        raise VerificationException(_('Missing META-INF/MANIFEST.MF'))
+    manifest_bytes = zf.read('META-INF/MANIFEST.MF')
+    manifest = _parse_manifest(manifest_bytes)
+    manifest_entries = dict()
+    for attributes, raw in manifest[1:]:
+        if 'name' in attributes:
+            if attributes['name'] in manifest_entries:
+                raise VerificationException(_('Duplicate entry {name} in manifest')
+                                            .format(name=attributes['name']))
+            manifest_entries[attributes['name']] = (attributes, raw)
+
+    signers = []
+    for name in names:
+        if common.SIGNATURE_BLOCK_FILE_REGEX.match(name):
+            sfname = name[:name.rindex('.')] + '.SF'
+            if sfname not in names:
+                raise VerificationException(_('Missing {path}').format(path=sfname))
+            signers.append((sfname, name))
+    if not signers:
+        raise VerificationException(_('No JAR signatures'))
+
+    certs = []
+    signed_names = None
+    for sfname, blockname in sorted(signers):
+        sf_bytes = zf.read(sfname)
+        certs.append(_verify_signature_block(zf.read(blockname), sf_bytes,
+                                             disabled_digests, min_key_size))
+        sf = _parse_manifest(sf_bytes)
+        main = sf[0][0]
+
+        if apk_signature_schemes is not None and 'x-android-apk-signed' in main:
+            for scheme in main['x-android-apk-signed'].split(','):
+                scheme = scheme.strip()
+                if scheme.isdigit() and int(scheme) not in apk_signature_schemes \
+                   and int(scheme) in (2, 3):
+                    raise VerificationException(
+                        _('{path} indicates the APK is signed using APK Signature Scheme v{version}'
+                          ' but no such signature was found. Signature stripped?')
+                        .format(path=sfname, version=scheme))
+
+        if _check_manifest_digests(_get_manifest_digests(main, '-digest-manifest'),
+                                   manifest_bytes, disabled_digests):
+            names_for_signer = set(manifest_entries)
+        else:
+            main_digests = _get_manifest_digests(main, '-digest-manifest-main-attributes')
+            if main_digests and not _check_manifest_digests(main_digests, manifest[0][1],
+                                                            disabled_digests):
+                raise VerificationException(_('{path} does not match the main attributes of the manifest')
+                                            .format(path=sfname))
+            names_for_signer = set()
+            for attributes, raw in sf[1:]:
+                name = attributes.get('name')
+                if name is None:
+                    continue
+                if name not in manifest_entries:
+                    raise VerificationException(_('{path} lists {name} which is not in the manifest')
+                                                .format(path=sfname, name=name))
+                if not _check_manifest_digests(_get_manifest_digests(attributes, '-digest'),
+                                               manifest_entries[name][1], disabled_digests):
+                    raise VerificationException(_('{path} digest of {name} does not match the manifest')
+                                                .format(path=sfname, name=name))
+                names_for_signer.add(name)
+        signed_names = names_for_signer if signed_names is None else signed_names & names_for_signer
+
+    for info in zf.infolist():
+        name = info.filename
+        if name.endswith('/') or _is_jar_signature_file(name):
+            continue
+        if name not in manifest_entries:
+            raise VerificationException(_('{name} is not listed in the manifest').format(name=name))
+        if name not in signed_names:
+            raise VerificationException(_('{name} is not signed by all signers').format(name=name))
+        digests = _get_manifest_digests(manifest_entries[name][0], '-digest')
+        if not digests or any(d in disabled_digests for d in digests):
+            raise VerificationException(_('No supported digest for {name} in the manifest')
+                                        .format(name=name))
+        hashers = {algorithm: hashlib.new(algorithm) for algorithm in digests}
+        try:
+            with zf.open(info) as fp:
+                while True:
+                    chunk = fp.read(65536)
+                    if not chunk:
+                        break
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+        except (zipfile.BadZipFile, OSError, RuntimeError) as e:
+            raise VerificationException(_('Cannot read {name}: {error}').format(name=name, error=e))
+        for algorithm, hasher in hashers.items():
+            if common.base64.b64encode(hasher.digest()).decode() != digests[algorithm]:
+                raise VerificationException(_('{name} does not match its digest in the manifest')
+                                            .format(name=name))
+    return certs
+
+
+def _read_length_prefixed_list(data):
+    values = []
+    offset = 0
+    while offset < len(data):
+        value, offset = common._read_length_prefixed(data, offset)
+        values.append(value)
+    return values
+
+
+def _find_zip_sections(inspection):
+    """Find the parts of the file that APK Signature Scheme v2/v3 digests cover
+
+    :returns: (signing block offset, central directory offset, EOCD offset, EOCD bytes)
+    """
+    size = inspection.size
+    tail_size = min(size, 22 + 0xffff)
+    tail = inspection.read(size - tail_size, tail_size)
+    pos = tail.rfind(b'PK\x05\x06')
+    while pos >= 0:
+        if pos + 22 <= len(tail) \
+           and pos + 22 + struct.unpack_from('<H', tail, pos + 20)[0] == len(tail):
+            break
+        pos = tail.rfind(b'PK\x05\x06', 0, pos)
+    if pos < 0:
+        raise VerificationException(_('ZIP End of Central Directory record not found'))
+    eocd_offset = size - tail_size + pos
+    eocd = tail[pos:]
+    cd_size, cd_offset = struct.unpack_from('<II', eocd, 12)
+    if cd_offset + cd_size != eocd_offset:
+        raise VerificationException(_('ZIP Central Directory is not immediately followed by'
+                                      ' the End of Central Directory record'))
+    if cd_offset < 32:
+        raise VerificationException(_('APK Signing Block not found'))
+    block_size, magic = struct.unpack('<Q16s', inspection.read(cd_offset - 24, 24))
+    if magic != common.APK_SIGNING_BLOCK_MAGIC or block_size > cd_offset - 8:
+        raise VerificationException(_('APK Signing Block not found'))
+    return cd_offset - block_size - 8, cd_offset, eocd_offset, eocd
+
+
+def _compute_content_digest(inspection, hash_name, sections):
+    signing_block_offset, cd_offset, eocd_offset, eocd = sections
+    # the digest of the EOCD uses the offset of the APK Signing Block as the
+    # offset of the Central Directory, as if the APK Signing Block was not there
+    eocd = eocd[:16] + struct.pack('<I', signing_block_offset) + eocd[20:]
+    chunk_digests = []
+
+    def digest_chunk(chunk):
+        h = hashlib.new(hash_name, b'\xa5' + struct.pack('<I', len(chunk)))
+        h.update(chunk)
+        chunk_digests.append(h.digest())
+
+    for start, end in ((0, signing_block_offset), (cd_offset, eocd_offset)):
+        for offset in range(start, end, CONTENT_DIGEST_CHUNK_SIZE):
+            digest_chunk(inspection.read(offset, min(CONTENT_DIGEST_CHUNK_SIZE, end - offset)))
+    for offset in range(0, len(eocd), CONTENT_DIGEST_CHUNK_SIZE):
+        digest_chunk(eocd[offset:offset + CONTENT_DIGEST_CHUNK_SIZE])
+
+    h = hashlib.new(hash_name, b'\x5a' + struct.pack('<I', len(chunk_digests)))
+    for d in chunk_digests:
+        h.update(d)
+    return h.digest()
+
+
+def verify_signature_scheme(inspection, version):
+    """Verify an APK Signature Scheme v2 or v3 signature
+
+    :returns: the DER-encoded certificates of the first signer
+    :raises: VerificationException
+    """
+    if version == 2:
+        block = inspection.signing_block.get(common.APK_SIGNATURE_SCHEME_V2_BLOCK_ID)
+    else:
+        block = inspection.signing_block.get(common.APK_SIGNATURE_SCHEME_V3_BLOCK_ID)
+    if block is None:
+        raise VerificationException(_('No APK Signature Scheme v{version} signature')
+                                    .format(version=version))
+    scheme = _('APK Signature Scheme v{version}').format(version=version)
+
+    expected_digests = dict()
+    first_certs = None
+    try:
+        signers = _read_length_prefixed_list(common._read_length_prefixed(block, 0)[0])
+        if not signers:
+            raise VerificationException(_('{scheme} block has no signers').format(scheme=scheme))
+        for signer in signers:
+            signed_data, offset = common._read_length_prefixed(signer, 0)
+            if version == 3:
+                min_sdk, max_sdk = struct.unpack_from('<II', signer, offset)
+                offset += 8
+            signatures, offset = common._read_length_prefixed(signer, offset)
+            public_key_der, offset = common._read_length_prefixed(signer, offset)
+            public_key = PublicKey(public_key_der)
+
+            signature_algorithms = []
+            best = None
+            for record in _read_length_prefixed_list(signatures):
+                algorithm_id, = struct.unpack_from('<I', record)
+                signature_algorithms.append(algorithm_id)
+                if algorithm_id in SCHEME_SIGNATURE_ALGORITHMS:
+                    rank = list(SCHEME_SIGNATURE_ALGORITHMS).index(algorithm_id)
+                    if best is None or rank < best[0]:
+                        best = (rank, algorithm_id, common._read_length_prefixed(record, 4)[0])
+            if best is None:
+                raise VerificationException(_('{scheme} signer has no supported signatures')
+                                            .format(scheme=scheme))
+            key_algorithm, padding, hash_name, content_digest = SCHEME_SIGNATURE_ALGORITHMS[best[1]]
+            if key_algorithm != public_key.algorithm:
+                raise VerificationException(_('{scheme} signature algorithm does not match the key')
+                                            .format(scheme=scheme))
+            public_key.verify(best[2], signed_data, hash_name, padding)
+
+            digests, offset = common._read_length_prefixed(signed_data, 0)
+            certificates, offset = common._read_length_prefixed(signed_data, offset)
+            if version == 3:
+                if (min_sdk, max_sdk) != struct.unpack_from('<II', signed_data, offset):
+                    raise VerificationException(_('{scheme} SDK versions of signer and signed data'
+                                                  ' do not match').format(scheme=scheme))
+            digest_algorithms = []
+            for record in _read_length_prefixed_list(digests):
+                algorithm_id, = struct.unpack_from('<I', record)
+                digest_algorithms.append(algorithm_id)
+                if algorithm_id == best[1]:
+                    expected = common._read_length_prefixed(record, 4)[0]
+                    if expected_digests.get(content_digest, expected) != expected:
+                        raise VerificationException(_('{scheme} signers have different content digests')
+                                                    .format(scheme=scheme))
+                    expected_digests[content_digest] = expected
+            if digest_algorithms != signature_algorithms:
+                raise VerificationException(_('{scheme} signature and digest algorithms do not match')
+                                            .format(scheme=scheme))
+            certs = _read_length_prefixed_list(certificates)
+            if not certs:
+                raise VerificationException(_('{scheme} signer has no certificates').format(scheme=scheme))
+            if get_certificate_public_key(certs[0]).encoded != public_key.encoded:
+                raise VerificationException(_('{scheme} public key does not match the certificate')
+                                            .format(scheme=scheme))
+            if first_certs is None:
+                first_certs = certs
+    except (ValueError, struct.error) as e:
+        raise VerificationException(_('Malformed {scheme} block: {error}').format(scheme=scheme, error=e))
+
+    sections = _find_zip_sections(inspection)
+    for hash_name, expected in expected_digests.items():
+        if _compute_content_digest(inspection, hash_name, sections) != expected:
+            raise VerificationException(_('{scheme} digest of the APK contents does not match')
+                                        .format(scheme=scheme))
+    return first_certs
+
+
+def get_min_sdk_version(inspection):
+    """Get the minSdkVersion from the binary AndroidManifest.xml, 1 if not set"""
+    from androguard.core.bytecodes.axml import AXMLParser, START_TAG, END_DOCUMENT, TYPE_STRING
+    with inspection.zipfile.open('AndroidManifest.xml') as manifest:
+        axml = AXMLParser(manifest.read())
+    while axml.is_valid():
+        _type = next(axml)
+        if _type == START_TAG and axml.getName() == 'uses-sdk':
+            for i in range(axml.getAttributeCount()):
+                if axml.getAttributeName(i) == 'minSdkVersion':
+                    if axml.getAttributeValueType(i) != TYPE_STRING:
+                        return axml.getAttributeValueData(i)
+                    try:
+                        return int(axml.getAttributeValue(i))
+                    except ValueError:
+                        return 1  # a codename, so a preview version
+            break
+        if _type == END_DOCUMENT:
+            break
+    return 1
+
+
+def verify_apk(apkfile, min_sdk_version=None):
+    """Verify all the signatures of an APK, like `apksigner verify`
+
+    The JAR signature is required when the APK supports Android
+    versions before 7.0, and all APK Signature Scheme v2/v3 signatures
+    that are present must be valid.
+
+    :param apkfile: path to the APK, or a common.ApkInspection of it
+    :param min_sdk_version: check for this Android version instead of the
+                            minSdkVersion from the APK
+    :raises: VerificationException if the APK does not verify
+    """
+    try:
+        with common.inspect_apk(apkfile) as inspection:
+            if inspection.read_header(4) != b'PK\x03\x04':
+                raise VerificationException(_('Does not start with a ZIP entry, possible Janus exploit!'))
+            schemes = [v for v, block_id in ((2, common.APK_SIGNATURE_SCHEME_V2_BLOCK_ID),
+                                             (3, common.APK_SIGNATURE_SCHEME_V3_BLOCK_ID))
+                       if block_id in inspection.signing_block]
+            if min_sdk_version is None:
+                min_sdk_version = get_min_sdk_version(inspection)
+            if not schemes or int(min_sdk_version) < ANDROID_N_SDK_VERSION:
+                verify_v1(inspection, apk_signature_schemes=schemes)
+            for version in schemes:
+                verify_signature_scheme(inspection, version)
+    except VerificationException:
+        raise
+    except (FDroidException, zipfile.BadZipFile, KeyError, OSError) as e:
+        raise VerificationException(str(e))
+
+
+def verify_jar(jarfile, disabled_digests=('md2', 'md5'), min_key_size=1024):
+    """Verify the JAR signature of a JAR or APK, like `jarsigner -strict -verify`
+
+    The defaults reject the same algorithms as jarsigner does.
+
+    :param jarfile: path to the JAR, or a common.ApkInspection of it
+    :raises: VerificationException if the JAR does not verify
+    """
+    try:
+        with common.inspect_apk(jarfile) as inspection:
+            verify_v1(inspection, disabled_digests, min_key_size)
+    except VerificationException:
+        raise
+    except (FDroidException, zipfile.BadZipFile, KeyError, OSError, ValueError) as e:
+        raise VerificationException(str(e))
+
+
+# Signing JARs, like `jarsigner -digestalg SHA1 -sigalg SHA1withRSA`
+
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_SHA1 = '1.3.14.3.2.26'
+OID_JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+JKS_MAGIC = 0xfeedfeed
+SIGNATURE_FILE_CREATED_BY = 'fdroidserver'
+
+
+class PrivateKey:
+    """An RSA private key with its X.509 certificate, for signing JARs"""
+
+    def __init__(self, pkcs8_der, cert_der):
+        try:
+            info = decoder.decode(pkcs8_der, asn1Spec=rfc5208.PrivateKeyInfo())[0]
+            algorithm = str(info['privateKeyAlgorithm']['algorithm'])
+            if algorithm != OID_RSA_ENCRYPTION:
+                raise VerificationException(_('Unsupported private key algorithm {oid}')
+                                            .format(oid=algorithm))
+            rsa = decoder.decode(info['privateKey'].asOctets(), asn1Spec=rfc2437.RSAPrivateKey())[0]
+        except PyAsn1Error as e:
+            raise VerificationException(_('Malformed private key: {error}').format(error=e))
+        self.algorithm = 'RSA'
+        self.n = int(rsa['modulus'])
+        self.d = int(rsa['privateExponent'])
+        self.p = int(rsa['prime1'])
+        self.q = int(rsa['prime2'])
+        self.dp = int(rsa['exponent1'])
+        self.dq = int(rsa['exponent2'])
+        self.qinv = int(rsa['coefficient'])
+        self.certificate = cert_der
+        self.public_key = get_certificate_public_key(cert_der)
+        if self.public_key.algorithm != 'RSA' or self.public_key.n != self.n:
+            raise VerificationException(_('The certificate does not match the private key'))
+
+    def sign(self, data, hash_name='sha1'):
+        """RSASSA-PKCS1-v1_5 signature of data"""
+        size = (self.n.bit_length() + 7) // 8
+        t = _digest_info(hash_name, hashlib.new(hash_name, data).digest())
+        em = b'\x00\x01' + b'\xff' * (size - len(t) - 3) + b'\x00' + t
+        m = int.from_bytes(em, 'big')
+        m1 = pow(m, self.dp, self.p)
+        m2 = pow(m, self.dq, self.q)
+        s = m2 + self.q * ((self.qinv * (m1 - m2)) % self.p)
+        return s.to_bytes(size, 'big')
+
+
+def _read_jks_key(data, storepass, alias, keypass):
+    """Decrypt a private key entry from a Java KeyStore (JKS) file
+
+    :returns: (PKCS#8 DER, certificate DER), or None if alias is not a
+              key entry
+    """
+    password = storepass.encode('utf-16-be')
+    if hashlib.sha1(password + b'Mighty Aphrodite' + data[:-20]).digest() != data[-20:]:
+        raise FDroidException(_('Keystore was tampered with, or password was incorrect'))
+    magic, version, count = struct.unpack('>III', data[:12])
+    offset = 12
+
+    def read(length):
+        nonlocal offset
+        offset += length
+        return data[offset - length:offset]
+
+    def read_utf():
+        return read(struct.unpack('>H', read(2))[0]).decode('utf-8')
+
+    for i in range(count):
+        tag = struct.unpack('>I', read(4))[0]
+        entry_alias = read_utf()
+        read(8)  # timestamp
+        if tag == 1:
+            protected_key = read(struct.unpack('>I', read(4))[0])
+            chain = []
+            for j in range(struct.unpack('>I', read(4))[0]):
+                if version == 2:
+                    read_utf()  # certificate type
+                chain.append(read(struct.unpack('>I', read(4))[0]))
+        elif tag == 2:
+            if version == 2:
+                read_utf()
+            read(struct.unpack('>I', read(4))[0])
+            continue
+        else:
+            raise FDroidException(_('Unknown keystore entry type {tag}').format(tag=tag))
+        if entry_alias.lower() != alias.lower():
+            continue
+
+        info = decoder.decode(protected_key, asn1Spec=rfc5208.EncryptedPrivateKeyInfo())[0]
+        oid = str(info['encryptionAlgorithm']['algorithm'])
+        if oid != OID_JKS_KEY_PROTECTOR:
+            raise VerificationException(_('Unsupported key protection {oid}').format(oid=oid))
+        encrypted = info['encryptedData'].asOctets()
+        salt, encrypted, check = encrypted[:20], encrypted[20:-20], encrypted[-20:]
+        password = keypass.encode('utf-16-be')
+        stream = b''
+        block = salt
+        while len(stream) < len(encrypted):
+            block = hashlib.sha1(password + block).digest()
+            stream += block
+        plain = bytes(a ^ b for a, b in zip(encrypted, stream))
+        if hashlib.sha1(password + plain).digest() != check:
+            raise FDroidException(_('Cannot recover key "{alias}", the key password is incorrect')
+                                  .format(alias=alias))
+        return plain, chain[0]
+    return None
+
+
+def load_private_key(keystore, storepass, alias, keypass=None):
+    """Load a signing key from a JKS or PKCS#12 keystore
+
+    JKS is read in plain Python, PKCS#12 needs the optional cryptography
+    library.  Other keystore types, like JCEKS or smartcards, and keys
+    other than RSA are only usable with jarsigner.  So are PKCS#12
+    keystores where the key is not stored under alias, or which have a
+    separate key password.
+
+    :returns: a PrivateKey, or None if this keystore or key is not
+              supported here
+    :raises: FDroidException if alias is not in the keystore or a
+             password is wrong
+    """
+    if keypass is None:
+        keypass = storepass
+    try:
+        with open(keystore, 'rb') as fp:
+            data = fp.read()
+    except OSError as e:
+        raise FDroidException(_('Cannot read keystore {path}: {error}').format(path=keystore, error=e))
+    try:
+        if len(data) > 12 and struct.unpack('>I', data[:4])[0] == JKS_MAGIC:
+            entry = _read_jks_key(data, storepass, alias, keypass)
+        elif data[:1] == b'\x30':
+            try:
+                from cryptography.hazmat.primitives import serialization
+                from cryptography.hazmat.primitives.serialization import pkcs12
+            except ImportError:
+                return None
+            # the key is decrypted with storepass, and there is only room
+            # for one key, so anything else is left to jarsigner
+            if keypass != storepass or not hasattr(pkcs12, 'load_pkcs12'):
+                return None
+            try:
+                p12 = pkcs12.load_pkcs12(data, storepass.encode('utf-8'))
+            except ValueError as e:
+                raise FDroidException(_('Cannot read keystore {path}: {error}')
+                                      .format(path=keystore, error=e))
+            if p12.key is None or p12.cert is None or p12.cert.friendly_name is None:
+                return None
+            # Java keystores store PKCS#12 aliases in lower case
+            if p12.cert.friendly_name.decode('utf-8').lower() != alias.lower():
+                return None
+            entry = (p12.key.private_bytes(serialization.Encoding.DER,
+                                           serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()),
+                     p12.cert.certificate.public_bytes(serialization.Encoding.DER))
+        else:
+            return None
+        if entry is None:
+            raise FDroidException(_('Alias "{alias}" not found in keystore {path}')
+                                  .format(alias=alias, path=keystore))
+        return PrivateKey(*entry)
+    except (VerificationException, PyAsn1Error, struct.error, IndexError):
+        return None
+
+
+def get_signature_file_name(alias):
+    """The base name jarsigner uses for the .SF and block files of alias"""
+    return re.sub(r'[^A-Z0-9_-]', '_', alias[:8].upper())
+
+
+def _make_manifest_section(attributes):
+    """Encode (name, value) pairs as a manifest section, wrapped at 72 bytes"""
+    section = b''
+    for name, value in attributes:
+        line = ('%s: %s' % (name, value)).encode('utf-8')
+        section += line[:72] + b'\r\n'
+        line = line[72:]
+        while line:
+            section += b' ' + line[:71] + b'\r\n'
+            line = line[71:]
+    return section + b'\r\n'
+
+
+def _der(tag, *contents):
+    content = b''.join(contents)
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, 'big') + content
+
+
+def _make_signature_block(key, sf):
+    """Make the PKCS#7 SignedData block of a .SF file, as jarsigner does"""
+    tbs = decoder.decode(key.certificate, asn1Spec=rfc2459.Certificate())[0]['tbsCertificate']
+    sha1 = _der(0x30, encoder.encode(univ.ObjectIdentifier(OID_SHA1)), b'\x05\x00')
+    rsa = _der(0x30, encoder.encode(univ.ObjectIdentifier(OID_RSA_ENCRYPTION)), b'\x05\x00')
+    signer_info = _der(0x30,
+                       b'\x02\x01\x01',
+                       _der(0x30, encoder.encode(tbs['issuer']), encoder.encode(tbs['serialNumber'])),
+                       sha1,
+                       rsa,
+                       _der(0x04, key.sign(sf, 'sha1')))
+    signed_data = _der(0x30,
+                       b'\x02\x01\x01',
+                       _der(0x31, sha1),
+                       _der(0x30, encoder.encode(univ.ObjectIdentifier(OID_DATA))),
+                       _der(0xa0, key.certificate),
+                       _der(0x31, signer_info))
+    return _der(0x30,
+                encoder.encode(univ.ObjectIdentifier(OID_SIGNED_DATA)),
+                _der(0xa0, signed_data))
+
+
+def sign_jar(jarfile, key, alias):
+    """Sign a JAR in place, like `jarsigner -digestalg SHA1 -sigalg SHA1withRSA`
+
+    An existing main section of the manifest is kept, any existing
+    signature is replaced.  Only SHA1 digests are written so that
+    Android < 4.3 can still verify the result.
+
+    :param key: a PrivateKey from load_private_key()
+    """
+    name = get_signature_file_name(alias)
+    signature_files = ('META-INF/MANIFEST.MF', 'META-INF/%s.SF' % name, 'META-INF/%s.RSA' % name)
+    main_section = None
+    with zipfile.ZipFile(jarfile) as jar:
+        infos = [i for i in jar.infolist() if not _is_jar_signature_file(i.filename)]
+        if 'META-INF/MANIFEST.MF' in jar.namelist():
+            main_section = _parse_manifest(jar.read('META-INF/MANIFEST.MF'))[0][1]
+        if not main_section:
+            main_section = _make_manifest_section((('Manifest-Version', '1.0'),
+                                                   ('Created-By', SIGNATURE_FILE_CREATED_BY)))
+        manifest = [main_section]
+        sf = [None]
+        for info in infos:
+            if info.filename.endswith('/'):
+                continue
+            digest = hashlib.sha1()
+            with jar.open(info) as fp:
+                for chunk in iter(lambda: fp.read(CONTENT_DIGEST_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            section = _make_manifest_section((
+                ('Name', info.filename),
+                ('SHA1-Digest', common.base64.b64encode(digest.digest()).decode()),
+            ))
+            manifest.append(section)
+            sf.append(_make_manifest_section((
+                ('Name', info.filename),
+                ('SHA1-Digest', common.base64.b64encode(hashlib.sha1(section).digest()).decode()),
+            )))
+        manifest = b''.join(manifest)
+        sf[0] = _make_manifest_section((
+            ('Signature-Version', '1.0'),
+            ('Created-By', SIGNATURE_FILE_CREATED_BY),
+            ('SHA1-Digest-Manifest', common.base64.b64encode(hashlib.sha1(manifest).digest()).decode()),
+            ('SHA1-Digest-Manifest-Main-Attributes',
+             common.base64.b64encode(hashlib.sha1(main_section).digest()).decode()),
+        ))
+        sf = b''.join(sf)
+        date_time = max([i.date_time for i in infos] or [(1980, 1, 1, 0, 0, 0)])
+
+        tmpfile = jarfile + '.tmp'
+        try:
+            with zipfile.ZipFile(tmpfile, 'w', zipfile.ZIP_DEFLATED) as out:
+                for filename, data in zip(signature_files, (manifest, sf, _make_signature_block(key, sf))):
+                    out.writestr(zipfile.ZipInfo(filename, date_time), data, zipfile.ZIP_DEFLATED)
+                for info in infos:
+                    copy = zipfile.ZipInfo(info.filename, info.date_time)
+                    copy.compress_type = info.compress_type
+                    copy.external_attr = info.external_attr
+                    with jar.open(info) as src, out.open(copy, 'w') as dst:
+                        for chunk in iter(lambda: src.read(CONTENT_DIGEST_CHUNK_SIZE), b''):
+                            dst.write(chunk)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+    os.replace(tmpfile, jarfile)
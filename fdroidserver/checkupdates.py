@@ -623,7 +623,7 @@ def main():
             sys.exit(1)
 
     # Get all apps...
-    allapps = metadata.read_metadata()
+    allapps = metadata.read_metadata(lazy=bool(options.appid))
 
     apps = common.read_app_args(options.appid, allapps, False)
 
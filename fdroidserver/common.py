@@ -42,6 +42,11 @@ import urllib.request
 import zipfile
 import tempfile
 import json
+import mmap
+import atexit
+import struct
+import bisect
+import contextlib
 
 # TODO change to only import defusedxml once its installed everywhere
 try:
@@ -77,6 +82,9 @@ VERCODE_OPERATION_RE = re.compile(r'^([ 0-9/*+-]|%c)+$')
 
 # A signature block file with a .DSA, .RSA, or .EC extension
 SIGNATURE_BLOCK_FILE_REGEX = re.compile(r'^META-INF/.*\.(DSA|EC|RSA)$')
+APK_SIGNING_BLOCK_MAGIC = b'APK Sig Block 42'
+APK_SIGNATURE_SCHEME_V2_BLOCK_ID = 0x7109871a
+APK_SIGNATURE_SCHEME_V3_BLOCK_ID = 0xf05368c0
 APK_NAME_REGEX = re.compile(r'^([a-zA-Z][\w.]*)_(-?[0-9]+)_?([0-9a-f]{7})?\.apk')
 APK_ID_TRIPLET_REGEX = re.compile(r"^package: name='(\w[^']*)' versionCode='([^']+)' versionName='([^']*)'")
 STANDARD_FILE_NAME_REGEX = re.compile(r'^(\w[\w.]*)_(-?[0-9]+)\.\w+')
@@ -121,8 +129,11 @@ default_config = {
     'accepted_formats': ['txt', 'yml'],
     'sync_from_local_copy_dir': False,
     'allow_disabled_algorithms': False,
+    'apkcache_backend': 'sqlite',
+    'signature_verifier': 'apksigner-daemon',
     'per_app_repos': False,
     'make_current_version_link': True,
+    'make_compressed_sidecars': True,
     'current_version_name_source': 'Name',
     'deploy_process_logs': False,
     'update_stats': False,
@@ -131,6 +142,7 @@ default_config = {
     'stats_user': None,
     'stats_to_carbon': False,
     'repo_maxage': 0,
+    'index_delta_count': 10,
     'build_server_always': False,
     'keystore': 'keystore.jks',
     'smartcardoptions': [],
@@ -560,9 +572,9 @@ def read_app_args(appid_versionCode_pairs, allapps, allow_vercodes=False):
         return allapps
 
     apps = {}
-    for appid, app in allapps.items():
+    for appid in allapps:
         if appid in vercodes:
-            apps[appid] = app
+            apps[appid] = allapps[appid]
 
     if len(apps) != len(vercodes):
         for p in vercodes:
@@ -2259,6 +2271,86 @@ class KnownApks:
         return lst
 
 
+class RepoPackages:
+    """The APKs and other files of a repo section, indexed by packageName
+
+    This iterates over all of the packages like the list it replaces,
+    in the order they were added, and supports the list operations
+    that `fdroid update` uses.  Looking up the packages of one app,
+    checking whether a package is in it and removing a package only
+    depend on the number of packages of that app, so going through
+    all apps is not O(apps x packages).  Packages are compared by
+    identity, since they are the dicts that get written to the index.
+    """
+
+    def __init__(self, apks=()):
+        self._apks = dict()  # all packages by id(), in the order they were added
+        self._packages = dict()  # packageName: [(-versionCode, sequence, apk)], sorted
+        self._sequence = 0
+        for apk in apks:
+            self.append(apk)
+
+    @staticmethod
+    def _sort_key(apk, sequence):
+        return (-(apk.get('versionCode') or 0), sequence)
+
+    def append(self, apk):
+        if id(apk) in self._apks:
+            raise ValueError(_('{apkfilename} was already added').format(apkfilename=apk.get('apkName')))
+        self._apks[id(apk)] = (self._sequence, apk)
+        packages = self._packages.setdefault(apk['packageName'], [])
+        # the sequence is unique, so the dicts themselves never get compared
+        bisect.insort(packages, self._sort_key(apk, self._sequence) + (apk, ))
+        self._sequence += 1
+
+    def extend(self, apks):
+        for apk in apks:
+            self.append(apk)
+
+    def remove(self, apk):
+        sequence, apk = self._apks.pop(id(apk))
+        packages = self._packages[apk['packageName']]
+        del packages[bisect.bisect_left(packages, self._sort_key(apk, sequence))]
+        if not packages:
+            del self._packages[apk['packageName']]
+
+    def __reduce__(self):
+        # the packages are indexed by id(), so only pickle the list of them
+        return (RepoPackages, (list(self), ))
+
+    def __contains__(self, apk):
+        return id(apk) in self._apks
+
+    def __iter__(self):
+        return (apk for _sequence, apk in list(self._apks.values()))
+
+    def __len__(self):
+        return len(self._apks)
+
+    def __add__(self, other):
+        combined = RepoPackages(self)
+        combined.extend(other)
+        return combined
+
+    def get(self, packageName):
+        """Get the packages of an app, sorted by versionCode, highest first
+
+        Packages with the same versionCode are in the order they were added.
+        """
+        return [apk for _versionCode, _sequence, apk in self._packages.get(packageName, [])]
+
+    def packageNames(self):
+        """All packageNames with packages, in no particular order"""
+        return self._packages.keys()
+
+
+def get_repo_packages(apks):
+    """Get apks as a RepoPackages, without copying it if it already is one"""
+    if isinstance(apks, RepoPackages):
+        return apks
+    return RepoPackages(apks)
+
+
 def get_file_extension(filename):
     """get the normalized file extension, can be blank string but never None"""
     if isinstance(filename, bytes):
@@ -2316,7 +2408,7 @@ def ensure_final_value(packageName, arsc, value):
 
 
 def is_apk_and_debuggable_aapt(apkfile):
-    p = SdkToolsPopen(['aapt', 'dump', 'xmltree', apkfile, 'AndroidManifest.xml'],
+    p = SdkToolsPopen(['aapt', 'dump', 'xmltree', get_apk_path(apkfile), 'AndroidManifest.xml'],
                       output=False)
     if p.returncode != 0:
         raise FDroidException(_("Failed to get APK manifest information"))
@@ -2329,8 +2421,8 @@ def is_apk_and_debuggable_aapt(apkfile):
 def is_apk_and_debuggable_androguard(apkfile):
     """Parse only <application android:debuggable=""> from the APK"""
     from androguard.core.bytecodes.axml import AXMLParser, format_value, START_TAG
-    with ZipFile(apkfile) as apk:
-        with apk.open('AndroidManifest.xml') as manifest:
+    with inspect_apk(apkfile) as inspection:
+        with inspection.zipfile.open('AndroidManifest.xml') as manifest:
             axml = AXMLParser(manifest.read())
             while axml.is_valid():
                 _type = next(axml)
@@ -2352,9 +2444,9 @@ def is_apk_and_debuggable_androguard(apkfile):
 def is_apk_and_debuggable(apkfile):
     """Returns True if the given file is an APK and is debuggable
 
-    :param apkfile: full path to the apk to check"""
+    :param apkfile: full path to the apk to check, or an ApkInspection of it"""
 
-    if get_file_extension(apkfile) != 'apk':
+    if get_file_extension(get_apk_path(apkfile)) != 'apk':
         return False
 
     if use_androguard():
@@ -2774,33 +2866,224 @@ def signer_fingerprint(cert_encoded):
     return hashlib.sha256(cert_encoded).hexdigest()
 
 
+class _SeekableMmap(mmap.mmap):
+    """mmap that can be used as the file object of a ZipFile"""
+
+    def seekable(self):
+        return True
+
+
+def _read_length_prefixed(data, offset):
+    """Read a uint32 length-prefixed value as used in APK Signature Scheme v2/v3
+
+    :returns: the value and the offset of whatever comes after it
+    """
+    if offset + 4 > len(data):
+        raise ValueError('truncated length prefix')
+    length, = struct.unpack_from('<I', data, offset)
+    offset += 4
+    if offset + length > len(data):
+        raise ValueError('truncated length-prefixed value')
+    return data[offset:offset + length], offset + length
+
+
+class ApkInspection:
+    """read-only view of an APK file, parsed only once for all checks
+
+    The ZIP Central Directory and the APK Signing Block are parsed
+    lazily the first time they are needed, then shared by all of the
+    functions that look at the APK, e.g. getting the signer
+    certificate, checking for known vulnerabilities, and extracting
+    icons.  The file is mmap'ed, so only the parts that are actually
+    looked at get read, which matters for large APKs on network
+    filesystems.
+
+    This should be used as a context manager, or closed when done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'rb')
+        self._zipfile = None
+        self._signing_block = None
+        try:
+            self._data = _SeekableMmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files cannot be mmap'ed
+            self._data = self._fp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._zipfile is not None:
+            self._zipfile.close()
+        if self._data is not self._fp:
+            self._data.close()
+        self._fp.close()
+
+    @property
+    def size(self):
+        return os.fstat(self._fp.fileno()).st_size
+
+    def read(self, offset, length):
+        """Read length bytes of the file starting at offset"""
+        self._data.seek(offset)
+        return self._data.read(length)
+
+    def read_header(self, length=4):
+        """Read the first bytes of the file, e.g. to check the file signature"""
+        return self.read(0, length)
+
+    def get_entry_data_offset(self, info):
+        """Get the offset in the file of the data of a ZIP entry
+
+        The local file header can have a different extra field than
+        the Central Directory, so its lengths have to be read.
+        """
+        header = self.read(info.header_offset, 30)
+        if len(header) != 30 or header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(_('Bad local file header for {name}').format(name=info.filename))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        return info.header_offset + 30 + name_length + extra_length
+
+    def search(self, pattern, start, end):
+        """Search for a compiled bytes regex in part of the file, without copying it"""
+        return pattern.search(self._data, start, end)
+
+    @property
+    def zipfile(self):
+        """The APK as a ZipFile, raises zipfile.BadZipFile if it is not one"""
+        if self._zipfile is None:
+            self._zipfile = zipfile.ZipFile(self._data)
+        return self._zipfile
+
+    @property
+    def signing_block(self):
+        """The ID-value pairs of the APK Signing Block, empty if there is none"""
+        if self._signing_block is None:
+            try:
+                self._signing_block = self._parse_signing_block()
+            except (ValueError, struct.error) as e:
+                raise FDroidException(_('{path} has a malformed APK Signing Block: {error}')
+                                      .format(path=self.path, error=e))
+        return self._signing_block
+
+    def _parse_signing_block(self):
+        """Parse the APK Signing Block which directly precedes the Central Directory
+
+        https://source.android.com/security/apksigning/v2#apk-signing-block
+        """
+        pairs = dict()
+        central_directory_offset = self.zipfile.start_dir
+        if central_directory_offset < 32:
+            return pairs
+        self._data.seek(central_directory_offset - 24)
+        size, magic = struct.unpack('<Q16s', self._data.read(24))
+        if magic != APK_SIGNING_BLOCK_MAGIC:
+            return pairs
+        start = central_directory_offset - size - 8
+        if start < 0:
+            raise ValueError('block size larger than file')
+        self._data.seek(start)
+        block = self._data.read(size - 16)
+        if struct.unpack_from('<Q', block)[0] != size:
+            raise ValueError('block sizes do not match')
+        offset = 8
+        while offset < len(block):
+            if offset + 12 > len(block):
+                raise ValueError('truncated ID-value pair')
+            length, pair_id = struct.unpack_from('<QI', block, offset)
+            if length < 4 or offset + 8 + length > len(block):
+                raise ValueError('bad ID-value pair length')
+            pairs[pair_id] = block[offset + 12:offset + 8 + length]
+            offset += 8 + length
+        return pairs
+
+    def get_signature_scheme_certificates(self, version):
+        """Get the DER-encoded certificates from an APK Signature Scheme v2/v3 block
+
+        :param version: 2 or 3, the version of the APK Signature Scheme
+        :returns: the certificates of all signers, in order
+        """
+        if version == 2:
+            block = self.signing_block.get(APK_SIGNATURE_SCHEME_V2_BLOCK_ID)
+        else:
+            block = self.signing_block.get(APK_SIGNATURE_SCHEME_V3_BLOCK_ID)
+        certs = []
+        if block is None:
+            return certs
+        try:
+            signers, _unused = _read_length_prefixed(block, 0)
+            offset = 0
+            while offset < len(signers):
+                signer, offset = _read_length_prefixed(signers, offset)
+                signed_data = _read_length_prefixed(signer, 0)[0]
+                certificates = _read_length_prefixed(signed_data,
+                                                     _read_length_prefixed(signed_data, 0)[1])[0]
+                cert_offset = 0
+                while cert_offset < len(certificates):
+                    cert, cert_offset = _read_length_prefixed(certificates, cert_offset)
+                    certs.append(cert)
+        except ValueError as e:
+            raise FDroidException(_('{path} has a malformed v{version} signature: {error}')
+                                  .format(path=self.path, version=version, error=e))
+        return certs
+
+
+@contextlib.contextmanager
+def inspect_apk(apkfile):
+    """Get an ApkInspection for either a path or an existing ApkInspection
+
+    An ApkInspection that is passed in is left open, so that the
+    caller can keep using it.
+    """
+    if isinstance(apkfile, ApkInspection):
+        yield apkfile
+    else:
+        with ApkInspection(apkfile) as inspection:
+            yield inspection
+
+
+def get_apk_path(apkfile):
+    """Get the path of an APK given as either a path or an ApkInspection"""
+    if isinstance(apkfile, ApkInspection):
+        return apkfile.path
+    return apkfile
+
+
 def get_first_signer_certificate(apkpath):
-    """Get the first signing certificate from the APK,  DER-encoded"""
-    certs = None
+    """Get the first signing certificate from the APK,  DER-encoded
+
+    :param apkpath: path to the APK, or an ApkInspection of it
+    """
     cert_encoded = None
-    with zipfile.ZipFile(apkpath, 'r') as apk:
+    with inspect_apk(apkpath) as inspection:
+        apk = inspection.zipfile
         cert_files = [n for n in apk.namelist() if SIGNATURE_BLOCK_FILE_REGEX.match(n)]
         if len(cert_files) > 1:
-            logging.error(_("Found multiple JAR Signature Block Files in {path}").format(path=apkpath))
+            logging.error(_("Found multiple JAR Signature Block Files in {path}")
+                          .format(path=inspection.path))
             return None
         elif len(cert_files) == 1:
             cert_encoded = get_certificate(apk.read(cert_files[0]))
 
-    if not cert_encoded and use_androguard():
-        apkobject = _get_androguard_APK(apkpath)
-        certs = apkobject.get_certificates_der_v2()
-        if len(certs) > 0:
-            logging.debug(_('Using APK Signature v2'))
-            cert_encoded = certs[0]
         if not cert_encoded:
-            certs = apkobject.get_certificates_der_v3()
+            certs = inspection.get_signature_scheme_certificates(2)
+            if len(certs) > 0:
+                logging.debug(_('Using APK Signature v2'))
+                cert_encoded = certs[0]
+        if not cert_encoded:
+            certs = inspection.get_signature_scheme_certificates(3)
             if len(certs) > 0:
                 logging.debug(_('Using APK Signature v3'))
                 cert_encoded = certs[0]
 
-    if not cert_encoded:
-        logging.error(_("No signing certificates found in {path}").format(path=apkpath))
-        return None
+        if not cert_encoded:
+            logging.error(_("No signing certificates found in {path}").format(path=inspection.path))
+            return None
     return cert_encoded
 
 
@@ -2810,7 +3093,7 @@ def apk_signer_fingerprint(apk_path):
     Extracts hexadecimal sha256 signing-key fingerprint string
     for a given APK.
 
-    :param apk_path: path to APK
+    :param apk_path: path to APK, or an ApkInspection of it
     :returns: signature fingerprint
     """
 
@@ -2832,6 +3115,10 @@ def apk_signer_fingerprint_short(apk_path):
     return apk_signer_fingerprint(apk_path)[:7]
 
 
+# appid: (mtimes of the signatures dirs, developer signer)
+_developer_signatures = dict()
+
+
 def metadata_get_sigdir(appid, vercode=None):
     """Get signature directory for app"""
     if vercode:
@@ -2840,15 +3127,52 @@ def metadata_get_sigdir(appid, vercode=None):
         return os.path.join('metadata', appid, 'signatures')
 
 
+def _get_sigdir_mtimes(appsigdir):
+    """The mtimes of an app's signatures dir and of its version dirs
+
+    Adding or removing a version dir changes the mtime of the
+    signatures dir, changing the files in a version dir changes the
+    mtime of that.
+
+    :returns: a tuple of (name, mtime), or None if there is no such dir
+    """
+    try:
+        mtimes = [('', os.stat(appsigdir).st_mtime_ns)]
+        with os.scandir(appsigdir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    mtimes.append((entry.name, entry.stat().st_mtime_ns))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return tuple(sorted(mtimes))
+
+
 def metadata_find_developer_signature(appid, vercode=None):
     """Tires to find the developer signature for given appid.
 
     This picks the first signature file found in metadata an returns its
-    signature.
+    signature.  Looking at all versions of an app means parsing the
+    certificate, so that result is kept for the rest of the run, until
+    the mtimes of the signatures dirs of the app change.
 
     :returns: sha256 signing key fingerprint of the developer signing key.
         None in case no signature can not be found."""
 
+    if vercode:
+        return _find_developer_signature(appid, vercode)
+    mtimes = _get_sigdir_mtimes(metadata_get_sigdir(appid))
+    if mtimes is None:
+        _developer_signatures.pop(appid, None)
+        return None
+    cached = _developer_signatures.get(appid)
+    if cached is not None and cached[0] == mtimes:
+        return cached[1]
+    signer = _find_developer_signature(appid)
+    _developer_signatures[appid] = (mtimes, signer)
+    return signer
+
+
+def _find_developer_signature(appid, vercode=None):
     # fetch list of dirs for all versions of signatures
     appversigdirs = []
     if vercode:
@@ -3089,6 +3413,14 @@ def verify_jar_signature(jar):
     """
 
     error = _('JAR signature failed to verify: {path}').format(path=jar)
+    if config.get('signature_verifier') == 'python':
+        from . import apksig
+        try:
+            apksig.verify_jar(jar)
+        except VerificationException as e:
+            raise VerificationException(error + '\n' + str(e))
+        logging.debug(_('JAR signature verified: {path}').format(path=jar))
+        return
     try:
         output = subprocess.check_output([config['jarsigner'], '-strict', '-verify', jar],
                                          stderr=subprocess.STDOUT)
@@ -3100,6 +3432,173 @@ def verify_jar_signature(jar):
             raise VerificationException(error + '\n' + e.output.decode('utf-8'))
 
 
+class ApkVerifierDaemon:
+    """A single JVM that verifies APK signatures like `apksigner verify`
+
+    Starting a JVM takes much longer than verifying a typical APK, so
+    this compiles a small Java program against the apksig library that
+    apksigner is built on, then keeps it running.  APK paths are sent to
+    it one by one, and it returns the same exit status and messages as
+    apksigner would have given.  Each process gets its own daemon, and
+    it exits when this process exits.
+    """
+
+    SOURCE = os.path.join(os.path.dirname(__file__), 'java', 'ApkVerifierDaemon.java')
+
+    def __init__(self, apksigner):
+        jar = self.find_apksig_jar(apksigner)
+        if jar is None:
+            raise FDroidException(_('Cannot find the apksig library for {path}').format(path=apksigner))
+        javabin = os.path.dirname(os.path.realpath(config['jarsigner'])) if 'jarsigner' in config else ''
+        java = os.path.join(javabin, 'java') if javabin else shutil.which('java')
+        javac = os.path.join(javabin, 'javac') if javabin else shutil.which('javac')
+        if not java or not os.path.exists(java):
+            raise FDroidException(_('Cannot find java'))
+
+        with open(self.SOURCE, 'rb') as fp:
+            h = hashlib.sha256(fp.read())
+        h.update(os.path.realpath(jar).encode())
+        classdir = os.path.join(config['cachedir'], 'ApkVerifierDaemon', h.hexdigest()[:16])
+        if not os.path.exists(os.path.join(classdir, 'ApkVerifierDaemon.class')):
+            if not javac or not os.path.exists(javac):
+                raise FDroidException(_('Cannot find javac'))
+            self.compile(javac, jar, classdir)
+
+        self.pid = os.getpid()
+        self.process = subprocess.Popen([java, '-cp', jar + os.pathsep + classdir, 'ApkVerifierDaemon'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @classmethod
+    def compile(cls, javac, jar, classdir):
+        """Compile the daemon into classdir
+
+        Worker processes of `fdroid update --jobs` might all start their
+        own daemon at the same time, so this compiles into a temporary
+        directory next to classdir, then moves it into place in one go.
+        Whoever comes second just uses the classes that are already
+        there, a daemon never gets started from half written classes.
+        """
+        parent = os.path.dirname(classdir)
+        os.makedirs(parent, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+        try:
+            p = FDroidPopen([javac, '-cp', jar, '-d', tmpdir, cls.SOURCE], output=False)
+            if p.returncode != 0:
+                raise FDroidException(_('Failed to compile {path}').format(path=cls.SOURCE), p.output)
+            try:
+                os.replace(tmpdir, classdir)
+            except OSError:
+                if os.path.exists(os.path.join(classdir, 'ApkVerifierDaemon.class')):
+                    return
+                # left over from an interrupted compile
+                shutil.rmtree(classdir, ignore_errors=True)
+                os.replace(tmpdir, classdir)
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+    @staticmethod
+    def find_apksig_jar(apksigner):
+        """Find the JAR with the apksig library that an apksigner script runs"""
+        apksigner = os.path.realpath(apksigner)
+        for jar in (os.path.join(os.path.dirname(apksigner), 'lib', 'apksigner.jar'),
+                    '/usr/share/java/apksig.jar'):
+            if os.path.isfile(jar):
+                return jar
+        return None
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise FDroidException(_('ApkVerifierDaemon exited unexpectedly'))
+        return data
+
+    @staticmethod
+    def _encode_path(apk):
+        """The path as the daemon reads it, or None if Java cannot open it
+
+        Java turns file names into strings, so a name that is not valid
+        UTF-8, like one that glob() returned with surrogate escapes,
+        is left to apksigner.
+        """
+        try:
+            return os.path.abspath(apk).encode('utf-8')
+        except UnicodeEncodeError:
+            return None
+
+    @classmethod
+    def can_verify(cls, apk):
+        return cls._encode_path(apk) is not None
+
+    def verify(self, apk, min_sdk_version=None, verbose=False):
+        """Verify an APK
+
+        The path is sent after its length, not as a line, so it can
+        contain line breaks.
+
+        :returns: (returncode, stdout, stderr) just like from `apksigner verify`
+        """
+        path = self._encode_path(apk)
+        if path is None:
+            raise FDroidException(_('Cannot send {path} to ApkVerifierDaemon').format(path=apk))
+        header = '\t'.join([str(min_sdk_version or ''), '1' if verbose else '0', str(len(path))]) + '\n'
+        try:
+            self.process.stdin.write(header.encode('ascii') + path)
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise FDroidException(_('ApkVerifierDaemon exited unexpectedly'))
+        header = self.process.stdout.readline()
+        if not header.endswith(b'\n'):
+            raise FDroidException(_('ApkVerifierDaemon exited unexpectedly'))
+        returncode, stdoutlen, stderrlen = (int(i) for i in header.split())
+        return returncode, self._read(stdoutlen), self._read(stderrlen)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+_apk_verifier_daemon = (None, None)
+
+
+def get_apk_verifier_daemon():
+    """Get the running ApkVerifierDaemon of this process, starting it if needed
+
+    :returns: the daemon, or None if it is not configured or could not
+              be started, then apksigner needs to be run for each APK
+    """
+    global _apk_verifier_daemon
+    pid, daemon = _apk_verifier_daemon
+    if pid == os.getpid():
+        return daemon
+    daemon = None
+    if config.get('signature_verifier', 'apksigner-daemon') == 'apksigner-daemon':
+        try:
+            daemon = ApkVerifierDaemon(config['apksigner'])
+            atexit.register(daemon.close)
+        except (FDroidException, OSError) as e:
+            logging.debug(_('Running apksigner for each APK: {error}').format(error=e))
+    _apk_verifier_daemon = (os.getpid(), daemon)
+    return daemon
+
+
+def stop_apk_verifier_daemon():
+    """Stop the ApkVerifierDaemon of this process, for good
+
+    After that, apksigner is run for each APK.
+    """
+    global _apk_verifier_daemon
+    pid, daemon = _apk_verifier_daemon
+    if pid == os.getpid() and daemon is not None:
+        try:
+            daemon.process.kill()
+            daemon.process.wait()
+        except OSError:
+            pass
+    _apk_verifier_daemon = (os.getpid(), None)
+
+
 def verify_apk_signature(apk, min_sdk_version=None):
     """verify the signature on an APK
 
@@ -3107,9 +3606,40 @@ def verify_apk_signature(apk, min_sdk_version=None):
     shitty: unsigned APKs pass as "verified"!  Warning, this does
     not work on JARs with apksigner >= 0.7 (build-tools 26.0.1)
 
+    Unless the signature_verifier config is set to 'apksigner', all
+    APKs are verified using a single ApkVerifierDaemon per process.
+    When it is set to 'python', the checks of apksigner are run in
+    this process instead, without needing Java at all.
+
     :returns: boolean whether the APK was verified
     """
+    if config.get('signature_verifier') == 'python':
+        from . import apksig
+        try:
+            apksig.verify_apk(apk, min_sdk_version)
+            return True
+        except VerificationException as e:
+            logging.error('\n' + apk + ': ' + str(e))
+            return False
+
     if set_command_in_config('apksigner'):
+        daemon = get_apk_verifier_daemon()
+        if daemon and daemon.can_verify(apk):
+            try:
+                returncode, output, error = daemon.verify(apk, min_sdk_version, options.verbose)
+            except FDroidException as e:
+                logging.warning(_('Running apksigner for each APK: {error}').format(error=e))
+                stop_apk_verifier_daemon()
+                return verify_apk_signature(apk, min_sdk_version)
+            sys.stderr.write(error.decode('utf-8'))
+            sys.stderr.flush()
+            if returncode == 0:
+                if options.verbose:
+                    logging.debug(apk + ': ' + output.decode('utf-8'))
+                return True
+            logging.error('\n' + apk + ': ' + output.decode('utf-8'))
+            return False
+
         args = [config['apksigner'], 'verify']
         if min_sdk_version:
             args += ['--min-sdk-version=' + min_sdk_version]
@@ -3152,10 +3682,20 @@ def verify_old_apk_signature(apk):
 
     """
 
-    _java_security = os.path.join(os.getcwd(), '.java.security')
-    if os.path.exists(_java_security):
-        os.remove(_java_security)
-    with open(_java_security, 'w') as fp:
+    if config.get('signature_verifier') == 'python':
+        from . import apksig
+        try:
+            apksig.verify_jar(apk, disabled_digests=('md2',), min_key_size=1024)
+            logging.debug(_('JAR signature verified: {path}').format(path=apk))
+            return True
+        except VerificationException as e:
+            logging.error(_('Old APK signature failed to verify: {path}').format(path=apk)
+                          + '\n' + str(e))
+            return False
+
+    # use a unique file name so that several APKs can be verified in parallel
+    fd, _java_security = tempfile.mkstemp(prefix='.java.security', dir=os.getcwd())
+    with os.fdopen(fd, 'w') as fp:
         fp.write('jdk.jar.disabledAlgorithms=MD2, RSA keySize < 1024')
     os.chmod(_java_security, 0o400)
 
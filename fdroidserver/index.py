@@ -21,7 +21,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import concurrent.futures
 import copy
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
@@ -33,14 +37,14 @@ import zipfile
 import calendar
 from binascii import hexlify, unhexlify
 from datetime import datetime, timezone
-from xml.dom.minidom import Document
 
 from . import _
+from . import apksig
 from . import common
 from . import metadata
 from . import net
 from . import signindex
-from fdroidserver.common import FDroidPopen, FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
+from fdroidserver.common import FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
 from fdroidserver.exception import FDroidException, VerificationException, MetaDataException
 
 
@@ -51,11 +55,74 @@ def make(apps, sortedids, apks, repodir, archive):
 
     :param apps: fully populated apps list
     :param sortedids: app package IDs, sorted
-    :param apks: full populated apks list
+    :param apks: full populated apks list, or a common.RepoPackages of them
     :param repodir: the repo directory
     :param archive: True if this is the archive repo, False if it's the
                     main one.
     """
+    make_sections([get_index_section(apps, sortedids, apks, repodir, archive)])
+
+
+def make_sections(sections, jobs=1):
+    """Generate the index files of several repo sections, then sign them
+
+    The sections, e.g. the repo and the archive or all of the per-app
+    repos, share no output files, and neither do index-v0 and index-v1
+    of a section, so with jobs > 1 those are all written at the same
+    time by a pool of worker processes.  All of the signing is done at
+    the end, in this process, so the key is only loaded once and a
+    smartcard is never used by several jarsigners at once.
+
+    :param sections: what get_index_section() returns for each section
+    :param jobs: number of worker processes to use
+    """
+    tasks = []
+    for apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints in sections:
+        tasks.append((make_v0, (apps, apks, repodir, repodict, requestsdict,
+                                fdroid_signing_key_fingerprints)))
+        tasks.append((make_v1, (apps, list(apks), repodir, repodict, requestsdict,
+                                fdroid_signing_key_fingerprints)))
+    if jobs > 1 and len(tasks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                                    initargs=(common.config, common.options)) as pool:
+            list(pool.map(_make_index_job, *zip(*tasks)))
+    else:
+        for func, args in tasks:
+            _make_index_job(func, args)
+
+    if common.options.nosign:
+        return
+    signindex.config = common.config
+    for section in sections:
+        repodir = section[2]
+        if 'repo_keyalias' in common.config:
+            signindex.sign_jar(os.path.join(repodir, 'index.jar'))
+        sign_index_v1_and_entry(repodir)
+
+
+def _init_worker(common_config, common_options):
+    """Set up the global state in a worker process of a process pool"""
+    common.config = common_config
+    common.options = common_options
+
+
+def _make_index_job(func, args):
+    """Run make_v0() or make_v1() without signing, in a worker"""
+    func(*args, sign=False)
+
+
+def get_index_section(apps, sortedids, apks, repodir, archive):
+    """Gather everything that goes into the index of one repo section
+
+    This takes the same arguments as make().  The apps in the index also
+    get the anti-features of their newest APK, and packages without a
+    versionName get the one from the build metadata, which also changes
+    the apps and APKs that were passed in, like generating the index
+    always did.  Only the packages of the apps in the index are kept.
+
+    :returns: (apps, apks, repodir, repodict, requestsdict,
+              fdroid_signing_key_fingerprints) for make_sections()
+    """
     from fdroidserver.update import METADATA_VERSION
 
     def _resolve_description_link(appid):
@@ -66,6 +133,8 @@ def make(apps, sortedids, apks, repodir, archive):
     if not common.options.nosign:
         common.assert_config_keystore(common.config)
 
+    apks = common.get_repo_packages(apks)
+
     repodict = collections.OrderedDict()
     repodict['timestamp'] = datetime.utcnow().replace(tzinfo=timezone.utc)
     repodict['version'] = METADATA_VERSION
@@ -113,13 +182,11 @@ def make(apps, sortedids, apks, repodir, archive):
             continue
 
         # only include apps with packages
-        for apk in apks:
-            if apk['packageName'] == packageName:
-                newapp = copy.copy(app)  # update wiki needs unmodified description
-                newapp['Description'] = metadata.description_html(app['Description'],
-                                                                  _resolve_description_link)
-                appsWithPackages[packageName] = newapp
-                break
+        if packageName in apks.packageNames():
+            newapp = copy.copy(app)  # update wiki needs unmodified description
+            newapp['Description'] = metadata.description_html(app['Description'],
+                                                              _resolve_description_link)
+            appsWithPackages[packageName] = newapp
 
     requestsdict = collections.OrderedDict()
     for command in ('install', 'uninstall'):
@@ -136,120 +203,350 @@ def make(apps, sortedids, apks, repodir, archive):
 
     fdroid_signing_key_fingerprints = load_stats_fdroid_signing_key_fingerprints()
 
-    make_v0(appsWithPackages, apks, repodir, repodict, requestsdict,
-            fdroid_signing_key_fingerprints)
-    make_v1(appsWithPackages, apks, repodir, repodict, requestsdict,
+    for appid, app in appsWithPackages.items():
+        apklist = _get_v0_apklist(apks, appid, fdroid_signing_key_fingerprints)
+        if app.Disabled is None and apklist and 'antiFeatures' in apklist[0]:
+            app.AntiFeatures.extend(apklist[0]['antiFeatures'])
+        for package in apks.get(appid):
+            if not package.get('versionName'):
+                versionCodeStr = str(package['versionCode'])  # TODO build.versionCode should be int!
+                for build in app['builds']:
+                    if build['versionCode'] == versionCodeStr:
+                        versionName = build.get('versionName')
+                        logging.info(_('Overriding blank versionName in {apkfilename} from metadata: {version}')
+                                     .format(apkfilename=package['apkName'], version=versionName))
+                        package['versionName'] = versionName
+                        break
+
+    # only the packages of these apps go into the index, the others
+    # would just be sent to the workers of make_sections() for nothing
+    apks = common.RepoPackages(package for appid in appsWithPackages for package in apks.get(appid))
+
+    return (appsWithPackages, apks, repodir, repodict, requestsdict,
             fdroid_signing_key_fingerprints)
 
 
-def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
+def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints,
+            sign=True):
+    """Write index-v1.json, then sign it into index-v1.jar
 
-    def _index_encoder_default(obj):
-        if isinstance(obj, set):
-            return sorted(list(obj))
-        if isinstance(obj, datetime):
-            # Java prefers milliseconds
-            # we also need to accound for time zone/daylight saving time
-            return int(calendar.timegm(obj.timetuple()) * 1000)
-        if isinstance(obj, dict):
-            d = collections.OrderedDict()
-            for key in sorted(obj.keys()):
-                d[key] = obj[key]
-            return d
-        raise TypeError(repr(obj) + " is not JSON serializable")
+    The entry of each app and package is generated and written on its
+    own, so the whole index is never held in memory as one document.
 
-    output = collections.OrderedDict()
-    output['repo'] = repodict
-    output['requests'] = requestsdict
+    :param sign: False to leave the signing to the caller
+    """
 
     # establish sort order of the index
     v1_sort_packages(packages, fdroid_signing_key_fingerprints)
 
-    appslist = []
-    output['apps'] = appslist
-    for packageName, appdict in apps.items():
-        d = collections.OrderedDict()
-        appslist.append(d)
-        for k, v in sorted(appdict.items()):
-            if not v:
-                continue
-            if k in ('builds', 'comments', 'metadatapath',
-                     'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
-                     'Provides', 'Repo', 'RepoType', 'RequiresRoot',
-                     'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
-                     'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'):
+    json_name = 'index-v1.json'
+    index_file = os.path.join(repodir, json_name)
+    with open(index_file, 'w') as fp:
+        writer = _JsonStreamWriter(fp, indent=2 if common.options.pretty else None,
+                                   default=_index_encoder_default)
+        writer.begin('{')
+        writer.write(repodict, key='repo')
+        writer.write(requestsdict, key='requests')
+        writer.begin('[', key='apps')
+        for packageName, appdict in apps.items():
+            writer.write(_get_v1_app(apps, packageName, appdict))
+        writer.end()
+        writer.begin('{', key='packages')
+        currentPackageName = None
+        for package in packages:
+            d = _get_v1_package(apps, package)
+            if d is None:
                 continue
+            if package['packageName'] != currentPackageName:
+                # packages are sorted by packageName, so each one is in a single run
+                if currentPackageName is not None:
+                    writer.end()
+                currentPackageName = package['packageName']
+                writer.begin('[', key=currentPackageName)
+            writer.write(d)
+        if currentPackageName is not None:
+            writer.end()
+        writer.end()
+        writer.end()
+
+    if common.config.get('index_delta_count', 0) > 0:
+        make_index_deltas(repodir, index_file, common.config['index_delta_count'])
 
-            # name things after the App class fields in fdroidclient
-            if k == 'id':
-                k = 'packageName'
-            elif k == 'CurrentVersionCode':  # TODO make SuggestedVersionCode the canonical name
-                k = 'suggestedVersionCode'
-            elif k == 'CurrentVersion':  # TODO make SuggestedVersionName the canonical name
-                k = 'suggestedVersionName'
-            elif k == 'AutoName':
-                if 'Name' not in apps[packageName]:
-                    d['name'] = v
-                continue
+    if common.options.nosign:
+        logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
+    elif sign:
+        signindex.config = common.config
+        sign_index_v1_and_entry(repodir)
+
+
+def _get_index_history_dir(repodir):
+    """Previous indexes are kept in the top level tmp/, which is never published
+
+    Per-app repos are in <appid>/fdroid/repo, and all of <appid>/ gets
+    deployed, so the history is keyed by the whole path of the repo.
+    """
+    return os.path.join('tmp', 'index-history', os.path.normpath(repodir).lstrip(os.sep))
+
+
+def _list_index_history(historydir):
+    """The timestamps of the indexes in the history, oldest first"""
+    return sorted(int(f[:-len('.json.gz')]) for f in os.listdir(historydir)
+                  if re.match(r'^[0-9]+\.json\.gz$', f))
+
+
+def _get_keyed_index_v1(index):
+    """index-v1 with the apps keyed by packageName, like the packages already are"""
+    keyed = collections.OrderedDict(index)
+    keyed['apps'] = collections.OrderedDict((app['packageName'], app) for app in index.get('apps', []))
+    return keyed
+
+
+def _make_merge_patch(old, new):
+    """Make the RFC 7386 JSON Merge Patch which turns old into new
+
+    index-v1 never contains null values, so those can mark removals.
+    """
+    patch = collections.OrderedDict()
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif value != old[key]:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                patch[key] = _make_merge_patch(old[key], value)
             else:
-                k = k[:1].lower() + k[1:]
-            d[k] = v
+                patch[key] = value
+    return patch
 
-    # establish sort order in localized dicts
-    for app in output['apps']:
-        localized = app.get('localized')
-        if localized:
-            lordered = collections.OrderedDict()
-            for lkey, lvalue in sorted(localized.items()):
-                lordered[lkey] = collections.OrderedDict()
-                for ikey, iname in sorted(lvalue.items()):
-                    lordered[lkey][ikey] = iname
-            app['localized'] = lordered
-
-    output_packages = collections.OrderedDict()
-    output['packages'] = output_packages
-    for package in packages:
-        packageName = package['packageName']
-        if packageName not in apps:
-            logging.info(_('Ignoring package without metadata: ') + package['apkName'])
-            continue
-        if not package.get('versionName'):
-            app = apps[packageName]
-            versionCodeStr = str(package['versionCode'])  # TODO build.versionCode should be int!
-            for build in app['builds']:
-                if build['versionCode'] == versionCodeStr:
-                    versionName = build.get('versionName')
-                    logging.info(_('Overriding blank versionName in {apkfilename} from metadata: {version}')
-                                 .format(apkfilename=package['apkName'], version=versionName))
-                    package['versionName'] = versionName
-                    break
-        if packageName in output_packages:
-            packagelist = output_packages[packageName]
+
+def make_index_deltas(repodir, index_file, count):
+    """Write diffs from the last count indexes to this one
+
+    Each diff/<timestamp>.json is a JSON Merge Patch (RFC 7386) from the
+    index-v1 with that timestamp to the current one, with the "apps"
+    list turned into an object keyed by packageName.  The lists of
+    packages of an app are replaced as a whole, which keeps their
+    order.  So a client which has one of those indexes only needs to
+    download the matching diff instead of the whole index.  They are
+    listed in entry.json by make_index_entry() once index-v1.jar is
+    signed.
+
+    :param index_file: the index-v1.json which was just written
+    :param count: the number of previous indexes to make diffs from
+    """
+    with open(index_file, 'rb') as fp:
+        data = fp.read()
+    index = json.loads(data.decode('utf-8'))
+    timestamp = index['repo']['timestamp']
+    current = _get_keyed_index_v1(index)
+
+    historydir = _get_index_history_dir(repodir)
+    os.makedirs(historydir, exist_ok=True)
+    history = [t for t in _list_index_history(historydir) if t < timestamp][-count:]
+
+    diffdir = os.path.join(repodir, 'diff')
+    os.makedirs(diffdir, exist_ok=True)
+    indent = 2 if common.options.pretty else None
+    diffs = set()
+    for old_timestamp in history:
+        with gzip.open(os.path.join(historydir, '%d.json.gz' % old_timestamp), 'rt', encoding='utf-8') as fp:
+            old = _get_keyed_index_v1(json.load(fp))
+        patch = json.dumps(_make_merge_patch(old, current), indent=indent, ensure_ascii=False)
+        patch = patch.encode('utf-8')
+        name = 'diff/%d.json' % old_timestamp
+        with open(os.path.join(repodir, name), 'wb') as fp:
+            fp.write(patch)
+        diffs.add(str(old_timestamp))
+    for f in os.listdir(diffdir):
+        if f.endswith('.json') and f[:-len('.json')] not in diffs:
+            os.remove(os.path.join(diffdir, f))
+
+    # the history is written last, so a failed run does not skip a diff
+    with gzip.open(os.path.join(historydir, '%d.json.gz' % timestamp), 'wb') as fp:
+        fp.write(data)
+    for old_timestamp in _list_index_history(historydir)[:-(count + 1)]:
+        os.remove(os.path.join(historydir, '%d.json.gz' % old_timestamp))
+
+
+def make_index_entry(repodir, pretty=False):
+    """Write entry.json, the entry point to the index and its diffs
+
+    It lists the SHA-256 and size of the signed index-v1.jar and of each
+    diff that make_index_deltas() wrote.  It gets signed into entry.jar
+    just like index-v1.jar, so the diffs themselves do not need a
+    signature.  This has to run after index-v1.jar was signed, by
+    `fdroid update` or by `fdroid signindex`.
+    """
+    jar_file = os.path.join(repodir, 'index-v1.jar')
+    with open(jar_file, 'rb') as fp:
+        data = fp.read()
+    with zipfile.ZipFile(io.BytesIO(data)) as jar:
+        index = json.loads(jar.read('index-v1.json').decode('utf-8'))
+
+    diffs = collections.OrderedDict()
+    diffdir = os.path.join(repodir, 'diff')
+    if os.path.isdir(diffdir):
+        timestamps = [f[:-len('.json')] for f in os.listdir(diffdir) if re.match(r'^[0-9]+\.json$', f)]
+        for old_timestamp in sorted(timestamps, key=int):
+            name = 'diff/%s.json' % old_timestamp
+            with open(os.path.join(repodir, name), 'rb') as fp:
+                patch = fp.read()
+            diffs[old_timestamp] = collections.OrderedDict([
+                ('name', name),
+                ('sha256', hashlib.sha256(patch).hexdigest()),
+                ('size', len(patch)),
+            ])
+
+    entry = collections.OrderedDict([
+        ('timestamp', index['repo']['timestamp']),
+        ('version', index['repo'].get('version')),
+        ('index', collections.OrderedDict([
+            ('name', 'index-v1.jar'),
+            ('sha256', hashlib.sha256(data).hexdigest()),
+            ('size', len(data)),
+            ('numPackages', sum(len(p) for p in index.get('packages', {}).values())),
+        ])),
+        ('diffs', diffs),
+    ])
+    with open(os.path.join(repodir, 'entry.json'), 'w', encoding='utf-8') as fp:
+        json.dump(entry, fp, indent=2 if pretty else None)
+
+
+def sign_index_v1_and_entry(repodir):
+    """Sign index-v1.json, then write and sign entry.json if diffs are made"""
+    signindex.sign_index_v1(repodir, 'index-v1.json')
+    if common.config.get('index_delta_count', 0) > 0:
+        make_index_entry(repodir, common.options.pretty)
+        signindex.sign_index_v1(repodir, 'entry.json')
+
+
+class _JsonStreamWriter:
+    """Write a JSON document piece by piece, formatted just like json.dump()
+
+    Containers are opened with begin() and closed with end(), and the
+    values inside them are written with write(), so that only one of
+    those values has to be in memory at a time.  Inside of an object,
+    each item needs a key.
+
+    """
+
+    def __init__(self, fp, indent=None, default=None):
+        self.fp = fp
+        self.indent = indent
+        self.encoder = json.JSONEncoder(indent=indent, default=default)
+        if indent is None:
+            self.item_separator = ', '
         else:
-            packagelist = []
-            output_packages[packageName] = packagelist
+            self.item_separator = ','
+        self._containers = []  # [closing bracket, has items] of each open container
+
+    def _newline(self):
+        if self.indent is None:
+            return ''
+        return '\n' + ' ' * (self.indent * len(self._containers))
+
+    def _start_item(self, key):
+        if not self._containers:
+            return
+        container = self._containers[-1]
+        if container[1]:
+            self.fp.write(self.item_separator)
+        container[1] = True
+        self.fp.write(self._newline())
+        if key is not None:
+            self.fp.write(self.encoder.encode(key) + ': ')
+
+    def begin(self, bracket, key=None):
+        self._start_item(key)
+        self.fp.write(bracket)
+        self._containers.append(['}' if bracket == '{' else ']', False])
+
+    def end(self):
+        bracket, hasitems = self._containers.pop()
+        if hasitems:
+            self.fp.write(self._newline())
+        self.fp.write(bracket)
+
+    def write(self, value, key=None):
+        self._start_item(key)
+        s = self.encoder.encode(value)
+        if self.indent is not None:
+            # newlines in JSON strings are always escaped, so these are all indentation
+            s = s.replace('\n', self._newline())
+        self.fp.write(s)
+
+
+def _index_encoder_default(obj):
+    if isinstance(obj, set):
+        return sorted(list(obj))
+    if isinstance(obj, datetime):
+        # Java prefers milliseconds
+        # we also need to accound for time zone/daylight saving time
+        return int(calendar.timegm(obj.timetuple()) * 1000)
+    if isinstance(obj, dict):
         d = collections.OrderedDict()
-        packagelist.append(d)
-        for k, v in sorted(package.items()):
-            if not v:
-                continue
-            if k in ('icon', 'icons', 'icons_src', 'name', ):
-                continue
-            d[k] = v
+        for key in sorted(obj.keys()):
+            d[key] = obj[key]
+        return d
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
-    json_name = 'index-v1.json'
-    index_file = os.path.join(repodir, json_name)
-    with open(index_file, 'w') as fp:
-        if common.options.pretty:
-            json.dump(output, fp, default=_index_encoder_default, indent=2)
+
+def _get_v1_app(apps, packageName, appdict):
+    """Get the entry of an app in index-v1, with its keys in index order"""
+    d = collections.OrderedDict()
+    for k, v in sorted(appdict.items()):
+        if not v:
+            continue
+        if k in ('builds', 'comments', 'metadatapath',
+                 'ArchivePolicy', 'AutoUpdateMode', 'MaintainerNotes',
+                 'Provides', 'Repo', 'RepoType', 'RequiresRoot',
+                 'UpdateCheckData', 'UpdateCheckIgnore', 'UpdateCheckMode',
+                 'UpdateCheckName', 'NoSourceSince', 'VercodeOperation'):
+            continue
+
+        # name things after the App class fields in fdroidclient
+        if k == 'id':
+            k = 'packageName'
+        elif k == 'CurrentVersionCode':  # TODO make SuggestedVersionCode the canonical name
+            k = 'suggestedVersionCode'
+        elif k == 'CurrentVersion':  # TODO make SuggestedVersionName the canonical name
+            k = 'suggestedVersionName'
+        elif k == 'AutoName':
+            if 'Name' not in apps[packageName]:
+                d['name'] = v
+            continue
         else:
-            json.dump(output, fp, default=_index_encoder_default)
+            k = k[:1].lower() + k[1:]
+        d[k] = v
 
-    if common.options.nosign:
-        logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
-    else:
-        signindex.config = common.config
-        signindex.sign_index_v1(repodir, json_name)
+    # establish sort order in localized dicts
+    localized = d.get('localized')
+    if localized:
+        lordered = collections.OrderedDict()
+        for lkey, lvalue in sorted(localized.items()):
+            lordered[lkey] = collections.OrderedDict()
+            for ikey, iname in sorted(lvalue.items()):
+                lordered[lkey][ikey] = iname
+        d['localized'] = lordered
+    return d
+
+
+def _get_v1_package(apps, package):
+    """Get the entry of a package in index-v1, or None if it has no metadata"""
+    packageName = package['packageName']
+    if packageName not in apps:
+        logging.info(_('Ignoring package without metadata: ') + package['apkName'])
+        return None
+    d = collections.OrderedDict()
+    for k, v in sorted(package.items()):
+        if not v:
+            continue
+        if k in ('icon', 'icons', 'icons_src', 'name', 'native_library_scans', 'stat_fingerprint', ):
+            continue
+        d[k] = v
+    return d
 
 
 def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
@@ -265,12 +562,19 @@ def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
     GROUP_FDROID_SIGNED = 2
     GROUP_OTHER_SIGNED = 3
 
+    # look up each app once, not once per package
+    dev_sigs = dict()
+    for package in packages:
+        packageName = package.get('packageName', None)
+        if packageName not in dev_sigs:
+            dev_sigs[packageName] = common.metadata_find_developer_signature(packageName)
+
     def v1_sort_keys(package):
         packageName = package.get('packageName', None)
 
         sig = package.get('signer', None)
 
-        dev_sig = common.metadata_find_developer_signature(packageName)
+        dev_sig = dev_sigs[packageName]
         group = GROUP_OTHER_SIGNED
         if dev_sig and dev_sig == sig:
             group = GROUP_DEV_SIGNED
@@ -288,35 +592,128 @@ def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
     packages.sort(key=v1_sort_keys)
 
 
-def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints):
+class _XmlStreamWriter:
+    """Write an XML document element by element, formatted just like minidom
+
+    This produces the same bytes as building the document with
+    xml.dom.minidom and then calling toxml() or toprettyxml() with
+    encoding='utf-8', without keeping the whole tree in memory.
+    Elements that contain other elements are opened with start() and
+    closed with end(), elements which only contain text are written
+    with element().  The attributes are written in the given order.
+
     """
-    aka index.jar aka index.xml
+
+    def __init__(self, fp, pretty=False):
+        self.fp = fp
+        if pretty:
+            self.indent = '\t'
+            self.newl = '\n'
+        else:
+            self.indent = ''
+            self.newl = ''
+        self._elements = []  # [tag name, has children] of each open element
+        fp.write('<?xml version="1.0" encoding="utf-8"?>' + self.newl)
+
+    @staticmethod
+    def escape(data):
+        return data.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('"', '&quot;').replace('>', '&gt;')
+
+    def _write_start_tag(self, name, attrs):
+        if self._elements and not self._elements[-1][1]:
+            self._elements[-1][1] = True
+            self.fp.write('>' + self.newl)
+        self.fp.write(self.indent * len(self._elements) + '<' + name)
+        for key, value in attrs:
+            self.fp.write(' ' + key + '="' + self.escape(value) + '"')
+
+    def start(self, name, attrs=()):
+        self._write_start_tag(name, attrs)
+        self._elements.append([name, False])
+
+    def end(self):
+        name, haschildren = self._elements.pop()
+        if haschildren:
+            self.fp.write(self.indent * len(self._elements) + '</' + name + '>' + self.newl)
+        else:
+            self.fp.write('/>' + self.newl)
+
+    def element(self, name, value, attrs=(), cdata=False):
+        if not isinstance(value, str):
+            raise TypeError('node contents must be a string')
+        self._write_start_tag(name, attrs)
+        if cdata:
+            if ']]>' in value:
+                raise ValueError("']]>' not allowed in a CDATA section")
+            value = '<![CDATA[' + value + ']]>'
+        else:
+            value = self.escape(value)
+        self.fp.write('>' + value + '</' + name + '>' + self.newl)
+
+
+def _get_v0_apklist(apks, appid, fdroid_signing_key_fingerprints):
+    """Choose the one APK for each versionCode of an app that goes into index-v0
+
+    :returns: the APKs, newest first
     """
+    apklist = []
+    apksbyversion = collections.defaultdict(lambda: [])
+    for apk in apks.get(appid):
+        if apk.get('versionCode'):
+            apksbyversion[apk['versionCode']].append(apk)
+    for versionCode, apksforver in apksbyversion.items():
+        fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
+        fdroid_signed_apk = None
+        name_match_apk = None
+        for x in apksforver:
+            if fdroidsig and x.get('signer', None) == fdroidsig:
+                fdroid_signed_apk = x
+            if common.apk_release_filename.match(x.get('apkName', '')):
+                name_match_apk = x
+        # choose which of the available versions is most
+        # suiteable for index v0
+        if fdroid_signed_apk:
+            apklist.append(fdroid_signed_apk)
+        elif name_match_apk:
+            apklist.append(name_match_apk)
+        else:
+            apklist.append(apksforver[0])
 
-    doc = Document()
+    # Sort the apk list into version order, just so the web site
+    # doesn't have to do any work by default...
+    return sorted(apklist, key=lambda apk: apk['versionCode'], reverse=True)
 
-    def addElement(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
 
-    def addElementNonEmpty(name, value, doc, parent):
+def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fingerprints,
+            sign=True):
+    """
+    aka index.jar aka index.xml
+
+    The XML is written out one element at a time while going through
+    the apps, it is only renamed to index.xml once it is complete.
+
+    :param apks: the APKs, as a list or common.RepoPackages
+    :param sign: False to leave the signing to the caller
+    """
+
+    apks = common.get_repo_packages(apks)
+
+    def addElementNonEmpty(name, value):
         if not value:
             return
-        addElement(name, value, doc, parent)
+        xml.element(name, value)
 
-    def addElementIfInApk(name, apk, key, doc, parent):
+    def addElementIfInApk(name, apk, key):
         if key not in apk:
             return
         value = str(apk[key])
-        addElement(name, value, doc, parent)
+        xml.element(name, value)
 
-    def addElementCDATA(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createCDATASection(value))
-        parent.appendChild(el)
+    def addElementCDATA(name, value):
+        xml.element(name, value, cdata=True)
 
-    def addElementCheckLocalized(name, app, key, doc, parent, default=''):
+    def addElementCheckLocalized(name, app, key, default=''):
         """Fill in field from metadata or localized block
 
         For name/summary/description, they can come only from the app source,
@@ -329,7 +726,6 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         """
 
-        el = doc.createElement(name)
         value = app.get(key)
         lkey = key[:1].lower() + key[1:]
         localized = app.get('localized')
@@ -346,245 +742,207 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
             value = localized[lang].get(lkey)
         if not value:
             value = default
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
-
-    root = doc.createElement("fdroid")
-    doc.appendChild(root)
-
-    repoel = doc.createElement("repo")
-    repoel.setAttribute("icon", os.path.basename(repodict['icon']))
-    if 'maxage' in repodict:
-        repoel.setAttribute("maxage", str(repodict['maxage']))
-    repoel.setAttribute("name", repodict['name'])
-    pubkey, repo_pubkey_fingerprint = extract_pubkey()
-    repoel.setAttribute("pubkey", pubkey.decode('utf-8'))
-    repoel.setAttribute("timestamp", '%d' % repodict['timestamp'].timestamp())
-    repoel.setAttribute("url", repodict['address'])
-    repoel.setAttribute("version", str(repodict['version']))
-
-    addElement('description', repodict['description'], doc, repoel)
-    for mirror in repodict.get('mirrors', []):
-        addElement('mirror', mirror, doc, repoel)
-
-    root.appendChild(repoel)
-
-    for command in ('install', 'uninstall'):
-        for packageName in requestsdict[command]:
-            element = doc.createElement(command)
-            root.appendChild(element)
-            element.setAttribute('packageName', packageName)
-
-    for appid, appdict in apps.items():
-        app = metadata.App(appdict)
-
-        if app.Disabled is not None:
-            continue
-
-        # Get a list of the apks for this app...
-        apklist = []
-        apksbyversion = collections.defaultdict(lambda: [])
-        for apk in apks:
-            if apk.get('versionCode') and apk.get('packageName') == appid:
-                apksbyversion[apk['versionCode']].append(apk)
-        for versionCode, apksforver in apksbyversion.items():
-            fdroidsig = fdroid_signing_key_fingerprints.get(appid, {}).get('signer')
-            fdroid_signed_apk = None
-            name_match_apk = None
-            for x in apksforver:
-                if fdroidsig and x.get('signer', None) == fdroidsig:
-                    fdroid_signed_apk = x
-                if common.apk_release_filename.match(x.get('apkName', '')):
-                    name_match_apk = x
-            # choose which of the available versions is most
-            # suiteable for index v0
-            if fdroid_signed_apk:
-                apklist.append(fdroid_signed_apk)
-            elif name_match_apk:
-                apklist.append(name_match_apk)
-            else:
-                apklist.append(apksforver[0])
-
-        if len(apklist) == 0:
-            continue
+        xml.element(name, value)
+
+    index_file = os.path.join(repodir, 'index.xml')
+    tmp_index_file = index_file + '.new'
+    # errors='xmlcharrefreplace' like minidom, for lone surrogates from broken metadata
+    fp = open(tmp_index_file, 'w', encoding='utf-8', errors='xmlcharrefreplace', newline='\n')
+    try:
+        xml = _XmlStreamWriter(fp, common.options.pretty)
+        xml.start('fdroid')
+
+        repoattrs = [('icon', os.path.basename(repodict['icon']))]
+        if 'maxage' in repodict:
+            repoattrs.append(('maxage', str(repodict['maxage'])))
+        repoattrs.append(('name', repodict['name']))
+        pubkey, repo_pubkey_fingerprint = extract_pubkey()
+        repoattrs.append(('pubkey', pubkey.decode('utf-8')))
+        repoattrs.append(('timestamp', '%d' % repodict['timestamp'].timestamp()))
+        repoattrs.append(('url', repodict['address']))
+        repoattrs.append(('version', str(repodict['version'])))
+        xml.start('repo', repoattrs)
+        xml.element('description', repodict['description'])
+        for mirror in repodict.get('mirrors', []):
+            xml.element('mirror', mirror)
+        xml.end()
+
+        for command in ('install', 'uninstall'):
+            for packageName in requestsdict[command]:
+                xml.start(command, [('packageName', packageName)])
+                xml.end()
+
+        for appid, appdict in apps.items():
+            app = metadata.App(appdict)
+
+            if app.Disabled is not None:
+                continue
 
-        apel = doc.createElement("application")
-        apel.setAttribute("id", app.id)
-        root.appendChild(apel)
-
-        addElement('id', app.id, doc, apel)
-        if app.added:
-            addElement('added', app.added.strftime('%Y-%m-%d'), doc, apel)
-        if app.lastUpdated:
-            addElement('lastupdated', app.lastUpdated.strftime('%Y-%m-%d'), doc, apel)
-
-        addElementCheckLocalized('name', app, 'Name', doc, apel)
-        addElementCheckLocalized('summary', app, 'Summary', doc, apel)
-
-        if app.icon:
-            addElement('icon', app.icon, doc, apel)
-
-        addElementCheckLocalized('desc', app, 'Description', doc, apel,
-                                 '<p>No description available</p>')
-
-        addElement('license', app.License, doc, apel)
-        if app.Categories:
-            addElement('categories', ','.join(app.Categories), doc, apel)
-            # We put the first (primary) category in LAST, which will have
-            # the desired effect of making clients that only understand one
-            # category see that one.
-            addElement('category', app.Categories[0], doc, apel)
-        addElement('web', app.WebSite, doc, apel)
-        addElement('source', app.SourceCode, doc, apel)
-        addElement('tracker', app.IssueTracker, doc, apel)
-        addElementNonEmpty('changelog', app.Changelog, doc, apel)
-        addElementNonEmpty('author', app.AuthorName, doc, apel)
-        addElementNonEmpty('email', app.AuthorEmail, doc, apel)
-        addElementNonEmpty('donate', app.Donate, doc, apel)
-        addElementNonEmpty('bitcoin', app.Bitcoin, doc, apel)
-        addElementNonEmpty('litecoin', app.Litecoin, doc, apel)
-        addElementNonEmpty('flattr', app.FlattrID, doc, apel)
-        addElementNonEmpty('liberapay', app.LiberapayID, doc, apel)
-        addElementNonEmpty('openCollective', app.OpenCollective, doc, apel)
-
-        # These elements actually refer to the current version (i.e. which
-        # one is recommended. They are historically mis-named, and need
-        # changing, but stay like this for now to support existing clients.
-        addElement('marketversion', app.CurrentVersion, doc, apel)
-        addElement('marketvercode', app.CurrentVersionCode, doc, apel)
-
-        if app.Provides:
-            pv = app.Provides.split(',')
-            addElementNonEmpty('provides', ','.join(pv), doc, apel)
-        if app.RequiresRoot:
-            addElement('requirements', 'root', doc, apel)
-
-        # Sort the apk list into version order, just so the web site
-        # doesn't have to do any work by default...
-        apklist = sorted(apklist, key=lambda apk: apk['versionCode'], reverse=True)
-
-        if 'antiFeatures' in apklist[0]:
-            app.AntiFeatures.extend(apklist[0]['antiFeatures'])
-        if app.AntiFeatures:
-            addElementNonEmpty('antifeatures', ','.join(app.AntiFeatures), doc, apel)
-
-        # Check for duplicates - they will make the client unhappy...
-        for i in range(len(apklist) - 1):
-            first = apklist[i]
-            second = apklist[i + 1]
-            if first['versionCode'] == second['versionCode'] \
-               and first['sig'] == second['sig']:
-                if first['hash'] == second['hash']:
-                    raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
-                        repodir, first['apkName'], second['apkName']))
-                else:
-                    raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
-                        repodir, first['apkName'], second['apkName']))
-
-        current_version_code = 0
-        current_version_file = None
-        for apk in apklist:
-            file_extension = common.get_file_extension(apk['apkName'])
-            # find the APK for the "Current Version"
-            if current_version_code < apk['versionCode']:
-                current_version_code = apk['versionCode']
-            if current_version_code < int(app.CurrentVersionCode):
-                current_version_file = apk['apkName']
-
-            apkel = doc.createElement("package")
-            apel.appendChild(apkel)
-
-            versionName = apk.get('versionName')
-            if not versionName:
-                versionCodeStr = str(apk['versionCode'])  # TODO build.versionCode should be int!
-                for build in app.builds:
-                    if build['versionCode'] == versionCodeStr and 'versionName' in build:
-                        versionName = build['versionName']
-                        break
-            if versionName:
-                addElement('version', versionName, doc, apkel)
-
-            addElement('versioncode', str(apk['versionCode']), doc, apkel)
-            addElement('apkname', apk['apkName'], doc, apkel)
-            addElementIfInApk('srcname', apk, 'srcname', doc, apkel)
-
-            hashel = doc.createElement("hash")
-            hashel.setAttribute('type', 'sha256')
-            hashel.appendChild(doc.createTextNode(apk['hash']))
-            apkel.appendChild(hashel)
-
-            addElement('size', str(apk['size']), doc, apkel)
-            addElementIfInApk('sdkver', apk,
-                              'minSdkVersion', doc, apkel)
-            addElementIfInApk('targetSdkVersion', apk,
-                              'targetSdkVersion', doc, apkel)
-            addElementIfInApk('maxsdkver', apk,
-                              'maxSdkVersion', doc, apkel)
-            addElementIfInApk('obbMainFile', apk,
-                              'obbMainFile', doc, apkel)
-            addElementIfInApk('obbMainFileSha256', apk,
-                              'obbMainFileSha256', doc, apkel)
-            addElementIfInApk('obbPatchFile', apk,
-                              'obbPatchFile', doc, apkel)
-            addElementIfInApk('obbPatchFileSha256', apk,
-                              'obbPatchFileSha256', doc, apkel)
-            if 'added' in apk:
-                addElement('added', apk['added'].strftime('%Y-%m-%d'), doc, apkel)
-
-            if file_extension == 'apk':  # sig is required for APKs, but only APKs
-                addElement('sig', apk['sig'], doc, apkel)
-
-                old_permissions = set()
-                sorted_permissions = sorted(apk['uses-permission'])
-                for perm in sorted_permissions:
-                    perm_name = perm[0]
-                    if perm_name.startswith("android.permission."):
-                        perm_name = perm_name[19:]
-                    old_permissions.add(perm_name)
-                addElementNonEmpty('permissions', ','.join(sorted(old_permissions)), doc, apkel)
-
-                for permission in sorted_permissions:
-                    permel = doc.createElement('uses-permission')
-                    if permission[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission[0])
-                for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
-                    permel = doc.createElement('uses-permission-sdk-23')
-                    if permission_sdk_23[1] is not None:
-                        permel.setAttribute('maxSdkVersion', '%d' % permission_sdk_23[1])
-                        apkel.appendChild(permel)
-                    permel.setAttribute('name', permission_sdk_23[0])
-                if 'nativecode' in apk:
-                    addElement('nativecode', ','.join(sorted(apk['nativecode'])), doc, apkel)
-                addElementNonEmpty('features', ','.join(sorted(apk['features'])), doc, apkel)
-
-        if current_version_file is not None \
-                and common.config['make_current_version_link'] \
-                and repodir == 'repo':  # only create these
-            namefield = common.config['current_version_name_source']
-            sanitized_name = re.sub(b'''[ '"&%?+=/]''', b'', app.get(namefield).encode('utf-8'))
-            apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
-            current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
-            if os.path.islink(apklinkname):
-                os.remove(apklinkname)
-            os.symlink(current_version_path, apklinkname)
-            # also symlink gpg signature, if it exists
-            for extension in (b'.asc', b'.sig'):
-                sigfile_path = current_version_path + extension
-                if os.path.exists(sigfile_path):
-                    siglinkname = apklinkname + extension
-                    if os.path.islink(siglinkname):
-                        os.remove(siglinkname)
-                    os.symlink(sigfile_path, siglinkname)
-
-    if common.options.pretty:
-        output = doc.toprettyxml(encoding='utf-8')
-    else:
-        output = doc.toxml(encoding='utf-8')
+            # Get a list of the apks for this app...
+            apklist = _get_v0_apklist(apks, appid, fdroid_signing_key_fingerprints)
+            if len(apklist) == 0:
+                continue
 
-    with open(os.path.join(repodir, 'index.xml'), 'wb') as f:
-        f.write(output)
+            # Check for duplicates - they will make the client unhappy...
+            for i in range(len(apklist) - 1):
+                first = apklist[i]
+                second = apklist[i + 1]
+                if first['versionCode'] == second['versionCode'] \
+                   and first['sig'] == second['sig']:
+                    if first['hash'] == second['hash']:
+                        raise FDroidException('"{0}/{1}" and "{0}/{2}" are exact duplicates!'.format(
+                            repodir, first['apkName'], second['apkName']))
+                    else:
+                        raise FDroidException('duplicates: "{0}/{1}" - "{0}/{2}"'.format(
+                            repodir, first['apkName'], second['apkName']))
+
+            xml.start('application', [('id', app.id)])
+
+            xml.element('id', app.id)
+            if app.added:
+                xml.element('added', app.added.strftime('%Y-%m-%d'))
+            if app.lastUpdated:
+                xml.element('lastupdated', app.lastUpdated.strftime('%Y-%m-%d'))
+
+            addElementCheckLocalized('name', app, 'Name')
+            addElementCheckLocalized('summary', app, 'Summary')
+
+            if app.icon:
+                xml.element('icon', app.icon)
+
+            addElementCheckLocalized('desc', app, 'Description',
+                                     '<p>No description available</p>')
+
+            xml.element('license', app.License)
+            if app.Categories:
+                xml.element('categories', ','.join(app.Categories))
+                # We put the first (primary) category in LAST, which will have
+                # the desired effect of making clients that only understand one
+                # category see that one.
+                xml.element('category', app.Categories[0])
+            xml.element('web', app.WebSite)
+            xml.element('source', app.SourceCode)
+            xml.element('tracker', app.IssueTracker)
+            addElementNonEmpty('changelog', app.Changelog)
+            addElementNonEmpty('author', app.AuthorName)
+            addElementNonEmpty('email', app.AuthorEmail)
+            addElementNonEmpty('donate', app.Donate)
+            addElementNonEmpty('bitcoin', app.Bitcoin)
+            addElementNonEmpty('litecoin', app.Litecoin)
+            addElementNonEmpty('flattr', app.FlattrID)
+            addElementNonEmpty('liberapay', app.LiberapayID)
+            addElementNonEmpty('openCollective', app.OpenCollective)
+
+            # These elements actually refer to the current version (i.e. which
+            # one is recommended. They are historically mis-named, and need
+            # changing, but stay like this for now to support existing clients.
+            xml.element('marketversion', app.CurrentVersion)
+            xml.element('marketvercode', app.CurrentVersionCode)
+
+            if app.Provides:
+                pv = app.Provides.split(',')
+                addElementNonEmpty('provides', ','.join(pv))
+            if app.RequiresRoot:
+                xml.element('requirements', 'root')
+
+            if app.AntiFeatures:
+                addElementNonEmpty('antifeatures', ','.join(app.AntiFeatures))
+
+            current_version_code = 0
+            current_version_file = None
+            for apk in apklist:
+                file_extension = common.get_file_extension(apk['apkName'])
+                # find the APK for the "Current Version"
+                if current_version_code < apk['versionCode']:
+                    current_version_code = apk['versionCode']
+                if current_version_code < int(app.CurrentVersionCode):
+                    current_version_file = apk['apkName']
+
+                xml.start('package')
+
+                versionName = apk.get('versionName')
+                if not versionName:
+                    versionCodeStr = str(apk['versionCode'])  # TODO build.versionCode should be int!
+                    for build in app.builds:
+                        if build['versionCode'] == versionCodeStr and 'versionName' in build:
+                            versionName = build['versionName']
+                            break
+                if versionName:
+                    xml.element('version', versionName)
+
+                xml.element('versioncode', str(apk['versionCode']))
+                xml.element('apkname', apk['apkName'])
+                addElementIfInApk('srcname', apk, 'srcname')
+                xml.element('hash', apk['hash'], [('type', 'sha256')])
+                xml.element('size', str(apk['size']))
+                addElementIfInApk('sdkver', apk, 'minSdkVersion')
+                addElementIfInApk('targetSdkVersion', apk, 'targetSdkVersion')
+                addElementIfInApk('maxsdkver', apk, 'maxSdkVersion')
+                addElementIfInApk('obbMainFile', apk, 'obbMainFile')
+                addElementIfInApk('obbMainFileSha256', apk, 'obbMainFileSha256')
+                addElementIfInApk('obbPatchFile', apk, 'obbPatchFile')
+                addElementIfInApk('obbPatchFileSha256', apk, 'obbPatchFileSha256')
+                if 'added' in apk:
+                    xml.element('added', apk['added'].strftime('%Y-%m-%d'))
+
+                if file_extension == 'apk':  # sig is required for APKs, but only APKs
+                    xml.element('sig', apk['sig'])
+
+                    old_permissions = set()
+                    sorted_permissions = sorted(apk['uses-permission'])
+                    for perm in sorted_permissions:
+                        perm_name = perm[0]
+                        if perm_name.startswith("android.permission."):
+                            perm_name = perm_name[19:]
+                        old_permissions.add(perm_name)
+                    addElementNonEmpty('permissions', ','.join(sorted(old_permissions)))
+
+                    # only the permissions with a maxSdkVersion get their own element in v0
+                    for permission in sorted_permissions:
+                        if permission[1] is not None:
+                            xml.start('uses-permission', [('maxSdkVersion', '%d' % permission[1]),
+                                                          ('name', permission[0])])
+                            xml.end()
+                    for permission_sdk_23 in sorted(apk['uses-permission-sdk-23']):
+                        if permission_sdk_23[1] is not None:
+                            xml.start('uses-permission-sdk-23', [('maxSdkVersion', '%d' % permission_sdk_23[1]),
+                                                                 ('name', permission_sdk_23[0])])
+                            xml.end()
+                    if 'nativecode' in apk:
+                        xml.element('nativecode', ','.join(sorted(apk['nativecode'])))
+                    addElementNonEmpty('features', ','.join(sorted(apk['features'])))
+
+                xml.end()
+
+            xml.end()
+
+            if current_version_file is not None \
+                    and common.config['make_current_version_link'] \
+                    and repodir == 'repo':  # only create these
+                namefield = common.config['current_version_name_source']
+                sanitized_name = re.sub(b'''[ '"&%?+=/]''', b'', app.get(namefield).encode('utf-8'))
+                apklinkname = sanitized_name + os.path.splitext(current_version_file)[1].encode('utf-8')
+                current_version_path = os.path.join(repodir, current_version_file).encode('utf-8', 'surrogateescape')
+                if os.path.islink(apklinkname):
+                    os.remove(apklinkname)
+                os.symlink(current_version_path, apklinkname)
+                # also symlink gpg signature, if it exists
+                for extension in (b'.asc', b'.sig'):
+                    sigfile_path = current_version_path + extension
+                    if os.path.exists(sigfile_path):
+                        siglinkname = apklinkname + extension
+                        if os.path.islink(siglinkname):
+                            os.remove(siglinkname)
+                        os.symlink(sigfile_path, siglinkname)
+
+        xml.end()
+    except BaseException:
+        # do not leave a partial index behind, e.g. after finding duplicates
+        fp.close()
+        os.remove(tmp_index_file)
+        raise
+    fp.close()
+    os.replace(tmp_index_file, index_file)
 
     if 'repo_keyalias' in common.config:
 
@@ -596,9 +954,8 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         # Create a jar of the index...
         jar_output = 'index_unsigned.jar' if common.options.nosign else 'index.jar'
-        p = FDroidPopen(['jar', 'cf', jar_output, 'index.xml'], cwd=repodir)
-        if p.returncode != 0:
-            raise FDroidException("Failed to create {0}".format(jar_output))
+        with zipfile.ZipFile(os.path.join(repodir, jar_output), 'w', zipfile.ZIP_DEFLATED) as jar:
+            jar.write(index_file, 'index.xml')
 
         # Sign the index...
         signed = os.path.join(repodir, 'index.jar')
@@ -606,7 +963,7 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
             # Remove old signed index if not signing
             if os.path.exists(signed):
                 os.remove(signed)
-        else:
+        elif sign:
             signindex.config = common.config
             signindex.sign_jar(signed)
 
@@ -621,8 +978,11 @@ def extract_pubkey():
     Extracts and returns the repository's public key from the keystore.
     :return: public key in hex, repository fingerprint
     """
+    signindex.config = common.config
     if 'repo_pubkey' in common.config:
         pubkey = unhexlify(common.config['repo_pubkey'])
+    elif signindex.get_signing_key() is not None:
+        pubkey = signindex.get_signing_key().certificate
     else:
         env_vars = {'LC_ALL': 'C.UTF-8',
                     'FDROID_KEY_STORE_PASS': common.config['keystorepass']}
@@ -703,6 +1063,39 @@ def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600
         - The index in JSON format or None if the index did not change
         - The new eTag as returned by the HTTP request
 
+    """
+    items, new_etag = download_repo_index_iter(url_str, etag, verify_fingerprint, timeout)
+    if items is None:
+        return None, new_etag
+
+    index = dict()
+    for key, value in items:
+        if key == 'apps':
+            index.setdefault(key, []).append(value)
+        elif key == 'packages':
+            index.setdefault(key, dict())[value[0]] = value[1]
+        else:
+            index[key] = value
+    index.setdefault('apps', [])
+    index.setdefault('packages', dict())
+    return index, new_etag
+
+
+def download_repo_index_iter(url_str, etag=None, verify_fingerprint=True, timeout=600):
+    """Downloads and verifies index file, then parses it incrementally.
+
+    This works like download_repo_index(), but instead of the whole
+    index, it returns an iterator over its parts, as described in
+    iter_index_v1(), so only one app or one app's packages is parsed
+    at a time.  The index-v1.jar is streamed to a temporary file,
+    which is removed once the iterator is done.
+
+    :raises: VerificationException() if the repository could not be verified
+
+    :return: A tuple consisting of:
+        - The iterator, or None if the index did not change
+        - The new eTag as returned by the HTTP request
+
     """
     url = urllib.parse.urlsplit(url_str)
 
@@ -714,19 +1107,50 @@ def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600
         fingerprint = query['fingerprint'][0]
 
     url = urllib.parse.SplitResult(url.scheme, url.netloc, url.path + '/index-v1.jar', '', '')
-    download, new_etag = net.http_get(url.geturl(), etag, timeout)
-
-    if download is None:
-        return None, new_etag
-
-    with tempfile.NamedTemporaryFile() as fp:
-        fp.write(download)
-        fp.flush()
-        index, public_key, public_key_fingerprint = get_index_from_jar(fp.name, fingerprint)
-        index["repo"]["pubkey"] = hexlify(public_key).decode()
-        index["repo"]["fingerprint"] = public_key_fingerprint
-        index["apps"] = [metadata.App(app) for app in index["apps"]]
-        return index, new_etag
+    fp = tempfile.NamedTemporaryFile(suffix='.jar')
+    try:
+        sha256, new_etag = net.http_get_to_file(url.geturl(), fp, etag, timeout)
+        if sha256 is None:
+            fp.close()
+            return None, new_etag
+        logging.debug(_('Downloaded {url}, SHA-256 {sha256}').format(url=url.geturl(), sha256=sha256))
+        public_key, public_key_fingerprint = _verify_index_jar(fp.name, fingerprint)
+    except BaseException:
+        fp.close()
+        raise
+    return _iter_downloaded_index(fp, public_key, public_key_fingerprint), new_etag
+
+
+def _iter_downloaded_index(fp, public_key, public_key_fingerprint):
+    with fp, zipfile.ZipFile(fp.name) as jar:
+        with io.TextIOWrapper(jar.open('index-v1.json'), encoding='utf-8') as jsonfp:
+            for key, value in iter_index_v1(jsonfp):
+                if key == 'repo':
+                    value["pubkey"] = hexlify(public_key).decode()
+                    value["fingerprint"] = public_key_fingerprint
+                elif key == 'apps':
+                    value = metadata.App(value)
+                yield key, value
+
+
+def _verify_index_jar(jarfile, fingerprint=None):
+    """Verify the JAR signature in-process, and the signer's fingerprint
+
+    :returns: the public key and its fingerprint
+    :raises: VerificationException() if the repository could not be verified
+    """
+    logging.debug(_('Verifying index signature:'))
+    try:
+        apksig.verify_jar(jarfile)
+    except VerificationException as e:
+        raise VerificationException(_('JAR signature failed to verify: {path}').format(path=jarfile)
+                                    + '\n' + str(e))
+    with zipfile.ZipFile(jarfile) as jar:
+        public_key, public_key_fingerprint = get_public_key_from_jar(jar)
+    if fingerprint is not None:
+        if fingerprint.upper() != public_key_fingerprint:
+            raise VerificationException(_("The repository's fingerprint does not match."))
+    return public_key, public_key_fingerprint
 
 
 def get_index_from_jar(jarfile, fingerprint=None):
@@ -735,17 +1159,118 @@ def get_index_from_jar(jarfile, fingerprint=None):
     :raises: VerificationException() if the repository could not be verified
     """
 
-    logging.debug(_('Verifying index signature:'))
-    common.verify_jar_signature(jarfile)
+    public_key, public_key_fingerprint = _verify_index_jar(jarfile, fingerprint)
     with zipfile.ZipFile(jarfile) as jar:
-        public_key, public_key_fingerprint = get_public_key_from_jar(jar)
-        if fingerprint is not None:
-            if fingerprint.upper() != public_key_fingerprint:
-                raise VerificationException(_("The repository's fingerprint does not match."))
         data = json.loads(jar.read('index-v1.json').decode())
         return data, public_key, public_key_fingerprint
 
 
+class _JsonStreamReader:
+    """Read the values of a JSON document one at a time from a text file"""
+
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, fp, chunk_size=65536):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self, size):
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        data = self.fp.read(max(size, self.chunk_size))
+        if not data:
+            self.eof = True
+        self.buf += data
+        return bool(data)
+
+    def peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            self.pos = self._whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read_more(self.chunk_size):
+                raise ValueError(_('Unexpected end of JSON'))
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(_('Expected one of {chars} in JSON, found {char}')
+                             .format(chars=chars, char=c))
+        self.pos += 1
+        return c
+
+    def decode(self):
+        """Parse the next complete value, reading more until there is one"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+                # a number could go on in the part that is not read yet
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # grow geometrically, so big values are not parsed over and over
+            self._read_more(len(self.buf) - self.pos)
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(',]') == ']':
+                return
+
+    def iter_keys(self):
+        """Yield the keys of an object, the caller has to read each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            if not isinstance(key, str):
+                raise ValueError(_('Expected a string as key in JSON'))
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+
+def iter_index_v1(fp):
+    """Parse an index-v1.json incrementally
+
+    Each app and each app's list of packages is parsed when it is
+    reached, so the whole index never has to be in memory at once.
+
+    :param fp: text file object of the index-v1.json
+    :returns: iterator of (key, value) tuples in the order of the file:
+              ('apps', app) for each entry of the "apps" list,
+              ('packages', (packageName, packages)) for each entry of
+              the "packages" dict, and (key, value) for the others,
+              like "repo" and "requests"
+    """
+    stream = _JsonStreamReader(fp)
+    for key in stream.iter_keys():
+        if key == 'apps' and stream.peek() == '[':
+            for app in stream.iter_array():
+                yield key, app
+        elif key == 'packages' and stream.peek() == '{':
+            for packageName in stream.iter_keys():
+                yield key, (packageName, stream.decode())
+        else:
+            yield key, stream.decode()
+
+
 def get_public_key_from_jar(jar):
     """
     Get the public key and its fingerprint from a JAR file.
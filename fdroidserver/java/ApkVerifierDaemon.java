@@ -0,0 +1,177 @@
+/*
+ * ApkVerifierDaemon.java - verify many APK signatures in a single JVM
+ * Copyright (C) 2019, The F-Droid Project
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU Affero General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+import com.android.apksig.ApkVerifier;
+
+import java.io.BufferedInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.util.List;
+
+/**
+ * Runs the same checks as {@code apksigner verify}, using the apksig
+ * library that apksigner is built on, but for any number of APKs
+ * without starting a new JVM for each one.
+ *
+ * Each request is a header line on stdin, made of tab-separated fields:
+ * the minimum SDK version to check (or empty), "1" for verbose output
+ * or "0", and the length in bytes of the path to the APK, followed by
+ * that path in UTF-8.  Since the path is not read as a line, it can
+ * contain any character.  Each response is a header line on
+ * stdout with the exit status apksigner would have returned and the
+ * lengths in bytes of its stdout and stderr, followed by the contents
+ * of stdout and stderr.  This exits when stdin is closed.
+ */
+public class ApkVerifierDaemon {
+
+    public static void main(String[] args) throws Exception {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        OutputStream out = System.out;
+        String line;
+        while ((line = readHeader(in)) != null) {
+            String[] request = line.split("\t", 3);
+            byte[] path = new byte[Integer.parseInt(request[2])];
+            in.readFully(path);
+            ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+            ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+            int status;
+            try (PrintStream o = new PrintStream(stdout, true, "UTF-8");
+                 PrintStream e = new PrintStream(stderr, true, "UTF-8")) {
+                try {
+                    status = verify(new String(path, StandardCharsets.UTF_8), request[0],
+                                    "1".equals(request[1]), o, e);
+                } catch (Exception ex) {
+                    e.println(ex.toString());
+                    status = 1;
+                }
+            }
+            byte[] o = stdout.toByteArray();
+            byte[] e = stderr.toByteArray();
+            out.write((status + " " + o.length + " " + e.length + "\n")
+                    .getBytes(StandardCharsets.UTF_8));
+            out.write(o);
+            out.write(e);
+            out.flush();
+        }
+    }
+
+    /**
+     * Read a header line, which only ends at "\n", unlike {@code readLine()}.
+     *
+     * @return the line, or null if stdin was closed
+     */
+    private static String readHeader(InputStream in) throws IOException {
+        ByteArrayOutputStream line = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != '\n') {
+            if (c == -1) {
+                return null;
+            }
+            line.write(c);
+        }
+        return new String(line.toByteArray(), StandardCharsets.US_ASCII);
+    }
+
+    /**
+     * Verify one APK, writing the same messages as {@code apksigner verify}.
+     *
+     * @return the exit status that apksigner would have returned
+     */
+    private static int verify(String path, String minSdkVersion, boolean verbose,
+                              PrintStream out, PrintStream err) throws Exception {
+        ApkVerifier.Builder builder = new ApkVerifier.Builder(new File(path));
+        if (!minSdkVersion.isEmpty()) {
+            builder.setMinCheckedPlatformVersion(Integer.parseInt(minSdkVersion));
+        }
+        ApkVerifier.Result result = builder.build().verify();
+        boolean verified = result.isVerified();
+        if (verified) {
+            if (verbose) {
+                out.println("Verifies");
+                out.println("Verified using v1 scheme (JAR signing): "
+                        + result.isVerifiedUsingV1Scheme());
+                out.println("Verified using v2 scheme (APK Signature Scheme v2): "
+                        + result.isVerifiedUsingV2Scheme());
+                Object v3 = call(result, "isVerifiedUsingV3Scheme");
+                if (v3 != null) {
+                    out.println("Verified using v3 scheme (APK Signature Scheme v3): " + v3);
+                }
+                out.println("Number of signers: " + result.getSignerCertificates().size());
+            }
+        } else {
+            err.println("DOES NOT VERIFY");
+        }
+
+        for (ApkVerifier.IssueWithParams error : result.getErrors()) {
+            err.println("ERROR: " + error);
+        }
+        for (ApkVerifier.IssueWithParams warning : result.getWarnings()) {
+            out.println("WARNING: " + warning);
+        }
+        for (ApkVerifier.Result.V1SchemeSignerInfo signer : result.getV1SchemeSigners()) {
+            String name = signer.getName();
+            for (ApkVerifier.IssueWithParams error : signer.getErrors()) {
+                err.println("ERROR: JAR signer " + name + ": " + error);
+            }
+            for (ApkVerifier.IssueWithParams warning : signer.getWarnings()) {
+                out.println("WARNING: JAR signer " + name + ": " + warning);
+            }
+        }
+        printSchemeIssues(result, "getV2SchemeSigners", "APK Signature Scheme v2", out, err);
+        printSchemeIssues(result, "getV3SchemeSigners", "APK Signature Scheme v3", out, err);
+        return verified ? 0 : 1;
+    }
+
+    /** Print the issues of v2/v3 signers, if this version of apksig has them. */
+    private static void printSchemeIssues(ApkVerifier.Result result, String getter,
+                                          String scheme, PrintStream out, PrintStream err)
+            throws Exception {
+        Object signers = call(result, getter);
+        if (signers == null) {
+            return;
+        }
+        for (Object signer : (List<?>) signers) {
+            String name = "signer #" + ((Integer) call(signer, "getIndex") + 1);
+            for (Object error : (List<?>) call(signer, "getErrors")) {
+                err.println("ERROR: " + scheme + " " + name + ": " + error);
+            }
+            for (Object warning : (List<?>) call(signer, "getWarnings")) {
+                out.println("WARNING: " + scheme + " " + name + ": " + warning);
+            }
+        }
+    }
+
+    /** Call a public no-argument method, or return null if it does not exist. */
+    private static Object call(Object object, String name) throws Exception {
+        Method method;
+        try {
+            method = object.getClass().getMethod(name);
+        } catch (NoSuchMethodException e) {
+            return null;
+        }
+        method.setAccessible(true);
+        return method.invoke(object);
+    }
+}
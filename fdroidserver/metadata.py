@@ -18,12 +18,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import copy
+import itertools
 import json
 import os
 import re
 import glob
 import html
 import logging
+import operator
 import textwrap
 import io
 import yaml
@@ -33,6 +37,7 @@ except ImportError:
     from yaml import SafeLoader
 import importlib
 from collections import OrderedDict
+from collections.abc import MutableMapping
 
 import fdroidserver.common
 from fdroidserver import _
@@ -40,10 +45,18 @@ from fdroidserver.exception import MetaDataException, FDroidException
 
 srclibs = None
 warnings_action = None
+warnings_count = 0  # how often warn_or_exception() was called, whatever -W says
+
+METADATA_CACHE_FILE = os.path.join('tmp', 'metadatacache.json')
+METADATA_CACHE_VERSION = 1
+PARSE_JOB_MIN_FILES = 16  # files per worker process, to make up for starting it
+DESCRIPTION_CACHE_FILE = os.path.join('tmp', 'descriptioncache.json')
 
 
 def warn_or_exception(value, cause=None):
     '''output warning or Exception depending on -W'''
+    global warnings_count
+    warnings_count += 1
     if warnings_action == 'ignore':
         pass
     elif warnings_action == 'error':
@@ -154,8 +167,20 @@ yaml_app_field_order = [
 yaml_app_fields = [x for x in yaml_app_field_order if x != '\n']
 
 
+class _MissingField(KeyError, AttributeError):
+    """A field that is not set, for both app[name] and app.name"""
+
+
+def _field(name):
+    """Read a field straight from the dict, not via __getattr__()"""
+    return property(operator.itemgetter(name))
+
+
 class App(dict):
 
+    # no __dict__, everything is stored as items
+    __slots__ = ()
+
     def __init__(self, copydict=None):
         if copydict:
             super().__init__(copydict)
@@ -208,6 +233,9 @@ class App(dict):
         self.added = None
         self.lastUpdated = None
 
+    def __missing__(self, name):
+        raise _MissingField(name)
+
     def __getattr__(self, name):
         if name in self:
             return self[name]
@@ -230,6 +258,121 @@ class App(dict):
             return Build()
 
 
+class AppOverlay(App):
+    """A copy-on-write view of an App
+
+    Only the fields that are set on the overlay are stored in it, all
+    others are read from the underlying App, so making one is cheap
+    compared to copy.deepcopy().  Lists, dicts and sets are copied into
+    the overlay the first time they are read, so changing them in place
+    does not change the underlying App either.  When pickled, e.g. to
+    send it to a worker process, it becomes a plain App.
+    """
+
+    __slots__ = ('_app', '_deleted')
+
+    def __init__(self, app):
+        dict.__init__(self)
+        object.__setattr__(self, '_app', app)
+        object.__setattr__(self, '_deleted', set())
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if key in self._deleted:
+            return self.__missing__(key)
+        value = self._app[key]
+        if isinstance(value, (list, dict, set)):
+            value = copy.copy(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) \
+            or (key not in self._deleted and key in self._app)
+
+    def __iter__(self):
+        for key in self._app:
+            if key not in self._deleted:
+                yield key
+        for key in dict.__iter__(self):
+            if key not in self._app:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ignored in self)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __copy__(self):
+        overlay = AppOverlay(self._app)
+        dict.update(overlay, dict(dict.items(self)))
+        overlay._deleted.update(self._deleted)
+        return overlay
+
+    def __reduce__(self):
+        return (App, (dict(self.items()), ))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self._get_value(key)) for key in self]
+
+    def values(self):
+        return [self._get_value(key) for key in self]
+
+    def copy(self):
+        return self.__copy__()
+
+    def _get_value(self, key):
+        """Read a value without copying it into the overlay"""
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self._app[key]
+
+
 TYPE_UNKNOWN = 0
 TYPE_OBSOLETE = 1
 TYPE_STRING = 2
@@ -301,6 +444,9 @@ build_flags = ['versionName', 'versionCode'] + build_flags_order
 
 class Build(dict):
 
+    # no __dict__, everything is stored as items
+    __slots__ = ()
+
     def __init__(self, copydict=None):
         super().__init__()
         self.disable = ''
@@ -339,6 +485,9 @@ class Build(dict):
             super().__init__(copydict)
             return
 
+    def __missing__(self, name):
+        raise _MissingField(name)
+
     def __getattr__(self, name):
         if name in self:
             return self[name]
@@ -381,6 +530,15 @@ class Build(dict):
         return paths[version]
 
 
+# The known fields are properties, so reading them is a lookup in the
+# class and then in the dict, while __getattr__() is only called after
+# the lookup in the instance failed.
+for _name in list(App()):
+    setattr(App, _name, _field(_name))
+for _name in build_flags:
+    setattr(Build, _name, _field(_name))
+
+
 flagtypes = {
     'versionCode': TYPE_INT,
     'extlibs': TYPE_LIST,
@@ -680,14 +838,79 @@ class DescriptionFormatter:
         self.html.close()
 
 
-# Parse multiple lines of description as written in a metadata file, returning
-# a single string in text format and wrapped to 80 columns.
-def description_txt(s):
-    ps = DescriptionFormatter(None)
+# Rendered descriptions, keyed by output format and source text.  Each
+# entry also lists the [[appid]] links with what they resolved to when it
+# was rendered, so it is only reused when the link resolver still gives
+# the same results.
+_descriptions = dict()
+_descriptions_used = set()
+
+
+def _render_description(s, fmt, linkres):
+    key = (fmt, s)
+    resolved = OrderedDict()
+
+    def memo_linkres(linkid):
+        if linkid not in resolved:
+            resolved[linkid] = linkres(linkid) if linkres else (linkid, linkid)
+        return resolved[linkid]
+
+    warnings_before = warnings_count
+    entry = _descriptions.get(key)
+    if entry is not None \
+       and all(tuple(memo_linkres(link[0]) or ()) == tuple(link[1:]) for link in entry[1]):
+        _descriptions_used.add(key)
+        return entry[0]
+
+    ps = DescriptionFormatter(memo_linkres)
     for line in s.splitlines():
         ps.parseline(line)
     ps.end()
-    return ps.text_txt
+    text = ps.text_html if fmt == 'html' else ps.text_txt
+    if warnings_count == warnings_before:
+        _descriptions[key] = (text, [[linkid] + list(result) for linkid, result in resolved.items()])
+        _descriptions_used.add(key)
+    return text
+
+
+def read_description_cache():
+    """Add the descriptions rendered by earlier runs to the in-process cache"""
+    if not os.path.exists(DESCRIPTION_CACHE_FILE):
+        return
+    try:
+        with open(DESCRIPTION_CACHE_FILE) as fp:
+            cache = json.load(fp)
+        if cache.get('version') != _get_metadata_cache_version():
+            return
+        for fmt, s, text, links in cache['descriptions']:
+            _descriptions.setdefault((fmt, s), (text, links))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.debug(_('Ignoring broken {path}: {error}')
+                      .format(path=DESCRIPTION_CACHE_FILE, error=e))
+
+
+def write_description_cache():
+    """Atomically replace the cache with the descriptions used in this run"""
+    if not _descriptions_used or not os.path.isdir(os.path.dirname(DESCRIPTION_CACHE_FILE)):
+        return
+    descriptions = []
+    for key in sorted(_descriptions_used):
+        if key in _descriptions:
+            descriptions.append(list(key) + list(_descriptions[key]))
+    cache = OrderedDict([
+        ('version', _get_metadata_cache_version()),
+        ('descriptions', descriptions),
+    ])
+    tmpfile = DESCRIPTION_CACHE_FILE + '.new'
+    with open(tmpfile, 'w') as fp:
+        json.dump(cache, fp, separators=(',', ':'))
+    os.replace(tmpfile, DESCRIPTION_CACHE_FILE)
+
+
+# Parse multiple lines of description as written in a metadata file, returning
+# a single string in text format and wrapped to 80 columns.
+def description_txt(s):
+    return _render_description(s, 'txt', None)
 
 
 # Parse multiple lines of description as written in a metadata file, returning
@@ -700,11 +923,7 @@ def description_wiki(s):
 # Parse multiple lines of description as written in a metadata file, returning
 # a single string in HTML format.
 def description_html(s, linkres):
-    ps = DescriptionFormatter(linkres)
-    for line in s.splitlines():
-        ps.parseline(line)
-    ps.end()
-    return ps.text_html
+    return _render_description(s, 'html', linkres)
 
 
 def parse_txt_srclib(metadatapath):
@@ -792,15 +1011,104 @@ def parse_yml_srclib(metadatapath):
     return thisinfo
 
 
+class SrclibRegistry(dict):
+    """The srclib metadata, each parsed the first time it is looked up
+
+    The srclib names come from the names of the files in the srclibs
+    directory, so checking whether a srclib exists does not parse
+    anything.  Only the commands that build or check out source code
+    look srclibs up, so most never parse a single one.  Everything
+    that reads the whole registry, like items() or comparing it, parses
+    all of them first, so it can still be used like a plain dict.
+    """
+
+    def __init__(self, srcdir='srclibs'):
+        super().__init__()
+        self._srcdir = srcdir
+        self._paths = dict()
+        # .yml wins over .txt, like when they were all read up front
+        for ext in ('txt', 'yml'):
+            for metadatapath in sorted(glob.glob(os.path.join(srcdir, '*.' + ext))):
+                self._paths[os.path.basename(metadatapath[:-4])] = metadatapath
+
+    def __missing__(self, name):
+        if name not in self._paths:
+            raise KeyError(name)
+        metadatapath = self._paths[name]
+        if metadatapath.endswith('.txt'):
+            srclib = parse_txt_srclib(metadatapath)
+        else:
+            srclib = parse_yml_srclib(metadatapath)
+        dict.__setitem__(self, name, srclib)
+        return srclib
+
+    def _load_all(self):
+        if dict.__len__(self) == len(self._paths):
+            return
+        srclibs = [(name, self[name]) for name in self._paths]
+        dict.clear(self)
+        dict.update(self, srclibs)
+
+    def __setitem__(self, name, srclib):
+        self._paths.setdefault(name, None)
+        dict.__setitem__(self, name, srclib)
+
+    def __delitem__(self, name):
+        del self._paths[name]
+        dict.pop(self, name, None)
+
+    def __contains__(self, name):
+        return name in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __eq__(self, other):
+        self._load_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self._load_all()
+        return dict.__ne__(self, other)
+
+    def __repr__(self):
+        self._load_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        return (type(self), (self._srcdir, ))
+
+    def get(self, name, default=None):
+        if name in self._paths:
+            return self[name]
+        return default
+
+    def keys(self):
+        return self._paths.keys()
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+
 def read_srclibs():
-    """Read all srclib metadata.
+    """Find all srclib metadata.
 
     The information read will be accessible as metadata.srclibs, which is a
     dictionary, keyed on srclib name, with the values each being a dictionary
     in the same format as that returned by the parse_txt_srclib function.
+    It is a SrclibRegistry, so each srclib is only parsed when it is
+    looked up.
 
     A MetaDataException is raised if there are any problems with the srclib
-    metadata.
+    metadata, when that srclib is looked up.
     """
     global srclibs
 
@@ -808,22 +1116,277 @@ def read_srclibs():
     if srclibs is not None:
         return
 
-    srclibs = {}
-
     srcdir = 'srclibs'
     if not os.path.exists(srcdir):
         os.makedirs(srcdir)
 
-    for metadatapath in sorted(glob.glob(os.path.join(srcdir, '*.txt'))):
-        srclibname = os.path.basename(metadatapath[:-4])
-        srclibs[srclibname] = parse_txt_srclib(metadatapath)
+    srclibs = SrclibRegistry(srcdir)
+
+
+class _WarningCounter(logging.Handler):
+    """Count the warnings logged while parsing a metadata file"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
 
-    for metadatapath in sorted(glob.glob(os.path.join(srcdir, '*.yml'))):
-        srclibname = os.path.basename(metadatapath[:-4])
-        srclibs[srclibname] = parse_yml_srclib(metadatapath)
+    def emit(self, record):
+        self.count += 1
 
 
-def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
+def _get_metadata_cache_version():
+    """Get the values which invalidate the whole metadata cache when changed
+
+    Besides the cache format version, this includes the stat of this
+    module, so that a new or locally modified fdroidserver does not
+    reuse what an older one parsed, and the accepted formats, since
+    those decide which files parse at all.
+
+    """
+    stat = os.stat(__file__)
+    return [METADATA_CACHE_VERSION, stat.st_size, stat.st_mtime_ns,
+            sorted(fdroidserver.common.config['accepted_formats'])]
+
+
+def _get_metadata_file_fingerprint(metadatapath):
+    stat = os.stat(metadatapath)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def read_metadata_cache():
+    """Read the cache of parsed metadata files, or an empty one if it is stale
+
+    :returns: dict of cache entries, keyed by the path of the metadata file
+    """
+    version = _get_metadata_cache_version()
+    if os.path.exists(METADATA_CACHE_FILE):
+        try:
+            with open(METADATA_CACHE_FILE) as fp:
+                cache = json.load(fp)
+            if cache.get('version') == version:
+                return cache['files']
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.debug(_('Ignoring broken {path}: {error}')
+                          .format(path=METADATA_CACHE_FILE, error=e))
+    return dict()
+
+
+def write_metadata_cache(entries):
+    """Atomically replace the cache of parsed metadata files"""
+    cache = OrderedDict([
+        ('version', _get_metadata_cache_version()),
+        ('files', entries),
+    ])
+    tmpfile = METADATA_CACHE_FILE + '.new'
+    with open(tmpfile, 'w') as fp:
+        json.dump(cache, fp, separators=(',', ':'))
+    os.replace(tmpfile, METADATA_CACHE_FILE)
+
+
+def _app_from_cache_entry(entry):
+    app = App(entry['app'])
+    app['builds'] = [Build(build) for build in app['builds']]
+    return app
+
+
+def _parse_and_check_metadata(metadatapath, check_vcs, refresh):
+    """Parse and check a metadata file, and say whether the result can be cached
+
+    Only files which parse without any warnings are cached, so that
+    the warnings are shown again on every run, and so that an error
+    for them is still raised when -W error is given on a later run.
+
+    """
+    counter = _WarningCounter()
+    logger = logging.getLogger()
+    warnings_before = warnings_count
+    logger.addHandler(counter)
+    try:
+        app = parse_metadata(metadatapath, check_vcs, refresh)
+        check_metadata(app)
+    finally:
+        logger.removeHandler(counter)
+    cacheable = not check_vcs and counter.count == 0 and warnings_count == warnings_before
+    return app, cacheable
+
+
+def _get_metadata_files(sort_by_time=False):
+    metadatafiles = (glob.glob(os.path.join('metadata', '*.txt'))
+                     + glob.glob(os.path.join('metadata', '*.json'))
+                     + glob.glob(os.path.join('metadata', '*.yml'))
+                     + glob.glob('.fdroid.txt')
+                     + glob.glob('.fdroid.json')
+                     + glob.glob('.fdroid.yml'))
+
+    if sort_by_time:
+        entries = ((os.stat(path).st_mtime, path) for path in metadatafiles)
+        metadatafiles = []
+        for _ignored, path in sorted(entries, reverse=True):
+            metadatafiles.append(path)
+    else:
+        # most things want the index alpha sorted for stability
+        metadatafiles = sorted(metadatafiles)
+    return metadatafiles
+
+
+def _get_xref_linkres(apps):
+    def linkres(appid):
+        if appid in apps:
+            return ("fdroid.app:" + appid, "Dummy name - don't know yet")
+        warn_or_exception(_("Cannot resolve app id {appid}").format(appid=appid))
+    return linkres
+
+
+class AppRegistry(MutableMapping):
+    """All apps in the metadata, parsed only when they are accessed
+
+    The app IDs come from the names of the metadata files, so listing
+    them, or checking whether an app exists, does not parse anything.
+    An app's metadata file is parsed and checked the first time the
+    app is accessed, and then its description is checked, which only
+    needs to know which app IDs exist.  Everything that read_metadata()
+    warns about for a file is warned about then.  Only .fdroid.* files
+    in the current directory are parsed right away, since their app ID
+    is in the file.  The metadata cache is neither read nor written,
+    since parsing a few files is faster than loading it.
+
+    Iterating over the values or items parses all of the apps, like
+    read_metadata() would, so this can be used in place of its result.
+    """
+
+    def __init__(self, metadatafiles, xref=True, check_vcs=[], refresh=True):
+        self._xref = xref
+        self._check_vcs = check_vcs
+        self._refresh = refresh
+        self._paths = OrderedDict()  # appid: metadata files, like read_metadata() sees them
+        self._apps = dict()
+        in_source = []
+        for metadatapath in metadatafiles:
+            appid, _ignored = fdroidserver.common.get_extension(os.path.basename(metadatapath))
+            if appid == '.fdroid':
+                in_source.append(metadatapath)
+            else:
+                self._paths.setdefault(appid, []).append(metadatapath)
+        for metadatapath in in_source:
+            self._load(None, [metadatapath])
+
+    def _load(self, appid, metadatafiles):
+        app = None
+        for metadatapath in metadatafiles:
+            if metadatapath == '.fdroid.txt':
+                warn_or_exception(_('.fdroid.txt is not supported!  Convert to .fdroid.yml or .fdroid.json.'))
+            if appid is not None and not fdroidserver.common.is_valid_package_name(appid):
+                warn_or_exception(_("{appid} from {path} is not a valid Java Package Name!")
+                                  .format(appid=appid, path=metadatapath))
+            if app is not None:
+                warn_or_exception(_("Found multiple metadata files for {appid}")
+                                  .format(appid=appid))
+            app, _ignored = _parse_and_check_metadata(metadatapath, appid in self._check_vcs, self._refresh)
+        if appid is None:
+            appid = app.id
+            self._paths[appid] = metadatafiles
+        self._apps[appid] = app
+        if self._xref:
+            try:
+                description_html(app.Description, _get_xref_linkres(self))
+            except MetaDataException as e:
+                warn_or_exception(_("Problem with description of {appid}: {error}")
+                                  .format(appid=appid, error=str(e)))
+        return app
+
+    def __getitem__(self, appid):
+        if appid in self._apps:
+            return self._apps[appid]
+        if appid not in self._paths:
+            raise KeyError(appid)
+        return self._load(appid, self._paths[appid])
+
+    def __setitem__(self, appid, app):
+        self._paths.setdefault(appid, [])
+        self._apps[appid] = app
+
+    def __delitem__(self, appid):
+        del self._paths[appid]
+        self._apps.pop(appid, None)
+
+    def __contains__(self, appid):
+        return appid in self._paths
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __repr__(self):
+        return '<{name} of {count} apps, {loaded} loaded>'.format(
+            name=type(self).__name__, count=len(self), loaded=len(self._apps))
+
+
+class _LogRecorder(logging.Handler):
+    """Keep the log records of a worker, to be logged by the main process"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _init_parse_worker(common_config, common_options, action, worker_srclibs, loglevel):
+    """Set up the global state in a worker process of a process pool"""
+    global warnings_action, srclibs
+    fdroidserver.common.config = common_config
+    fdroidserver.common.options = common_options
+    warnings_action = action
+    srclibs = worker_srclibs
+    logger = logging.getLogger()
+    logger.handlers = [logging.NullHandler()]
+    logger.setLevel(loglevel)
+
+
+def _parse_metadata_job(metadatapath, refresh):
+    """Run _parse_and_check_metadata() in a worker
+
+    Nothing is logged or raised here, instead the log records, the
+    number of warnings and the exception are returned, so that the
+    main process can log them in the same order as if it parsed all of
+    the files itself, see _finish_parse_metadata_job().
+
+    """
+    recorder = _LogRecorder()
+    logger = logging.getLogger()
+    logger.addHandler(recorder)
+    warnings_before = warnings_count
+    app = cacheable = error = None
+    try:
+        app, cacheable = _parse_and_check_metadata(metadatapath, False, refresh)
+    except Exception as e:
+        error = e
+    finally:
+        logger.removeHandler(recorder)
+    return app, cacheable, recorder.records, warnings_count - warnings_before, error
+
+
+def _finish_parse_metadata_job(result):
+    global warnings_count
+    app, cacheable, records, count, error = result
+    logger = logging.getLogger()
+    for record in records:
+        logger.handle(record)
+    warnings_count += count
+    if error is not None:
+        raise error
+    return app, cacheable
+
+
+def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False, jobs=None, lazy=False):
     """Return a list of App instances sorted newest first
 
     This reads all of the metadata files in a 'data' repository, then
@@ -838,6 +1401,25 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
 
     check_vcs is the list of appids to check for .fdroid.yml in source
 
+    Parsing thousands of files is slow, so the parsed and checked App
+    instances are kept in tmp/metadatacache.json.  A file is only
+    parsed again when its size, mtime or inode changed, or when
+    fdroidserver itself changed.  The app IDs that each description
+    links to are cached as well, so the cross-reference check only
+    has to render the descriptions with links that do not resolve.
+    The rendered descriptions that `fdroid update` saved in
+    tmp/descriptioncache.json are loaded here too.
+
+    The files that have to be parsed are spread over a pool of :param
+    jobs worker processes, all cores by default, when there are enough
+    of them for that to pay off.  The results, and the warnings and
+    errors, are still handled one file at a time in sorted order, just
+    like when they are parsed in this process.
+
+    With :param lazy, an AppRegistry is returned instead, which only
+    parses the metadata of an app when it is accessed.  That is for
+    commands that only work on the apps given on the command line.
+
     """
 
     # Always read the srclibs before the apps, since they can use a srlib as
@@ -850,50 +1432,104 @@ def read_metadata(xref=True, check_vcs=[], refresh=True, sort_by_time=False):
         if not os.path.exists(basedir):
             os.makedirs(basedir)
 
-    metadatafiles = (glob.glob(os.path.join('metadata', '*.txt'))
-                     + glob.glob(os.path.join('metadata', '*.json'))
-                     + glob.glob(os.path.join('metadata', '*.yml'))
-                     + glob.glob('.fdroid.txt')
-                     + glob.glob('.fdroid.json')
-                     + glob.glob('.fdroid.yml'))
+    metadatafiles = _get_metadata_files(sort_by_time)
+    if lazy:
+        return AppRegistry(metadatafiles, xref, check_vcs, refresh)
 
-    if sort_by_time:
-        entries = ((os.stat(path).st_mtime, path) for path in metadatafiles)
-        metadatafiles = []
-        for _ignored, path in sorted(entries, reverse=True):
-            metadatafiles.append(path)
-    else:
-        # most things want the index alpha sorted for stability
-        metadatafiles = sorted(metadatafiles)
+    cache = read_metadata_cache()
+    cachechanged = False
+    read_description_cache()
+    newcache = dict()
 
+    fingerprints = dict()
+    to_parse = []
     for metadatapath in metadatafiles:
-        if metadatapath == '.fdroid.txt':
-            warn_or_exception(_('.fdroid.txt is not supported!  Convert to .fdroid.yml or .fdroid.json.'))
         appid, _ignored = fdroidserver.common.get_extension(os.path.basename(metadatapath))
-        if appid != '.fdroid' and not fdroidserver.common.is_valid_package_name(appid):
-            warn_or_exception(_("{appid} from {path} is not a valid Java Package Name!")
-                              .format(appid=appid, path=metadatapath))
-        if appid in apps:
-            warn_or_exception(_("Found multiple metadata files for {appid}")
-                              .format(appid=appid))
-        app = parse_metadata(metadatapath, appid in check_vcs, refresh)
-        check_metadata(app)
-        apps[app.id] = app
+        if os.path.dirname(metadatapath) != 'metadata' or appid in check_vcs:
+            fingerprint = None  # might include files from the source repo
+        else:
+            fingerprint = _get_metadata_file_fingerprint(metadatapath)
+        fingerprints[metadatapath] = fingerprint
+        entry = cache.get(metadatapath)
+        if not (entry and fingerprint and entry['fingerprint'] == fingerprint) \
+           and appid not in check_vcs:
+            to_parse.append(metadatapath)
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(to_parse) // PARSE_JOB_MIN_FILES)
+    pool = None
+    if jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_parse_worker,
+            initargs=(fdroidserver.common.config, fdroidserver.common.options,
+                      warnings_action, srclibs, logging.getLogger().getEffectiveLevel()))
+        parsed = pool.map(_parse_metadata_job, to_parse, itertools.repeat(refresh),
+                          chunksize=PARSE_JOB_MIN_FILES // 2)
+
+    try:
+        for metadatapath in metadatafiles:
+            if metadatapath == '.fdroid.txt':
+                warn_or_exception(_('.fdroid.txt is not supported!  Convert to .fdroid.yml or .fdroid.json.'))
+            appid, _ignored = fdroidserver.common.get_extension(os.path.basename(metadatapath))
+            if appid != '.fdroid' and not fdroidserver.common.is_valid_package_name(appid):
+                warn_or_exception(_("{appid} from {path} is not a valid Java Package Name!")
+                                  .format(appid=appid, path=metadatapath))
+            if appid in apps:
+                warn_or_exception(_("Found multiple metadata files for {appid}")
+                                  .format(appid=appid))
+            entry = cache.get(metadatapath)
+            fingerprint = fingerprints[metadatapath]
+            if entry and fingerprint and entry['fingerprint'] == fingerprint:
+                app = _app_from_cache_entry(entry)
+            else:
+                if pool and appid not in check_vcs:
+                    app, cacheable = _finish_parse_metadata_job(next(parsed))
+                else:
+                    app, cacheable = _parse_and_check_metadata(metadatapath, appid in check_vcs, refresh)
+                entry = None
+                if fingerprint and cacheable:
+                    try:
+                        json.dumps(app)
+                        entry = OrderedDict([('fingerprint', fingerprint), ('app', app), ('xrefs', None)])
+                    except (TypeError, ValueError):
+                        pass  # YAML gave something without a JSON representation
+                cachechanged = True
+            if entry:
+                newcache[metadatapath] = entry
+            apps[app.id] = app
+    finally:
+        if pool:
+            pool.shutdown()
 
     if xref:
         # Parse all descriptions at load time, just to ensure cross-referencing
         # errors are caught early rather than when they hit the build server.
-        def linkres(appid):
-            if appid in apps:
-                return ("fdroid.app:" + appid, "Dummy name - don't know yet")
-            warn_or_exception(_("Cannot resolve app id {appid}").format(appid=appid))
+        linkres = _get_xref_linkres(apps)
 
         for appid, app in apps.items():
+            entry = newcache.get(app.metadatapath)
+            if entry and entry['xrefs'] is not None \
+               and all(linkappid in apps for linkappid in entry['xrefs']):
+                continue
+            xrefs = []
+
+            def recording_linkres(linkappid):
+                xrefs.append(linkappid)
+                return linkres(linkappid)
+
             try:
-                description_html(app.Description, linkres)
+                description_html(app.Description, recording_linkres)
             except MetaDataException as e:
                 warn_or_exception(_("Problem with description of {appid}: {error}")
                                   .format(appid=appid, error=str(e)))
+                xrefs = None
+            if entry and entry['xrefs'] != xrefs:
+                entry['xrefs'] = xrefs
+                cachechanged = True
+
+    if cachechanged or len(newcache) != len(cache):
+        write_metadata_cache(newcache)
 
     return apps
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import ipaddress
 import logging
 import os
@@ -7,12 +8,15 @@ import posixpath
 import socket
 import subprocess
 import sys
+import tempfile
+import zipfile
 from argparse import ArgumentParser
 import urllib.parse
 
 from . import _
 from . import common
 from . import index
+from . import net
 from . import update
 
 options = None
@@ -38,6 +42,12 @@ def _run_wget(path, urls):
     os.remove(urls_file)
 
 
+def _iter_unverified_index(fp):
+    with fp, zipfile.ZipFile(fp) as jar:
+        with io.TextIOWrapper(jar.open('index-v1.json'), encoding='utf-8') as jsonfp:
+            yield from index.iter_index_v1(jsonfp)
+
+
 def main():
     global options
 
@@ -80,26 +90,18 @@ def main():
         return urllib.parse.urlunparse((scheme, hostname, newpath, params, query, fragment))
 
     if fingerprint:
-        config = common.read_config(options)
-        if not ('jarsigner' in config or 'apksigner' in config):
-            logging.error(_('Java JDK not found! Install in standard location or set java_paths!'))
-            sys.exit(1)
+        common.read_config(options)
 
-        def _get_index(section, etag=None):
+        def _get_index(section):
             url = _append_to_url_path(section)
-            return index.download_repo_index(url, etag=etag)
+            items, etag = index.download_repo_index_iter(url)
+            return items
     else:
-        def _get_index(section, etag=None):
-            import io
-            import json
-            import zipfile
-            from . import net
+        def _get_index(section):
             url = _append_to_url_path(section, 'index-v1.jar')
-            content, etag = net.http_get(url)
-            with zipfile.ZipFile(io.BytesIO(content)) as zip:
-                jsoncontents = zip.open('index-v1.json').read()
-            data = json.loads(jsoncontents.decode('utf-8'))
-            return data, etag
+            fp = tempfile.TemporaryFile()
+            net.http_get_to_file(url, fp)
+            return _iter_unverified_index(fp)
 
     ip = None
     try:
@@ -138,73 +140,77 @@ def main():
     for section in sections:
         sectiondir = os.path.join(basedir, section)
 
-        data, etag = _get_index(section)
+        items = _get_index(section)
 
         os.makedirs(sectiondir, exist_ok=True)
         os.chdir(sectiondir)
         for icondir in icondirs:
             os.makedirs(os.path.join(sectiondir, icondir), exist_ok=True)
 
+        # only the URLs are kept, so the whole index is never in memory
         urls = []
-        for packageName, packageList in data['packages'].items():
-            for package in packageList:
-                to_fetch = []
-                keys = ['apkName', ]
-                if options.src_tarballs:
-                    keys.append('srcname')
-                for k in keys:
-                    if k in package:
-                        to_fetch.append(package[k])
-                    elif k == 'apkName':
-                        logging.error(_('{appid} is missing {name}')
-                                      .format(appid=package['packageName'], name=k))
-                for f in to_fetch:
-                    if not os.path.exists(f) \
-                       or (f.endswith('.apk') and os.path.getsize(f) != package['size']):
-                        urls.append(_append_to_url_path(section, f))
-                        if options.pgp_signatures:
-                            urls.append(_append_to_url_path(section, f + '.asc'))
-                        if options.build_logs and f.endswith('.apk'):
-                            urls.append(_append_to_url_path(section, f[:-4] + '.log.gz'))
+        graphics = []
+        icon_urls = dict((icondir, []) for icondir in icondirs)
+        for key, value in items:
+            if key == 'apps':
+                app = value
+                localized = app.get('localized')
+                if localized:
+                    for locale, d in localized.items():
+                        graphic_urls = []
+                        components = (section, app['packageName'], locale)
+                        for k in update.GRAPHIC_NAMES:
+                            f = d.get(k)
+                            if f:
+                                filepath_tuple = components + (f, )
+                                graphic_urls.append(_append_to_url_path(*filepath_tuple))
+                        graphics.append((os.path.join(basedir, *components), graphic_urls))
+                        for k in update.SCREENSHOT_DIRS:
+                            filelist = d.get(k)
+                            if filelist:
+                                graphic_urls = []
+                                components = (section, app['packageName'], locale, k)
+                                for f in filelist:
+                                    filepath_tuple = components + (f, )
+                                    graphic_urls.append(_append_to_url_path(*filepath_tuple))
+                                graphics.append((os.path.join(basedir, *components), graphic_urls))
+
+                if 'icon' not in app:
+                    logging.error(_('no "icon" in {appid}').format(appid=app['packageName']))
+                    continue
+                icon = app['icon']
+                for icondir in icondirs:
+                    icon_urls[icondir].append(_append_to_url_path(section, icondir, icon))
+
+            elif key == 'packages':
+                packageName, packageList = value
+                for package in packageList:
+                    to_fetch = []
+                    keys = ['apkName', ]
+                    if options.src_tarballs:
+                        keys.append('srcname')
+                    for k in keys:
+                        if k in package:
+                            to_fetch.append(package[k])
+                        elif k == 'apkName':
+                            logging.error(_('{appid} is missing {name}')
+                                          .format(appid=package['packageName'], name=k))
+                    for f in to_fetch:
+                        if not os.path.exists(f) \
+                           or (f.endswith('.apk') and os.path.getsize(f) != package['size']):
+                            urls.append(_append_to_url_path(section, f))
+                            if options.pgp_signatures:
+                                urls.append(_append_to_url_path(section, f + '.asc'))
+                            if options.build_logs and f.endswith('.apk'):
+                                urls.append(_append_to_url_path(section, f[:-4] + '.log.gz'))
 
         _run_wget(sectiondir, urls)
 
-        for app in data['apps']:
-            localized = app.get('localized')
-            if localized:
-                for locale, d in localized.items():
-                    urls = []
-                    components = (section, app['packageName'], locale)
-                    for k in update.GRAPHIC_NAMES:
-                        f = d.get(k)
-                        if f:
-                            filepath_tuple = components + (f, )
-                            urls.append(_append_to_url_path(*filepath_tuple))
-                    _run_wget(os.path.join(basedir, *components), urls)
-                    for k in update.SCREENSHOT_DIRS:
-                        urls = []
-                        filelist = d.get(k)
-                        if filelist:
-                            components = (section, app['packageName'], locale, k)
-                            for f in filelist:
-                                filepath_tuple = components + (f, )
-                                urls.append(_append_to_url_path(*filepath_tuple))
-                            _run_wget(os.path.join(basedir, *components), urls)
-
-        urls = dict()
-        for app in data['apps']:
-            if 'icon' not in app:
-                logging.error(_('no "icon" in {appid}').format(appid=app['packageName']))
-                continue
-            icon = app['icon']
-            for icondir in icondirs:
-                url = _append_to_url_path(section, icondir, icon)
-                if icondir not in urls:
-                    urls[icondir] = []
-                urls[icondir].append(url)
+        for path, graphic_urls in graphics:
+            _run_wget(path, graphic_urls)
 
         for icondir in icondirs:
-            _run_wget(os.path.join(basedir, section, icondir), urls[icondir])
+            _run_wget(os.path.join(basedir, section, icondir), icon_urls[icondir])
 
 
 if __name__ == "__main__":
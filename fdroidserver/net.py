@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os
 import requests
 
@@ -65,3 +66,38 @@ def http_get(url, etag=None, timeout=600):
         new_etag = r.headers['ETag']
 
     return r.content, new_etag
+
+
+def http_get_to_file(url, fp, etag=None, timeout=600, chunk_size=65536):
+    """
+    Streams the content from the given URL into a file, hashing it on the way.
+
+    Unlike http_get(), this never holds the whole content in memory.
+    If an ETag is given, it will do a HEAD request first, to see if the content changed.
+
+    :param url: The URL to download from.
+    :param fp: The binary file object to write the content to.
+    :param etag: The last ETag to be used for the request (optional).
+    :return: A tuple consisting of:
+        - The SHA-256 of the content as hex string, or None if it did not change
+        - The new eTag as returned by the HTTP request
+    """
+    if etag:
+        r = requests.head(url, headers=HEADERS, timeout=timeout)
+        r.raise_for_status()
+        if 'ETag' in r.headers and etag == r.headers['ETag']:
+            return None, etag
+
+    r = requests.get(url, headers=HEADERS, timeout=timeout, stream=True)
+    r.raise_for_status()
+
+    new_etag = None
+    if 'ETag' in r.headers:
+        new_etag = r.headers['ETag']
+
+    sha256 = hashlib.sha256()
+    for chunk in r.iter_content(chunk_size=chunk_size):
+        sha256.update(chunk)
+        fp.write(chunk)
+    fp.flush()
+    return sha256.hexdigest(), new_etag
@@ -34,6 +34,7 @@ import zipfile
 from . import _
 from . import common
 from . import metadata
+from . import signindex
 from .common import FDroidPopen
 from .exception import BuildException, FDroidException
 
@@ -104,21 +105,8 @@ def sign_sig_key_fingerprint_list(jar_file):
     where built and signed by F-Droid and which ones were
     manually added by users.
     """
-    cmd = [config['jarsigner']]
-    cmd += '-keystore', config['keystore']
-    cmd += '-storepass:env', 'FDROID_KEY_STORE_PASS'
-    cmd += '-digestalg', 'SHA1'
-    cmd += '-sigalg', 'SHA1withRSA'
-    cmd += jar_file, config['repo_keyalias']
-    if config['keystore'] == 'NONE':
-        cmd += config['smartcardoptions']
-    else:  # smardcards never use -keypass
-        cmd += '-keypass:env', 'FDROID_KEY_PASS'
-    env_vars = {'FDROID_KEY_STORE_PASS': config['keystorepass'],
-                'FDROID_KEY_PASS': config['keypass']}
-    p = common.FDroidPopen(cmd, envs=env_vars)
-    if p.returncode != 0:
-        raise FDroidException("Failed to sign '{}'!".format(jar_file))
+    signindex.config = config
+    signindex.sign_jar(jar_file)
 
 
 def store_stats_fdroid_signing_key_fingerprints(appids, indent=None):
@@ -18,6 +18,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from argparse import ArgumentParser
+from collections import OrderedDict
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import os
 import logging
 import io
@@ -31,22 +36,144 @@ options = None
 
 
 SUPPORTED_FORMATS = ['txt', 'yml']
+CANONICAL_CACHE_FILE = os.path.join('tmp', 'rewritemetacache.json')
+REWRITE_JOB_MIN_FILES = 16  # files per worker process, to make up for starting it
 
 
-def proper_format(app):
+def _format_metadata(app, extension):
     s = io.StringIO()
-    # TODO: currently reading entire file again, should reuse first
-    # read in metadata.py
-    with open(app.metadatapath, 'r') as f:
-        cur_content = f.read()
-    _ignored, extension = common.get_extension(app.metadatapath)
     if extension == 'yml':
         metadata.write_yaml(s, app)
     elif extension == 'txt':
         metadata.write_txt(s, app)
     content = s.getvalue()
     s.close()
-    return content == cur_content
+    return content
+
+
+def proper_format(app):
+    # TODO: currently reading entire file again, should reuse first
+    # read in metadata.py
+    with open(app.metadatapath, 'r') as f:
+        cur_content = f.read()
+    _ignored, extension = common.get_extension(app.metadatapath)
+    return _format_metadata(app, extension) == cur_content
+
+
+def _get_canonical_cache_version():
+    """Get the values which invalidate the whole canonical cache when changed
+
+    That is everything that invalidates the metadata cache, since the
+    metadata parser and writers decide what is canonical, and the stat
+    of this module.
+
+    """
+    stat = os.stat(__file__)
+    return [metadata._get_metadata_cache_version(), stat.st_size, stat.st_mtime_ns]
+
+
+def read_canonical_cache():
+    """Read the hashes of the metadata files known to be in the canonical format
+
+    :returns: dict of SHA-256 hex digests, keyed by the path of the
+      metadata file, or an empty one if the cache is stale
+    """
+    version = _get_canonical_cache_version()
+    if os.path.exists(CANONICAL_CACHE_FILE):
+        try:
+            with open(CANONICAL_CACHE_FILE) as fp:
+                cache = json.load(fp)
+            if cache.get('version') == version:
+                return cache['files']
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.debug(_('Ignoring broken {path}: {error}')
+                          .format(path=CANONICAL_CACHE_FILE, error=e))
+    return dict()
+
+
+def write_canonical_cache(hashes):
+    """Atomically replace the hashes of the metadata files in the canonical format"""
+    cache = OrderedDict([
+        ('version', _get_canonical_cache_version()),
+        ('files', hashes),
+    ])
+    tmpfile = CANONICAL_CACHE_FILE + '.new'
+    with open(tmpfile, 'w') as fp:
+        json.dump(cache, fp, separators=(',', ':'))
+    os.replace(tmpfile, CANONICAL_CACHE_FILE)
+
+
+def rewrite_metadata(app, to_ext=None, list_only=False):
+    """Rewrite the metadata file of an app in the canonical format
+
+    A file that is already canonical is not written again, so that
+    its mtime, and with that the metadata cache entry, stays valid.
+
+    :param to_ext: the format to convert to, or None to keep the format
+    :param list_only: only check the format, do not write anything
+    :returns: True if the file was already in the canonical format
+    """
+    base, ext = common.get_extension(app.metadatapath)
+    if list_only:
+        return proper_format(app)
+
+    newbuilds = []
+    for build in app.builds:
+        new = metadata.Build()
+        for k in metadata.build_flags:
+            v = build[k]
+            if v is None or v is False or v == [] or v == '':
+                continue
+            new[k] = v
+        newbuilds.append(new)
+    app.builds = newbuilds
+
+    if to_ext is None or to_ext == ext:
+        with open(app.metadatapath, 'r') as f:
+            cur_content = f.read()
+        if _format_metadata(app, ext) == cur_content:
+            return True
+        to_ext = ext
+
+    metadata.write_metadata(base + '.' + to_ext, app)
+    # remove old format metadata if there was  a format change
+    # and rewriting to the new format worked
+    if ext != to_ext:
+        os.remove(app.metadatapath)
+    return False
+
+
+def _rewrite_metadata_job(app, to_ext, list_only):
+    """Run rewrite_metadata() in a worker
+
+    Like metadata._parse_metadata_job(), this returns the log records,
+    the number of warnings and the exception instead of logging or
+    raising them, so the main process can handle them in order.
+
+    """
+    recorder = metadata._LogRecorder()
+    logger = logging.getLogger()
+    logger.addHandler(recorder)
+    warnings_before = metadata.warnings_count
+    canonical = error = None
+    try:
+        canonical = rewrite_metadata(app, to_ext, list_only)
+    except Exception as e:
+        error = e
+    finally:
+        logger.removeHandler(recorder)
+    return canonical, recorder.records, metadata.warnings_count - warnings_before, error
+
+
+def _finish_rewrite_metadata_job(result):
+    canonical, records, count, error = result
+    logger = logging.getLogger()
+    for record in records:
+        logger.handle(record)
+    metadata.warnings_count += count
+    if error is not None:
+        raise error
+    return canonical
 
 
 def main():
@@ -60,6 +187,8 @@ def main():
                         help=_("List files that would be reformatted"))
     parser.add_argument("-t", "--to", default=None,
                         help=_("Rewrite to a specific format: ") + ', '.join(SUPPORTED_FORMATS))
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help=_("Number of parallel processes to use for reading and rewriting metadata, all cores by default"))
     parser.add_argument("appid", nargs='*', help=_("applicationId in the form APPID"))
     metadata.add_metadata_arguments(parser)
     options = parser.parse_args()
@@ -68,7 +197,7 @@ def main():
     config = common.read_config(options)
 
     # Get all apps...
-    allapps = metadata.read_metadata(xref=True)
+    allapps = metadata.read_metadata(xref=True, jobs=options.jobs)
     apps = common.read_app_args(options.appid, allapps, False)
 
     if options.list and options.to is not None:
@@ -78,45 +207,64 @@ def main():
         parser.error(_("Unsupported metadata format, use: --to [{supported}]")
                      .format(supported=' '.join(SUPPORTED_FORMATS)))
 
+    # Files whose content is known to be canonical are skipped, which
+    # is most of them when this runs on every commit.  Only files that
+    # were checked and found canonical are added, never the ones that
+    # were just rewritten, so this never relies on rewriting twice
+    # giving the same result.
+    cache = read_canonical_cache()
+    metadatapaths = set(app.metadatapath for app in allapps.values())
+    hashes = dict((path, sha256) for path, sha256 in cache.items() if path in metadatapaths)
+    todo = []
     for appid, app in apps.items():
         path = app.metadatapath
         base, ext = common.get_extension(path)
         if not options.to and ext not in SUPPORTED_FORMATS:
             logging.info(_("Ignoring {ext} file at '{path}'").format(ext=ext, path=path))
             continue
-        elif options.to is not None:
+        sha256 = None
+        if options.to is None or options.to == ext:
+            with open(path, 'rb') as f:
+                sha256 = hashlib.sha256(f.read()).hexdigest()
+            if hashes.get(path) == sha256:
+                logging.debug(_("'{path}' is already in the canonical format").format(path=path))
+                continue
+            hashes.pop(path, None)
+        if options.to is not None:
             logging.info(_("Rewriting '{appid}' to '{path}'").format(appid=appid, path=options.to))
         else:
             logging.info(_("Rewriting '{appid}'").format(appid=appid))
+        todo.append((app, sha256))
 
-        to_ext = ext
-        if options.to is not None:
-            to_ext = options.to
-
-        if options.list:
-            if not proper_format(app):
-                print(path)
-            continue
+    jobs = options.jobs
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(todo) // REWRITE_JOB_MIN_FILES)
+    pool = None
+    if jobs > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=metadata._init_parse_worker,
+            initargs=(common.config, common.options, metadata.warnings_action,
+                      metadata.srclibs, logging.getLogger().getEffectiveLevel()))
+        results = pool.map(_rewrite_metadata_job, (app for app, _sha256 in todo),
+                           itertools.repeat(options.to), itertools.repeat(options.list),
+                           chunksize=max(1, REWRITE_JOB_MIN_FILES // 2))
 
-        newbuilds = []
-        for build in app.builds:
-            new = metadata.Build()
-            for k in metadata.build_flags:
-                v = build[k]
-                if v is None or v is False or v == [] or v == '':
-                    continue
-                new[k] = v
-            newbuilds.append(new)
-        app.builds = newbuilds
-
-        try:
-            metadata.write_metadata(base + '.' + to_ext, app)
-            # remove old format metadata if there was  a format change
-            # and rewriting to the new format worked
-            if ext != to_ext:
-                os.remove(path)
-        finally:
-            pass
+    try:
+        for app, sha256 in todo:
+            if pool:
+                canonical = _finish_rewrite_metadata_job(next(results))
+            else:
+                canonical = rewrite_metadata(app, options.to, options.list)
+            if canonical and sha256:
+                hashes[app.metadatapath] = sha256
+            elif options.list:
+                print(app.metadatapath)
+    finally:
+        if pool:
+            pool.shutdown()
+        if hashes != cache:
+            write_canonical_cache(hashes)
 
     logging.debug(_("Finished"))
 
@@ -295,7 +295,7 @@ def main():
     config = common.read_config(options)
 
     # Read all app and srclib metadata
-    allapps = metadata.read_metadata()
+    allapps = metadata.read_metadata(lazy=bool(options.appid))
     apps = common.read_app_args(options.appid, allapps, True)
 
     probcount = 0
@@ -47,6 +47,14 @@ AUTO_S3CFG = '.fdroid-server-update-s3cfg'
 USER_S3CFG = 's3cfg'
 
 
+def _get_index_excludes(repo_section):
+    """Exclude the index files, which are only uploaded in the last pass"""
+    excludes = []
+    for f in ('index.xml', 'index.xml.gz', 'index.xml.br', 'index.jar', 'index-v1.jar', 'entry.jar'):
+        excludes += ['--exclude', os.path.join(repo_section, f)]
+    return excludes
+
+
 def update_awsbucket(repo_section):
     '''
     Upload the contents of the directory `repo_section` (including
@@ -107,27 +115,20 @@ def update_awsbucket_s3cmd(repo_section):
         s3cmd_sync += ['--verbose']
     if options.quiet:
         s3cmd_sync += ['--quiet']
-    indexxml = os.path.join(repo_section, 'index.xml')
-    indexjar = os.path.join(repo_section, 'index.jar')
-    indexv1jar = os.path.join(repo_section, 'index-v1.jar')
 
     s3url = s3bucketurl + '/fdroid/'
     logging.debug('s3cmd sync new files in ' + repo_section + ' to ' + s3url)
     logging.debug(_('Running first pass with MD5 checking disabled'))
     if subprocess.call(s3cmd_sync
-                       + ['--no-check-md5', '--skip-existing',
-                          '--exclude', indexxml,
-                          '--exclude', indexjar,
-                          '--exclude', indexv1jar,
-                          repo_section, s3url]) != 0:
+                       + ['--no-check-md5', '--skip-existing']
+                       + _get_index_excludes(repo_section)
+                       + [repo_section, s3url]) != 0:
         raise FDroidException()
     logging.debug('s3cmd sync all files in ' + repo_section + ' to ' + s3url)
     if subprocess.call(s3cmd_sync
-                       + ['--no-check-md5',
-                          '--exclude', indexxml,
-                          '--exclude', indexjar,
-                          '--exclude', indexv1jar,
-                          repo_section, s3url]) != 0:
+                       + ['--no-check-md5']
+                       + _get_index_excludes(repo_section)
+                       + [repo_section, s3url]) != 0:
         raise FDroidException()
 
     logging.debug(_('s3cmd sync indexes {path} to {url} and delete')
@@ -249,9 +250,6 @@ def update_serverwebroot(serverwebroot, repo_section):
         rsyncargs += ['-e', 'ssh -oBatchMode=yes -oIdentitiesOnly=yes -i ' + options.identity_file]
     elif 'identity_file' in config:
         rsyncargs += ['-e', 'ssh -oBatchMode=yes -oIdentitiesOnly=yes -i ' + config['identity_file']]
-    indexxml = os.path.join(repo_section, 'index.xml')
-    indexjar = os.path.join(repo_section, 'index.jar')
-    indexv1jar = os.path.join(repo_section, 'index-v1.jar')
     # Upload the first time without the index files and delay the deletion as
     # much as possible, that keeps the repo functional while this update is
     # running.  Then once it is complete, rerun the command again to upload
@@ -261,10 +259,8 @@ def update_serverwebroot(serverwebroot, repo_section):
     # (serverwebroot is guaranteed to have a trailing slash in common.py)
     logging.info('rsyncing ' + repo_section + ' to ' + serverwebroot)
     if subprocess.call(rsyncargs
-                       + ['--exclude', indexxml,
-                          '--exclude', indexjar,
-                          '--exclude', indexv1jar,
-                          repo_section, serverwebroot]) != 0:
+                       + _get_index_excludes(repo_section)
+                       + [repo_section, serverwebroot]) != 0:
         raise FDroidException()
     if subprocess.call(rsyncargs + [repo_section, serverwebroot]) != 0:
         raise FDroidException()
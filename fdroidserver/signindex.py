@@ -23,6 +23,7 @@ from argparse import ArgumentParser
 import logging
 
 from . import _
+from . import apksig
 from . import common
 from .exception import FDroidException
 
@@ -30,10 +31,31 @@ config = None
 options = None
 start_timestamp = time.gmtime()
 
+_signing_keys = dict()
+
+
+def get_signing_key():
+    """
+    Load the repo signing key from the keystore, only once per run.
+
+    :returns: an apksig.PrivateKey, or None if the key can only be used
+              with jarsigner, e.g. on a smartcard
+    """
+    if config.get('keystore', 'NONE') == 'NONE' or 'repo_keyalias' not in config:
+        return None
+    cache_key = (config['keystore'], config['repo_keyalias'])
+    if cache_key not in _signing_keys:
+        key = apksig.load_private_key(config['keystore'], config['keystorepass'],
+                                      config['repo_keyalias'], config.get('keypass'))
+        if key is None:
+            logging.debug(_('Cannot use {path} without jarsigner').format(path=config['keystore']))
+        _signing_keys[cache_key] = key
+    return _signing_keys[cache_key]
+
 
 def sign_jar(jar):
     """
-    Sign a JAR file with Java's jarsigner.
+    Sign a JAR file, in-process if possible, otherwise with Java's jarsigner.
 
     This method requires a properly initialized config object.
 
@@ -42,6 +64,11 @@ def sign_jar(jar):
     but then Android < 4.3 would not be able to verify it.
     https://code.google.com/p/android/issues/detail?id=38321
     """
+    key = get_signing_key()
+    if key is not None:
+        apksig.sign_jar(jar, key, config['repo_keyalias'])
+        return
+
     args = [config['jarsigner'], '-keystore', config['keystore'],
             '-storepass:env', 'FDROID_KEY_STORE_PASS',
             '-digestalg', 'SHA1', '-sigalg', 'SHA1withRSA',
@@ -68,6 +95,9 @@ def sign_index_v1(repodir, json_name):
     unsigned data.  That file is then stuck into a jar and signed by the
     signing process.  index-v1.json is never published to the repo.  It is
     included in the binary transparency log, if that is enabled.
+
+    entry.json, which lists index-v1.jar and the diffs to the previous
+    indexes, is signed into entry.jar the same way.
     """
     name, ext = common.get_extension(json_name)
     index_file = os.path.join(repodir, json_name)
@@ -98,7 +128,7 @@ def main():
 
     config = common.read_config(options)
 
-    if 'jarsigner' not in config:
+    if 'jarsigner' not in config and get_signing_key() is None:
         raise FDroidException(
             _('Java jarsigner not found! Install in standard location or set java_paths!'))
 
@@ -119,13 +149,21 @@ def main():
             logging.info('Signed index in ' + output_dir)
             signed.append(index_jar)
 
-        json_name = 'index-v1.json'
-        index_file = os.path.join(output_dir, json_name)
-        if os.path.exists(index_file):
-            sign_index_v1(output_dir, json_name)
-            os.remove(index_file)
-            logging.info('Signed ' + index_file)
-            signed.append(index_file)
+        for json_name in ('index-v1.json', 'entry.json'):
+            index_file = os.path.join(output_dir, json_name)
+            if json_name == 'entry.json' and config.get('index_delta_count', 0) > 0 \
+               and os.path.join(output_dir, 'index-v1.json') in signed:
+                # entry.json lists the hash of the index-v1.jar that was just signed
+                from . import index
+                index.make_index_entry(output_dir)
+            if os.path.exists(index_file):
+                sign_index_v1(output_dir, json_name)
+                os.remove(index_file)
+                for sidecar in (index_file + '.gz', index_file + '.br'):
+                    if os.path.exists(sidecar):
+                        os.remove(sidecar)
+                logging.info('Signed ' + index_file)
+                signed.append(index_file)
 
     if not signed:
         logging.info(_("Nothing to do"))
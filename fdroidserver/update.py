@@ -23,6 +23,7 @@ import sys
 import os
 import shutil
 import glob
+import gzip
 import logging
 import re
 import socket
@@ -32,11 +33,15 @@ import hashlib
 import json
 import time
 import copy
+import itertools
+import concurrent.futures
+import sqlite3
 from datetime import datetime
 from argparse import ArgumentParser
 from base64 import urlsafe_b64encode
 
 import collections
+import collections.abc
 from binascii import hexlify
 
 from . import _
@@ -51,8 +56,17 @@ if hasattr(Image, 'DecompressionBombWarning'):
     warnings.simplefilter('error', Image.DecompressionBombWarning)
 Image.MAX_IMAGE_PIXELS = 0xffffff  # 4096x4096
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 METADATA_VERSION = 21
 
+# text files in the repo which get precompressed copies next to them
+TEXT_ARTIFACT_EXTENSIONS = ('.css', '.html', '.js', '.json', '.svg', '.txt', '.xml')
+COMPRESSED_SIDECAR_EXTENSIONS = ('.gz', '.br')
+
 # less than the valid range of versionCode, i.e. Java's Integer.MIN_VALUE
 UNSET_VERSION_CODE = -0x100000000
 
@@ -125,11 +139,12 @@ def status_update_json(apps, sortedids, apks):
     """Output a JSON file with metadata about this `fdroid update` run
 
     :param apps: fully populated list of all applications
-    :param apks: all to be published apks
+    :param apks: all to be published apks, as a list or common.RepoPackages
 
     """
 
     logging.debug(_('Outputting JSON'))
+    apks = common.get_repo_packages(apks)
     output = common.setup_status_output(start_timestamp)
     output['antiFeatures'] = dict()
     output['disabled'] = []
@@ -146,10 +161,7 @@ def status_update_json(apps, sortedids, apks):
                 antiFeatures[af]['apps'] = set()
             antiFeatures[af]['apps'].add(appid)
 
-        apklist = []
-        for apk in apks:
-            if apk['packageName'] == appid:
-                apklist.append(apk)
+        apklist = apks.get(appid)
         builds = app.get('builds', [])
         validapks = 0
         for build in builds:
@@ -179,6 +191,7 @@ def update_wiki(apps, sortedids, apks):
     :param apks: all apks, except...
     """
     logging.info("Updating wiki")
+    apks = common.get_repo_packages(apks)
     wikicat = 'Apps'
     wikiredircat = 'App Redirects'
     import mwclient
@@ -239,11 +252,10 @@ def update_wiki(apps, sortedids, apks):
         gotcurrentver = False
         cantupdate = False
         buildfails = False
-        for apk in apks:
-            if apk['packageName'] == appid:
-                if str(apk['versionCode']) == app.CurrentVersionCode:
-                    gotcurrentver = True
-                apklist.append(apk)
+        for apk in apks.get(appid):
+            if str(apk['versionCode']) == app.CurrentVersionCode:
+                gotcurrentver = True
+            apklist.append(apk)
         # Include ones we can't build, as a special case...
         for build in app.builds:
             if build.disable:
@@ -482,7 +494,7 @@ def getsig(apkpath):
     md5 digest algorithm.  This is not the same as the standard X.509
     certificate fingerprint.
 
-    :param apkpath: path to the apk
+    :param apkpath: path to the apk, or a common.ApkInspection of it
     :returns: A string containing the md5 of the signature of the apk or None
               if an error occurred.
 
@@ -494,8 +506,161 @@ def getsig(apkpath):
     return hashlib.md5(hexlify(cert_encoded)).hexdigest()  # nosec just used as ID for signing key
 
 
+class _ApkCacheEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        elif isinstance(obj, datetime):
+            return obj.timestamp()
+        return super().default(obj)
+
+
+def _decode_cache_entry(v):
+    """Convert the values of a cache entry that JSON does not support natively"""
+    if isinstance(v, dict):
+        if 'antiFeatures' in v:
+            v['antiFeatures'] = set(v['antiFeatures'])
+        if 'added' in v:
+            v['added'] = datetime.fromtimestamp(v['added'])
+    return v
+
+
+class JsonApkCache(collections.OrderedDict):
+    """APK cache stored as a single JSON file
+
+    The whole file is read when the cache is opened, and rewritten
+    when it is saved.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.update(json.load(fp, object_pairs_hook=collections.OrderedDict))
+            for v in self.values():
+                _decode_cache_entry(v)
+
+    def save(self):
+        for k, v in self.items():
+            if isinstance(k, bytes):
+                print('BYTES: ' + str(k) + ' ' + str(v))
+        with open(self.path, 'w') as fp:
+            json.dump(self, fp, cls=_ApkCacheEncoder, indent=2)
+
+    def close(self):
+        pass
+
+
+class SqliteApkCache(collections.abc.MutableMapping):
+    """APK cache stored in an SQLite database, one row per file
+
+    Entries are only read from the database when they are looked up,
+    and saving only writes the entries that were added or changed
+    since they were read, so the cost of using the cache does not
+    grow with the size of the whole repo.  Nothing is written to the
+    database until save() is called.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS apkcache'
+                         ' (name TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL)')
+        self._entries = dict()  # entries that were read or set, by name
+        self._saved = dict()  # JSON of entries as they are in the database
+
+    def _load(self, key):
+        if key not in self._entries:
+            row = self._db.execute('SELECT data FROM apkcache WHERE name = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self._saved[key] = row[0]
+            self._entries[key] = _decode_cache_entry(json.loads(row[0]))
+        return self._entries[key]
+
+    def __getitem__(self, key):
+        return self._load(key)
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+
+    def __delitem__(self, key):
+        self._load(key)
+        del self._entries[key]
+        self._saved.pop(key, None)
+        self._db.execute('DELETE FROM apkcache WHERE name = ?', (key,))
+
+    def __contains__(self, key):
+        if key in self._entries:
+            return True
+        return self._db.execute('SELECT 1 FROM apkcache WHERE name = ?', (key,)).fetchone() is not None
+
+    def __iter__(self):
+        names = [row[0] for row in self._db.execute('SELECT name FROM apkcache ORDER BY rowid')]
+        for name in names:
+            yield name
+        stored = set(names)
+        for name in list(self._entries):
+            if name not in stored:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _unused in self)
+
+    def clear(self):
+        self._entries.clear()
+        self._saved.clear()
+        self._db.execute('DELETE FROM apkcache')
+
+    def save(self):
+        """Write all new and changed entries to the database in a single transaction"""
+        rows = []
+        for k, v in self._entries.items():
+            data = json.dumps(v, cls=_ApkCacheEncoder)
+            if self._saved.get(k) != data:
+                rows.append((k, data))
+                self._saved[k] = data
+        self._db.executemany('INSERT OR REPLACE INTO apkcache (name, data) VALUES (?, ?)', rows)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+APKCACHE_BACKENDS = {
+    'json': JsonApkCache,
+    'sqlite': SqliteApkCache,
+}
+
+APKCACHE_FILES = {
+    'json': 'apkcache.json',
+    'sqlite': 'apkcache.db',
+}
+
+
 def get_cache_file():
-    return os.path.join('tmp', 'apkcache.json')
+    return os.path.join('tmp', APKCACHE_FILES[get_cache_backend()])
+
+
+def get_cache_backend():
+    backend = config.get('apkcache_backend', 'sqlite')
+    if backend not in APKCACHE_BACKENDS:
+        raise FDroidException(_("Unknown apkcache_backend '{backend}', use one of: {backends}")
+                              .format(backend=backend, backends=', '.join(sorted(APKCACHE_BACKENDS))))
+    return backend
+
+
+def migrate_json_cache(apkcache):
+    """Copy the entries of an old tmp/apkcache.json into a new cache, then remove it"""
+    jsonfile = os.path.join('tmp', APKCACHE_FILES['json'])
+    if isinstance(apkcache, JsonApkCache) or not os.path.exists(jsonfile):
+        return
+    logging.info(_('Migrating {oldfile} to {newfile}')
+                 .format(oldfile=jsonfile, newfile=apkcache.path))
+    apkcache.update(JsonApkCache(jsonfile))
+    apkcache.save()
+    os.remove(jsonfile)
 
 
 def get_cache():
@@ -511,52 +676,99 @@ def get_cache():
     those cases, there is no easy way to know what has changed from
     the cache, so just rerun the whole thing.
 
+    The storage is chosen by the 'apkcache_backend' config option, see
+    APKCACHE_BACKENDS.  An existing tmp/apkcache.json is migrated into
+    the SQLite backend the first time it is used.
+
     :return: apkcache
 
     """
     apkcachefile = get_cache_file()
     ada = disabled_algorithms_allowed()
-    if not options.clean and os.path.exists(apkcachefile):
-        with open(apkcachefile) as fp:
-            apkcache = json.load(fp, object_pairs_hook=collections.OrderedDict)
-        if apkcache.get("METADATA_VERSION") != METADATA_VERSION \
-           or apkcache.get('allow_disabled_algorithms') != ada:
-            apkcache = collections.OrderedDict()
-    else:
-        apkcache = collections.OrderedDict()
+    cache_path = os.path.dirname(apkcachefile)
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    isnew = not os.path.exists(apkcachefile)
+    apkcache = APKCACHE_BACKENDS[get_cache_backend()](apkcachefile)
+    if isnew:
+        migrate_json_cache(apkcache)
+    if options.clean \
+       or apkcache.get("METADATA_VERSION") != METADATA_VERSION \
+       or apkcache.get('allow_disabled_algorithms') != ada:
+        apkcache.clear()
 
     apkcache["METADATA_VERSION"] = METADATA_VERSION
     apkcache['allow_disabled_algorithms'] = ada
 
-    for k, v in apkcache.items():
-        if not isinstance(v, dict):
-            continue
-        if 'antiFeatures' in v:
-            v['antiFeatures'] = set(v['antiFeatures'])
-        if 'added' in v:
-            v['added'] = datetime.fromtimestamp(v['added'])
-
     return apkcache
 
 
 def write_cache(apkcache):
-    class Encoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, set):
-                return list(obj)
-            elif isinstance(obj, datetime):
-                return obj.timestamp()
-            return super().default(obj)
+    apkcache.save()
 
-    apkcachefile = get_cache_file()
-    cache_path = os.path.dirname(apkcachefile)
-    if not os.path.exists(cache_path):
-        os.makedirs(cache_path)
-    for k, v in apkcache.items():
-        if isinstance(k, bytes):
-            print('BYTES: ' + str(k) + ' ' + str(v))
-    with open(apkcachefile, 'w') as fp:
-        json.dump(apkcache, fp, cls=Encoder, indent=2)
+
+class ApkCacheSection(collections.abc.MutableMapping):
+    """The entries of the APK cache whose names start with a prefix
+
+    Each entry is stored in the cache on its own, so the SQLite
+    backend only rewrites the entries that changed.  The keys that
+    are looked up or set are remembered, then prune() removes the
+    entries that were neither used since the section was created nor
+    are still referenced from somewhere else.
+    """
+
+    def __init__(self, apkcache, prefix):
+        self.apkcache = apkcache
+        self.prefix = prefix
+        self.seen = set()
+
+    def __getitem__(self, key):
+        value = self.apkcache[self.prefix + key]
+        self.seen.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.apkcache[self.prefix + key] = value
+        self.seen.add(key)
+
+    def __delitem__(self, key):
+        del self.apkcache[self.prefix + key]
+        self.seen.discard(key)
+
+    def __contains__(self, key):
+        return self.prefix + key in self.apkcache
+
+    def __iter__(self):
+        for name in list(self.apkcache):
+            if isinstance(name, str) and name.startswith(self.prefix):
+                yield name[len(self.prefix):]
+
+    def __len__(self):
+        return sum(1 for _unused in self)
+
+    def snapshot(self):
+        """Get all entries as a plain dict, without marking them as used"""
+        return {key: self.apkcache[self.prefix + key] for key in self}
+
+    def prune(self, keep=()):
+        """Remove the entries that were not used
+
+        :param keep: keys of the entries to keep even if they were not used
+        :returns: True if any entry was removed
+        """
+        keep = self.seen.union(keep)
+        unused = [key for key in self if key not in keep]
+        for key in unused:
+            del self[key]
+        return bool(unused)
+
+
+NATIVE_LIBRARY_SCANS_PREFIX = 'native_library_scans/'
+
+
+def get_library_scans(apkcache):
+    """Get the cached native library scans, see has_known_vulnerability()"""
+    return ApkCacheSection(apkcache, NATIVE_LIBRARY_SCANS_PREFIX)
 
 
 def get_icon_bytes(apkzip, iconsrc):
@@ -579,6 +791,50 @@ def sha256sum(filename):
     return sha.hexdigest()
 
 
+def get_stat_fingerprint(filename):
+    """Get the stat values which show whether a file has changed
+
+    If the size, mtime, inode and device of a file all match what was
+    recorded in its cache entry, then the file is assumed to be
+    unchanged, so the cached hash can be used instead of reading the
+    whole file again.
+
+    """
+    stat = os.stat(filename)
+    return collections.OrderedDict([
+        ('size', stat.st_size),
+        ('mtime_ns', stat.st_mtime_ns),
+        ('inode', stat.st_ino),
+        ('device', stat.st_dev),
+    ])
+
+
+def check_cached_hash(cached, filename):
+    """Check whether the hash in a cache entry still matches the file
+
+    When the recorded stat values match the file, the cached hash is
+    trusted without rehashing, unless --verify-hashes was given.
+    Otherwise, the file is hashed and compared to the cached hash.  If
+    that still matches, the stat values in the cache entry are
+    refreshed so the next run can use the fast path.
+
+    :param cached: the cache entry for this file
+    :param filename: path to the file to check
+    :returns: (valid, changed) where valid is True if the cached hash can
+              be used, and changed is True if the cache entry was modified.
+    """
+    stat_fingerprint = get_stat_fingerprint(filename)
+    if not options.verify_hashes and 'hash' in cached \
+       and cached.get('stat_fingerprint') == stat_fingerprint:
+        return True, False
+    if cached.get('hash') != sha256sum(filename):
+        return False, False
+    if cached.get('stat_fingerprint') != stat_fingerprint:
+        cached['stat_fingerprint'] = stat_fingerprint
+        return True, True
+    return True, False
+
+
 def sha256base64(filename):
     '''Calculate the sha256 of the given file as URL-safe base64'''
     hasher = hashlib.sha256()
@@ -591,7 +847,61 @@ def sha256base64(filename):
     return urlsafe_b64encode(hasher.digest()).decode()
 
 
-def has_known_vulnerability(filename):
+OPENSSL_VERSION_PATTERN = re.compile(b'OpenSSL ([01][0-9a-z.-]+)')
+# matched from the first version string, this finds the last one on its line
+OPENSSL_LAST_VERSION_PATTERN = re.compile(b'[^\n]*OpenSSL ([01][0-9a-z.-]+)')
+
+# how much of the end of each inflated chunk is searched again along
+# with the next chunk, longer than any OpenSSL version string
+OPENSSL_VERSION_OVERLAP = 64
+NATIVE_LIBRARY_SCAN_CHUNK_SIZE = 1024 * 1024
+
+
+def _find_openssl_version(inspection, info):
+    """Find the OpenSSL version string in a native library in the APK
+
+    Like the `.*OpenSSL ...` regex this used to be, it returns the last
+    version string on the first line that has one.
+
+    Stored entries are searched in place in the mmap'ed APK.
+    Compressed entries are inflated once, and searched chunk by chunk
+    with an overlap, so version strings that straddle two chunks are
+    still found.
+
+    :returns: the version, or None if there is none
+    """
+    if info.compress_type == zipfile.ZIP_STORED:
+        offset = inspection.get_entry_data_offset(info)
+        end = offset + info.file_size
+        m = inspection.search(OPENSSL_VERSION_PATTERN, offset, end)
+        if m:
+            m = inspection.search(OPENSSL_LAST_VERSION_PATTERN, m.start(), end)
+        return m.group(1).decode('ascii') if m else None
+
+    with inspection.zipfile.open(info) as lib:
+        data = b''
+        start = None  # where the first version string is in data
+        while True:
+            chunk = lib.read(NATIVE_LIBRARY_SCAN_CHUNK_SIZE)
+            searched = len(data)
+            data = data + chunk if data else chunk
+            if start is None:
+                m = OPENSSL_VERSION_PATTERN.search(data)
+                if m:
+                    start = searched = m.start()
+            # the line of the first version string has to be complete
+            if start is not None and (not chunk or data.find(b'\n', searched) >= 0):
+                return OPENSSL_LAST_VERSION_PATTERN.match(data, start).group(1).decode('ascii')
+            if not chunk:
+                return None
+            if start is None:
+                data = data[max(0, len(data) - OPENSSL_VERSION_OVERLAP):]
+            else:
+                data = data[start:]
+                start = 0
+
+
+def has_known_vulnerability(filename, library_scans=None):
     """checks for known vulnerabilities in the APK
 
     Checks OpenSSL .so files in the APK to see if they are a known vulnerable
@@ -604,43 +914,47 @@ def has_known_vulnerability(filename):
 
     Janus is similar to Master Key but is perhaps easier to scan for.
     https://www.guardsquare.com/en/blog/new-android-vulnerability-allows-attackers-modify-apps-without-affecting-their-signatures
+
+    :param filename: path to the APK, or a common.ApkInspection of it
+    :param library_scans: dict of the OpenSSL versions found in native
+                          libraries, keyed by the CRC and size of the
+                          library, which is used to skip libraries that
+                          were already scanned, and gets the new results
     """
 
     found_vuln = False
-
-    # statically load this pattern
-    if not hasattr(has_known_vulnerability, "pattern"):
-        has_known_vulnerability.pattern = re.compile(b'.*OpenSSL ([01][0-9a-z.-]+)')
-
-    with open(filename.encode(), 'rb') as fp:
-        first4 = fp.read(4)
-    if first4 != b'\x50\x4b\x03\x04':
-        raise FDroidException(_('{path} has bad file signature "{pattern}", possible Janus exploit!')
-                              .format(path=filename, pattern=first4.decode().replace('\n', ' ')) + '\n'
-                              + 'https://www.guardsquare.com/en/blog/new-android-vulnerability-allows-attackers-modify-apps-without-affecting-their-signatures')
-
-    files_in_apk = set()
-    with zipfile.ZipFile(filename) as zf:
-        for name in zf.namelist():
+    if library_scans is None:
+        library_scans = dict()
+
+    with common.inspect_apk(filename) as inspection:
+        filename = inspection.path
+        first4 = inspection.read_header(4)
+        if first4 != b'\x50\x4b\x03\x04':
+            raise FDroidException(_('{path} has bad file signature "{pattern}", possible Janus exploit!')
+                                  .format(path=filename, pattern=first4.decode().replace('\n', ' ')) + '\n'
+                                  + 'https://www.guardsquare.com/en/blog/new-android-vulnerability-allows-attackers-modify-apps-without-affecting-their-signatures')
+
+        files_in_apk = set()
+        for info in inspection.zipfile.infolist():
+            name = info.filename
             if name.endswith('libcrypto.so') or name.endswith('libssl.so'):
-                lib = zf.open(name)
-                while True:
-                    chunk = lib.read(4096)
-                    if chunk == b'':
-                        break
-                    m = has_known_vulnerability.pattern.search(chunk)
-                    if m:
-                        version = m.group(1).decode('ascii')
-                        if (version.startswith('1.0.1') and len(version) > 5 and version[5] >= 'r') \
-                           or (version.startswith('1.0.2') and len(version) > 5 and version[5] >= 'f') \
-                           or re.match(r'[1-9]\.[1-9]\.[0-9].*', version):
-                            logging.debug(_('"{path}" contains recent {name} ({version})')
-                                          .format(path=filename, name=name, version=version))
-                        else:
-                            logging.warning(_('"{path}" contains outdated {name} ({version})')
-                                            .format(path=filename, name=name, version=version))
-                            found_vuln = True
-                        break
+                key = '{:08x}-{}'.format(info.CRC, info.file_size)
+                if key in library_scans:
+                    version = library_scans[key]
+                else:
+                    version = _find_openssl_version(inspection, info)
+                    library_scans[key] = version
+                if version is None:
+                    continue
+                if (version.startswith('1.0.1') and len(version) > 5 and version[5] >= 'r') \
+                   or (version.startswith('1.0.2') and len(version) > 5 and version[5] >= 'f') \
+                   or re.match(r'[1-9]\.[1-9]\.[0-9].*', version):
+                    logging.debug(_('"{path}" contains recent {name} ({version})')
+                                  .format(path=filename, name=name, version=version))
+                else:
+                    logging.warning(_('"{path}" contains outdated {name} ({version})')
+                                    .format(path=filename, name=name, version=version))
+                    found_vuln = True
             elif name == 'AndroidManifest.xml' or name == 'classes.dex' or name.endswith('.so'):
                 if name in files_in_apk:
                     logging.warning(_('{apkfilename} has multiple {name} files, looks like Master Key exploit!')
@@ -650,7 +964,7 @@ def has_known_vulnerability(filename):
     return found_vuln
 
 
-def insert_obbs(repodir, apps, apks):
+def insert_obbs(repodir, apps, apks, apkcache=None):
     """Scans the .obb files in a given repo directory and adds them to the
     relevant APK instances.  OBB files have versionCodes like APK
     files, and they are loosely associated.  If there is an OBB file
@@ -662,7 +976,9 @@ def insert_obbs(repodir, apps, apks):
 
     :param repodir: repo directory to scan
     :param apps: list of current, valid apps
-    :param apks: current information on all APKs
+    :param apks: current information on all APKs, as a list or common.RepoPackages
+    :param apkcache: current cached info about all repo files
+    :returns: True if the apkcache got changed
 
     """
 
@@ -672,7 +988,11 @@ def insert_obbs(repodir, apps, apks):
             logging.error(_("Deleting unknown file: {path}").format(path=f))
             os.remove(f)
 
-    obbs = []
+    if apkcache is None:
+        apkcache = dict()
+    apks = common.get_repo_packages(apks)
+    cachechanged = False
+    obbs = collections.defaultdict(list)
     java_Integer_MIN_VALUE = -pow(2, 31)
     currentPackageNames = apps.keys()
     for f in glob.glob(os.path.join(repodir, '*.obb')):
@@ -693,27 +1013,44 @@ def insert_obbs(repodir, apps, apks):
         if packagename not in currentPackageNames:
             obbWarnDelete(f, _("OBB's packagename does not match a supported APK:"))
             continue
-        for apk in apks:
-            if packagename == apk['packageName'] and apk['versionCode'] > highestVersionCode:
+        for apk in apks.get(packagename):
+            if apk['versionCode'] > highestVersionCode:
                 highestVersionCode = apk['versionCode']
         if versionCode > highestVersionCode:
             obbWarnDelete(f, _('OBB file has newer versionCode({integer}) than any APK:')
                           .format(integer=str(versionCode)))
             continue
-        obbsha256 = sha256sum(f)
-        obbs.append((packagename, versionCode, obbfile, obbsha256))
-
-    for apk in apks:
-        for (packagename, versionCode, obbfile, obbsha256) in sorted(obbs, reverse=True):
-            if versionCode <= apk['versionCode'] and packagename == apk['packageName']:
-                if obbfile.startswith('main.') and 'obbMainFile' not in apk:
-                    apk['obbMainFile'] = obbfile
-                    apk['obbMainFileSha256'] = obbsha256
-                elif obbfile.startswith('patch.') and 'obbPatchFile' not in apk:
-                    apk['obbPatchFile'] = obbfile
-                    apk['obbPatchFileSha256'] = obbsha256
-            if 'obbMainFile' in apk and 'obbPatchFile' in apk:
-                break
+        cached = apkcache.get(obbfile)
+        if cached:
+            usecache, cachethis = check_cached_hash(cached, f)
+            cachechanged = cachechanged or cachethis
+        else:
+            usecache = False
+        if not usecache:
+            cached = collections.OrderedDict()
+            cached['hash'] = sha256sum(f)
+            cached['hashType'] = 'sha256'
+            cached['stat_fingerprint'] = get_stat_fingerprint(f)
+            apkcache[obbfile] = cached
+            cachechanged = True
+        obbsha256 = cached['hash']
+        obbs[packagename].append((versionCode, obbfile, obbsha256))
+
+    for packagename, packageobbs in obbs.items():
+        packageobbs.sort(reverse=True)
+        for apk in apks.get(packagename):
+            for (versionCode, obbfile, obbsha256) in packageobbs:
+                if versionCode <= apk['versionCode']:
+                    if obbfile.startswith('main.') and 'obbMainFile' not in apk:
+                        apk['obbMainFile'] = obbfile
+                        apk['obbMainFileSha256'] = obbsha256
+                    elif obbfile.startswith('patch.') and 'obbPatchFile' not in apk:
+                        apk['obbPatchFile'] = obbfile
+                        apk['obbPatchFileSha256'] = obbsha256
+                if 'obbMainFile' in apk and 'obbPatchFile' in apk:
+                    break
+
+    return cachechanged
 
 
 def translate_per_build_anti_features(apps, apks):
@@ -794,20 +1131,19 @@ def _strip_and_copy_image(in_file, outpath):
 
     Potential source of Python code to strip JPEGs without dependencies:
     http://www.fetidcascade.com/public/minimal_exif_writer.py
+
+    :returns: True if the output file is now up to date, False if copying failed
     """
     logging.debug('copying ' + in_file + ' ' + outpath)
 
-    if os.path.isdir(outpath):
-        out_file = os.path.join(outpath, os.path.basename(in_file))
-    else:
-        out_file = outpath
+    out_file = _get_image_out_file(in_file, outpath)
 
     if os.path.exists(out_file):
         in_stat = os.stat(in_file)
         out_stat = os.stat(out_file)
         if in_stat.st_size == out_stat.st_size \
            and in_stat.st_mtime == out_stat.st_mtime:
-            return
+            return True
 
     extension = common.get_extension(in_file)[1]
     if extension == 'png':
@@ -818,23 +1154,109 @@ def _strip_and_copy_image(in_file, outpath):
                               pnginfo=BLANK_PNG_INFO, icc_profile=None)
         except Exception as e:
             logging.error(_("Failed copying {path}: {error}".format(path=in_file, error=e)))
-            return
+            return False
     elif extension == 'jpg' or extension == 'jpeg':
         try:
             with open(in_file, 'rb') as fp:
                 in_image = Image.open(fp)
-                data = list(in_image.getdata())
+                # a new image gets only the pixels, none of the metadata
                 out_image = Image.new(in_image.mode, in_image.size)
-            out_image.putdata(data)
+                out_image.paste(in_image)
             out_image.save(out_file, "JPEG", optimize=True)
         except Exception as e:
             logging.error(_("Failed copying {path}: {error}".format(path=in_file, error=e)))
-            return
+            return False
     else:
         raise FDroidException(_('Unsupported file type "{extension}" for repo graphic')
                               .format(extension=extension))
     stat_result = os.stat(in_file)
     os.utime(out_file, times=(stat_result.st_atime, stat_result.st_mtime))
+    return True
+
+
+def _get_image_out_file(in_file, outpath):
+    if os.path.isdir(outpath):
+        return os.path.join(outpath, os.path.basename(in_file))
+    return outpath
+
+
+def _strip_and_copy_image_job(in_file, out_file, cached):
+    """Strip and copy an image, unless its manifest entry shows it is current
+
+    :param cached: the manifest entry of out_file from the last run, or None
+    :returns: the new manifest entry, or None if copying failed
+    """
+    if cached and os.path.exists(out_file) \
+       and cached.get('output_stat_fingerprint') == get_stat_fingerprint(out_file):
+        usecache, _cachechanged = check_cached_hash(cached, in_file)
+        if usecache:
+            logging.debug(_('{path} is unchanged, not copying it again').format(path=in_file))
+            return cached
+    if not _strip_and_copy_image(in_file, out_file):
+        return None
+    entry = collections.OrderedDict()
+    entry['hash'] = sha256sum(in_file)
+    entry['hashType'] = 'sha256'
+    entry['stat_fingerprint'] = get_stat_fingerprint(in_file)
+    entry['output_stat_fingerprint'] = get_stat_fingerprint(out_file)
+    return entry
+
+
+STORE_GRAPHICS_PREFIX = 'store_graphics/'
+
+
+def strip_and_copy_images(copies, apkcache=None, jobs=1):
+    """Strip the metadata from many images and copy them into the repo
+
+    Re-encoding images is slow, so this keeps a manifest in the APK
+    cache with the content hash of the source of each output file.
+    Each output file has its own entry, named by STORE_GRAPHICS_PREFIX
+    and its path.  Images are only stripped and copied again when their source
+    content or the output file changed, and the rest are spread over
+    a pool of worker processes.
+
+    :param copies: list of (in_file, outpath) like _strip_and_copy_image()
+                   takes, when several copy to the same file the last one wins
+    :param apkcache: current cached info about all repo files
+    :param jobs: number of worker processes to use
+    :returns: True if the apkcache got changed
+    """
+    if apkcache is None:
+        apkcache = dict()
+    manifest = ApkCacheSection(apkcache, STORE_GRAPHICS_PREFIX)
+    cachechanged = False
+
+    todo = collections.OrderedDict()
+    for in_file, outpath in copies:
+        out_file = _get_image_out_file(in_file, outpath)
+        todo.pop(out_file, None)
+        todo[out_file] = in_file
+    for out_file in list(manifest):
+        if out_file not in todo and not os.path.exists(out_file):
+            del manifest[out_file]
+            cachechanged = True
+    if not todo:
+        return cachechanged
+
+    out_files = list(todo)
+    in_files = [todo[f] for f in out_files]
+    # pass copies, the workers or check_cached_hash() might change the entries
+    cached = [copy.copy(manifest.get(f)) for f in out_files]
+    if jobs > 1 and len(out_files) > 1:
+        with _get_process_pool(jobs) as pool:
+            entries = list(pool.map(_strip_and_copy_image_job, in_files, out_files, cached,
+                                    chunksize=max(1, len(out_files) // (jobs * 4))))
+    else:
+        entries = list(map(_strip_and_copy_image_job, in_files, out_files, cached))
+
+    for out_file, entry in zip(out_files, entries):
+        if entry is None:
+            if manifest.pop(out_file, None) is not None:
+                cachechanged = True
+        elif manifest.get(out_file) != entry:
+            manifest[out_file] = entry
+            cachechanged = True
+    return cachechanged
 
 
 def _get_base_hash_extension(f):
@@ -847,7 +1269,7 @@ def _get_base_hash_extension(f):
     return base, None, extension
 
 
-def copy_triple_t_store_metadata(apps):
+def copy_triple_t_store_metadata(apps, apkcache=None, jobs=1):
     """Include store metadata from the app's source repo
 
     The Triple-T Gradle Play Publisher is a plugin that has a standard
@@ -865,10 +1287,16 @@ def copy_triple_t_store_metadata(apps):
     https://github.com/Triple-T/gradle-play-publisher/blob/1.2.2/README.md#play-store-metadata
     https://github.com/Triple-T/gradle-play-publisher/blob/2.1.0/README.md#publishing-listings
 
+    :param apkcache: current cached info about all repo files
+    :param jobs: number of worker processes to use for copying graphics
+    :returns: True if the apkcache got changed
+
     """
 
     if not os.path.isdir('build'):
-        return  # nothing to do
+        return False  # nothing to do
+
+    copies = []
 
     tt_graphic_names = ('feature-graphic', 'icon', 'promo-graphic', 'tv-banner')
     tt_screenshot_dirs = ('phone-screenshots', 'tablet-screenshots',
@@ -965,10 +1393,12 @@ def copy_triple_t_store_metadata(apps):
                         os.makedirs(destdir, mode=0o755, exist_ok=True)
                         sourcefile = os.path.join(root, f)
                         destfile = os.path.join(destdir, repofilename)
-                        _strip_and_copy_image(sourcefile, destfile)
+                        copies.append((sourcefile, destfile))
+
+    return strip_and_copy_images(copies, apkcache, jobs)
 
 
-def insert_localized_app_metadata(apps):
+def insert_localized_app_metadata(apps, apkcache=None, jobs=1):
     """scans standard locations for graphics and localized text
 
     Scans for localized description files, changelogs, store graphics, and
@@ -995,6 +1425,10 @@ def insert_localized_app_metadata(apps):
 
     See also our documentation page:
     https://f-droid.org/en/docs/All_About_Descriptions_Graphics_and_Screenshots/#in-the-apps-build-metadata-in-an-fdroiddata-collection
+
+    :param apkcache: current cached info about all repo files
+    :param jobs: number of worker processes to use for copying graphics
+    :returns: True if the apkcache got changed
     """
 
     sourcedirs = glob.glob(os.path.join('build', '[A-Za-z]*', 'src', '[A-Za-z]*', 'fastlane', 'metadata', 'android', '[a-z][a-z]*'))
@@ -1002,6 +1436,7 @@ def insert_localized_app_metadata(apps):
     sourcedirs += glob.glob(os.path.join('build', '[A-Za-z]*', 'metadata', '[a-z][a-z]*'))
     sourcedirs += glob.glob(os.path.join('metadata', '[A-Za-z]*', '[a-z][a-z]*'))
 
+    copies = []
     for srcd in sorted(sourcedirs):
         if not os.path.isdir(srcd):
             continue
@@ -1053,7 +1488,7 @@ def insert_localized_app_metadata(apps):
                     destdir = os.path.join('repo', packageName, locale)
                 if base in GRAPHIC_NAMES and extension in ALLOWED_EXTENSIONS:
                     os.makedirs(destdir, mode=0o755, exist_ok=True)
-                    _strip_and_copy_image(os.path.join(root, f), destdir)
+                    copies.append((os.path.join(root, f), destdir))
             for d in dirs:
                 if d in SCREENSHOT_DIRS:
                     if locale == 'images':
@@ -1064,7 +1499,8 @@ def insert_localized_app_metadata(apps):
                         if extension in ALLOWED_EXTENSIONS:
                             screenshotdestdir = os.path.join(destdir, d)
                             os.makedirs(screenshotdestdir, mode=0o755, exist_ok=True)
-                            _strip_and_copy_image(f, screenshotdestdir)
+                            copies.append((f, screenshotdestdir))
+    cachechanged = strip_and_copy_images(copies, apkcache, jobs)
 
     repodirs = sorted(glob.glob(os.path.join('repo', '[A-Za-z]*', '[a-z][a-z]*')))
     for d in repodirs:
@@ -1111,6 +1547,8 @@ def insert_localized_app_metadata(apps):
             else:
                 logging.warning(_('Unsupported graphics file found: {path}').format(path=f))
 
+    return cachechanged
+
 
 def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
     """Scan a repo for all files with an extension except APK/OBB
@@ -1142,20 +1580,22 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
             raise FDroidException(_('{path} is zero size!')
                                   .format(path=filename))
 
-        shasum = sha256sum(filename)
         usecache = False
         if name_utf8 in apkcache:
             repo_file = apkcache[name_utf8]
-            if repo_file.get('hash') == shasum:
+            usecache, cachethis = check_cached_hash(repo_file, filename)
+            if usecache:
                 logging.debug(_("Reading {apkfilename} from cache")
                               .format(apkfilename=name_utf8))
-                usecache = True
+                cachechanged = cachechanged or cachethis
             else:
                 logging.debug(_("Ignoring stale cache data for {apkfilename}")
                               .format(apkfilename=name_utf8))
 
         if not usecache:
             logging.debug(_("Processing {apkfilename}").format(apkfilename=name_utf8))
+            stat_fingerprint = get_stat_fingerprint(filename)
+            shasum = sha256sum(filename)
             repo_file = collections.OrderedDict()
             repo_file['name'] = os.path.splitext(name_utf8)[0]
             # TODO rename apkname globally to something more generic
@@ -1175,6 +1615,7 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
             if os.path.exists(os.path.join(repodir, srcfilename)):
                 repo_file['srcname'] = srcfilename.decode()
             repo_file['size'] = stat.st_size
+            repo_file['stat_fingerprint'] = stat_fingerprint
 
             apkcache[name_utf8] = repo_file
             cachechanged = True
@@ -1196,16 +1637,27 @@ def scan_repo_files(apkcache, repodir, knownapks, use_date_from_file=False):
     return repo_files, cachechanged
 
 
-def scan_apk(apk_file):
+def scan_apk(apk_file, library_scans=None):
     """
     Scans an APK file and returns dictionary with metadata of the APK.
 
     Attention: This does *not* verify that the APK signature is correct.
 
-    :param apk_file: The (ideally absolute) path to the APK file
+    The APK is opened and its ZIP structure parsed only once, then
+    shared by all of the checks using a common.ApkInspection.
+
+    :param apk_file: The (ideally absolute) path to the APK file,
+                     or a common.ApkInspection of it
+    :param library_scans: cached native library scans, see has_known_vulnerability()
     :raises BuildException
     :return A dict containing APK metadata
     """
+    with common.inspect_apk(apk_file) as inspection:
+        return _scan_apk_inspection(inspection, library_scans)
+
+
+def _scan_apk_inspection(inspection, library_scans=None):
+    apk_file = inspection.path
     apk = {
         'hash': sha256sum(apk_file),
         'hashType': 'sha256',
@@ -1218,9 +1670,9 @@ def scan_apk(apk_file):
     }
 
     if common.use_androguard():
-        scan_apk_androguard(apk, apk_file)
+        scan_apk_androguard(apk, apk_file, inspection)
     else:
-        scan_apk_aapt(apk, apk_file)
+        scan_apk_aapt(apk, apk_file, inspection)
 
     if not common.is_valid_package_name(apk['packageName']):
         raise BuildException(_("{appid} from {path} is not a valid Java Package Name!")
@@ -1231,11 +1683,10 @@ def scan_apk(apk_file):
 
     # Get the signature, or rather the signing key fingerprints
     logging.debug('Getting signature of {0}'.format(os.path.basename(apk_file)))
-    apk['sig'] = getsig(apk_file)
+    apk['sig'] = getsig(inspection)
     if not apk['sig']:
         raise BuildException("Failed to get apk signature")
-    apk['signer'] = common.apk_signer_fingerprint(os.path.join(os.getcwd(),
-                                                               apk_file))
+    apk['signer'] = common.apk_signer_fingerprint(inspection)
     if not apk.get('signer'):
         raise BuildException("Failed to get apk signing key fingerprint")
 
@@ -1247,7 +1698,7 @@ def scan_apk(apk_file):
         apk['minSdkVersion'] = 3  # aapt defaults to 3 as the min
 
     # Check for known vulnerabilities
-    if has_known_vulnerability(apk_file):
+    if has_known_vulnerability(inspection, library_scans):
         apk['antiFeatures'].add('KnownVuln')
 
     return apk
@@ -1261,11 +1712,12 @@ def _get_apk_icons_src(apkfile, icon_name):
     names they make up.  Android will just ignore them, so we should
     too.
 
+    :param apkfile: path to the APK, or a common.ApkInspection of it
     """
     icons_src = dict()
     density_re = re.compile(r'^res/(.*)/{}\.(png|xml)$'.format(icon_name))
-    with zipfile.ZipFile(apkfile) as zf:
-        for filename in zf.namelist():
+    with common.inspect_apk(apkfile) as inspection:
+        for filename in inspection.zipfile.namelist():
             m = density_re.match(filename)
             if m:
                 folder = m.group(1).split('-')
@@ -1279,7 +1731,7 @@ def _get_apk_icons_src(apkfile, icon_name):
     return icons_src
 
 
-def scan_apk_aapt(apk, apkfile):
+def scan_apk_aapt(apk, apkfile, inspection=None):
     p = SdkToolsPopen(['aapt', 'dump', 'badging', apkfile], output=False)
     if p.returncode != 0:
         if options.delete_unknown:
@@ -1353,7 +1805,7 @@ def scan_apk_aapt(apk, apkfile):
                 if feature.startswith("android.feature."):
                     feature = feature[16:]
                 apk['features'].add(feature)
-    apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name)
+    apk['icons_src'] = _get_apk_icons_src(inspection or apkfile, icon_name)
 
 
 def _sanitize_sdk_version(value):
@@ -1377,7 +1829,7 @@ def _sanitize_sdk_version(value):
     return None
 
 
-def scan_apk_androguard(apk, apkfile):
+def scan_apk_androguard(apk, apkfile, inspection=None):
     try:
         from androguard.core.bytecodes.apk import APK
         apkobject = APK(apkfile)
@@ -1446,7 +1898,7 @@ def scan_apk_androguard(apk, apkfile):
         else:
             # don't use 'anydpi' aka 0xFFFE aka 65534 since it is XML
             icon_name = os.path.splitext(os.path.basename(apkobject.get_app_icon(max_dpi=65534 - 1)))[0]
-        apk['icons_src'] = _get_apk_icons_src(apkfile, icon_name)
+        apk['icons_src'] = _get_apk_icons_src(inspection or apkfile, icon_name)
 
     arch_re = re.compile("^lib/(.*)/.*$")
     arch = set([arch_re.match(file).group(1) for file in apkobject.get_files() if arch_re.match(file)])
@@ -1494,8 +1946,158 @@ def scan_apk_androguard(apk, apkfile):
             apk['features'].append(feature)
 
 
+def scan_and_verify_apk(apkfile, repodir, allow_disabled_algorithms=False, library_scans=None):
+    """Scan a new APK file and verify its signature
+
+    This is the expensive part of processing an APK: hashing, parsing,
+    checking for known vulnerabilities and verifying the signature.
+    It only reads the APK file, so it is safe to run on many APKs in
+    parallel.
+
+    :param apkfile: path to the APK file, or a common.ApkInspection of it
+    :param repodir: repo directory the APK is in
+    :param allow_disabled_algorithms: allow APKs with valid signatures that include
+                                      disabled algorithms in the signature (e.g. MD5)
+    :param library_scans: cached native library scans, see has_known_vulnerability()
+    :returns: (apk, verified) where apk is the scanned apk information or None
+              if the APK could not be scanned, and verified is True if the
+              signature is valid
+    """
+    # the scans this APK uses are kept in the cache as long as it is
+    used_library_scans = ApkCacheSection(dict() if library_scans is None else library_scans, '')
+    with common.inspect_apk(apkfile) as inspection:
+        apkfile = inspection.path
+        try:
+            apk = scan_apk(inspection, used_library_scans)
+        except BuildException:
+            return None, False
+        if used_library_scans.seen:
+            apk['native_library_scans'] = sorted(used_library_scans.seen)
+
+        # Check for debuggable apks...
+        if common.is_apk_and_debuggable(inspection):
+            logging.warning('{0} is set to android:debuggable="true"'.format(apkfile))
+
+    # verify the jar signature is correct, allow deprecated
+    # algorithms only if the APK is in the archive.
+    verified = True
+    if not common.verify_apk_signature(apkfile):
+        if repodir == 'archive' or allow_disabled_algorithms:
+            if common.verify_old_apk_signature(apkfile):
+                apk['antiFeatures'].update(['KnownVuln', 'DisabledAlgorithm'])
+            else:
+                verified = False
+        else:
+            verified = False
+
+    return apk, verified
+
+
+def _place_scanned_apk(apk, apkfilename, repodir, verified, archive_bad_sig):
+    """Rename a freshly scanned APK if requested, and set its file names
+
+    :returns: the final filename of the APK, or None if it should be skipped
+    """
+    apkfile = os.path.join(repodir, apkfilename)
+    if options.rename_apks:
+        n = apk['packageName'] + '_' + str(apk['versionCode']) + '.apk'
+        std_short_name = os.path.join(repodir, n)
+        if apkfile != std_short_name:
+            if os.path.exists(std_short_name):
+                std_long_name = std_short_name.replace('.apk', '_' + apk['sig'][:7] + '.apk')
+                if apkfile != std_long_name:
+                    if os.path.exists(std_long_name):
+                        dupdir = os.path.join('duplicates', repodir)
+                        if not os.path.isdir(dupdir):
+                            os.makedirs(dupdir, exist_ok=True)
+                        dupfile = os.path.join('duplicates', std_long_name)
+                        logging.warning('Moving duplicate ' + std_long_name + ' to ' + dupfile)
+                        os.rename(apkfile, dupfile)
+                        return None
+                    else:
+                        os.rename(apkfile, std_long_name)
+                apkfile = std_long_name
+            else:
+                os.rename(apkfile, std_short_name)
+                apkfile = std_short_name
+            apkfilename = apkfile[len(repodir) + 1:]
+
+    apk['apkName'] = apkfilename
+    srcfilename = apkfilename[:-4] + "_src.tar.gz"
+    if os.path.exists(os.path.join(repodir, srcfilename)):
+        apk['srcname'] = srcfilename
+
+    if not verified:
+        if archive_bad_sig:
+            logging.warning(_('Archiving {apkfilename} with invalid signature!')
+                            .format(apkfilename=apkfilename))
+            move_apk_between_sections(repodir, 'archive', apk)
+        else:
+            logging.warning(_('Skipping {apkfilename} with invalid signature!')
+                            .format(apkfilename=apkfilename))
+        return None
+
+    return apkfilename
+
+
+def _extract_icons_from_apk_file(apk, repodir, inspection=None):
+    """Extract the icons from an APK file and check its manifest date
+
+    :param inspection: an already open common.ApkInspection of the APK
+    :returns: the date_time of AndroidManifest.xml in the APK
+    """
+    apkfile = os.path.join(repodir, apk['apkName'])
+    iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
+    with common.inspect_apk(inspection or apkfile) as inspection:
+        apkzip = inspection.zipfile
+        manifest = apkzip.getinfo('AndroidManifest.xml')
+        # 1980-0-0 means zeroed out, any other invalid date should trigger a warning
+        if (1980, 0, 0) != manifest.date_time[0:3]:
+            try:
+                common.check_system_clock(datetime(*manifest.date_time), apk['apkName'])
+            except ValueError as e:
+                logging.warning(_("{apkfilename}'s AndroidManifest.xml has a bad date: ")
+                                .format(apkfilename=apkfile) + str(e))
+
+        # extract icons from APK zip file
+        empty_densities = extract_apk_icons(iconfilename, apk, apkzip, repodir)
+
+    # resize existing icons for densities missing in the APK
+    fill_missing_icon_densities(empty_densities, iconfilename, apk, repodir)
+
+    return manifest.date_time
+
+
+def _extract_icons_from_apk_files(apks, repodir):
+    """Extract the icons from APKs which all share the same icon filename
+
+    This is the unit of work for parallel icon extraction.  Since APKs
+    with the same packageName and versionCode write to the same icon
+    files, they are handled in order by a single worker.
+
+    :returns: a list of (apk, manifest date_time) in the same order as apks
+    """
+    return [(apk, _extract_icons_from_apk_file(apk, repodir)) for apk in apks]
+
+
+def _record_new_apk(apkcache, knownapks, apk, manifest_date_time, use_date_from_apk):
+    """Add a newly processed APK to the known APKs and the APK cache"""
+    if use_date_from_apk and manifest_date_time[1] != 0:
+        default_date_param = datetime(*manifest_date_time)
+    else:
+        default_date_param = None
+
+    # Record in known apks, getting the added date at the same time..
+    added = knownapks.recordapk(apk['apkName'], apk['packageName'],
+                                default_date=default_date_param)
+    if added:
+        apk['added'] = added
+
+    apkcache[apk['apkName']] = apk
+
+
 def process_apk(apkcache, apkfilename, repodir, knownapks, use_date_from_apk=False,
-                allow_disabled_algorithms=False, archive_bad_sig=False):
+                allow_disabled_algorithms=False, archive_bad_sig=False, library_scans=None):
     """Processes the apk with the given filename in the given repo directory.
 
     This also extracts the icons.
@@ -1509,6 +2111,7 @@ def process_apk(apkcache, apkfilename, repodir, knownapks, use_date_from_apk=Fal
     :param allow_disabled_algorithms: allow APKs with valid signatures that include
                                       disabled algorithms in the signature (e.g. MD5)
     :param archive_bad_sig: move APKs with a bad signature to the archive
+    :param library_scans: cached native library scans, from get_library_scans()
     :returns: (skip, apk, cachechanged) where skip is a boolean indicating whether to skip this apk,
      apk is the scanned apk information, and cachechanged is True if the apkcache got changed.
     """
@@ -1520,10 +2123,10 @@ def process_apk(apkcache, apkfilename, repodir, knownapks, use_date_from_apk=Fal
     usecache = False
     if apkfilename in apkcache:
         apk = apkcache[apkfilename]
-        if apk.get('hash') == sha256sum(apkfile):
+        usecache, cachechanged = check_cached_hash(apk, apkfile)
+        if usecache:
             logging.debug(_("Reading {apkfilename} from cache")
                           .format(apkfilename=apkfilename))
-            usecache = True
         else:
             logging.debug(_("Ignoring stale cache data for {apkfilename}")
                           .format(apkfilename=apkfilename))
@@ -1531,106 +2134,152 @@ def process_apk(apkcache, apkfilename, repodir, knownapks, use_date_from_apk=Fal
     if not usecache:
         logging.debug(_("Processing {apkfilename}").format(apkfilename=apkfilename))
 
-        try:
-            apk = scan_apk(apkfile)
-        except BuildException:
-            logging.warning(_("Skipping '{apkfilename}' with invalid signature!")
-                            .format(apkfilename=apkfilename))
-            return True, None, False
+        if library_scans is None:
+            library_scans = get_library_scans(apkcache)
+        stat_fingerprint = get_stat_fingerprint(apkfile)
+        with common.ApkInspection(apkfile) as inspection:
+            apk, verified = scan_and_verify_apk(inspection, repodir, allow_disabled_algorithms,
+                                                library_scans)
+            if apk is None:
+                logging.warning(_("Skipping '{apkfilename}' with invalid signature!")
+                                .format(apkfilename=apkfilename))
+                return True, None, False
+            apk['stat_fingerprint'] = stat_fingerprint
 
-        # Check for debuggable apks...
-        if common.is_apk_and_debuggable(apkfile):
-            logging.warning('{0} is set to android:debuggable="true"'.format(apkfile))
+            if _place_scanned_apk(apk, apkfilename, repodir, verified, archive_bad_sig) is None:
+                return True, None, False
 
-        if options.rename_apks:
-            n = apk['packageName'] + '_' + str(apk['versionCode']) + '.apk'
-            std_short_name = os.path.join(repodir, n)
-            if apkfile != std_short_name:
-                if os.path.exists(std_short_name):
-                    std_long_name = std_short_name.replace('.apk', '_' + apk['sig'][:7] + '.apk')
-                    if apkfile != std_long_name:
-                        if os.path.exists(std_long_name):
-                            dupdir = os.path.join('duplicates', repodir)
-                            if not os.path.isdir(dupdir):
-                                os.makedirs(dupdir, exist_ok=True)
-                            dupfile = os.path.join('duplicates', std_long_name)
-                            logging.warning('Moving duplicate ' + std_long_name + ' to ' + dupfile)
-                            os.rename(apkfile, dupfile)
-                            return True, None, False
-                        else:
-                            os.rename(apkfile, std_long_name)
-                    apkfile = std_long_name
-                else:
-                    os.rename(apkfile, std_short_name)
-                    apkfile = std_short_name
-                apkfilename = apkfile[len(repodir) + 1:]
-
-        apk['apkName'] = apkfilename
-        srcfilename = apkfilename[:-4] + "_src.tar.gz"
-        if os.path.exists(os.path.join(repodir, srcfilename)):
-            apk['srcname'] = srcfilename
-
-        # verify the jar signature is correct, allow deprecated
-        # algorithms only if the APK is in the archive.
-        skipapk = False
-        if not common.verify_apk_signature(apkfile):
-            if repodir == 'archive' or allow_disabled_algorithms:
-                if common.verify_old_apk_signature(apkfile):
-                    apk['antiFeatures'].update(['KnownVuln', 'DisabledAlgorithm'])
-                else:
-                    skipapk = True
-            else:
-                skipapk = True
+            manifest_date_time = _extract_icons_from_apk_file(apk, repodir, inspection)
+        _record_new_apk(apkcache, knownapks, apk, manifest_date_time, use_date_from_apk)
+        cachechanged = True
 
-        if skipapk:
-            if archive_bad_sig:
-                logging.warning(_('Archiving {apkfilename} with invalid signature!')
-                                .format(apkfilename=apkfilename))
-                move_apk_between_sections(repodir, 'archive', apk)
-            else:
-                logging.warning(_('Skipping {apkfilename} with invalid signature!')
-                                .format(apkfilename=apkfilename))
-            return True, None, False
+    return False, apk, cachechanged
 
-        apkzip = zipfile.ZipFile(apkfile, 'r')
 
-        manifest = apkzip.getinfo('AndroidManifest.xml')
-        # 1980-0-0 means zeroed out, any other invalid date should trigger a warning
-        if (1980, 0, 0) != manifest.date_time[0:3]:
-            try:
-                common.check_system_clock(datetime(*manifest.date_time), apkfilename)
-            except ValueError as e:
-                logging.warning(_("{apkfilename}'s AndroidManifest.xml has a bad date: ")
-                                .format(apkfilename=apkfile) + str(e))
+# the native library scans in a worker process, see _scan_and_verify_apk_job()
+_worker_library_scans = dict()
 
-        # extract icons from APK zip file
-        iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
-        try:
-            empty_densities = extract_apk_icons(iconfilename, apk, apkzip, repodir)
-        finally:
-            apkzip.close()  # ensure that APK zip file gets closed
 
-        # resize existing icons for densities missing in the APK
-        fill_missing_icon_densities(empty_densities, iconfilename, apk, repodir)
+def _init_worker(update_config, update_options, common_config, common_options, library_scans=None):
+    """Set up the global state in a worker process of a process pool"""
+    global config, options, _worker_library_scans
+    config = update_config
+    options = update_options
+    common.config = common_config
+    common.options = common_options
+    if library_scans is not None:
+        _worker_library_scans = library_scans
 
-        if use_date_from_apk and manifest.date_time[1] != 0:
-            default_date_param = datetime(*manifest.date_time)
-        else:
-            default_date_param = None
 
-        # Record in known apks, getting the added date at the same time..
-        added = knownapks.recordapk(apk['apkName'], apk['packageName'],
-                                    default_date=default_date_param)
-        if added:
-            apk['added'] = added
+def _scan_and_verify_apk_job(apkfile, repodir, allow_disabled_algorithms):
+    """Run scan_and_verify_apk() in a worker, also returning the library scans it used
+
+    The library scans of the worker were set once when the pool was
+    started, and the new ones are added to them.  The ones this APK
+    used, old or new, are returned so they are kept in the APK cache.
+    """
+    library_scans = ApkCacheSection(_worker_library_scans, '')
+    apk, verified = scan_and_verify_apk(apkfile, repodir, allow_disabled_algorithms, library_scans)
+    return apk, verified, {key: _worker_library_scans[key] for key in library_scans.seen}
+
+
+def _get_process_pool(jobs, library_scans=None):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                  initializer=_init_worker,
+                                                  initargs=(config, options,
+                                                            common.config, common.options,
+                                                            library_scans))
+
 
-        apkcache[apkfilename] = apk
+def process_apks_parallel(apkcache, repodir, knownapks, use_date_from_apk, jobs, library_scans=None):
+    """Processes the apks in the given repo directory using a pool of workers
+
+    New APKs are scanned and verified in parallel, then they are
+    renamed, archived or skipped in sorted order, then their icons are
+    extracted in parallel.  Finally, the results are merged into the
+    APK cache and known APKs in sorted order, so the results are the
+    same as when processing the APKs one at a time.
+
+    The native library scans are sent to each worker once, when the
+    pool is started.
+
+    :returns: (apks, cachechanged) where apks is a list of apk information,
+              and cachechanged is True if the apkcache got changed.
+    """
+    cachechanged = False
+    ada = disabled_algorithms_allowed()
+
+    apkfilenames = []
+    newapkfilenames = []
+    for apkfile in sorted(glob.glob(os.path.join(repodir, '*.apk'))):
+        apkfilename = apkfile[len(repodir) + 1:]
+        apkfilenames.append(apkfilename)
+        usecache = False
+        if apkfilename in apkcache:
+            usecache, cachethis = check_cached_hash(apkcache[apkfilename], apkfile)
+            if usecache:
+                logging.debug(_("Reading {apkfilename} from cache")
+                              .format(apkfilename=apkfilename))
+                cachechanged = cachechanged or cachethis
+            else:
+                logging.debug(_("Ignoring stale cache data for {apkfilename}")
+                              .format(apkfilename=apkfilename))
+        if not usecache:
+            newapkfilenames.append(apkfilename)
+
+    if not newapkfilenames:
+        return [apkcache[f] for f in apkfilenames], cachechanged
+
+    if library_scans is None:
+        library_scans = get_library_scans(apkcache)
+    with _get_process_pool(jobs, library_scans.snapshot()) as pool:
+        newapkfiles = [os.path.join(repodir, f) for f in newapkfilenames]
+        stat_fingerprints = [get_stat_fingerprint(f) for f in newapkfiles]
+        scanned = dict()
+        for apkfilename, stat_fingerprint, (apk, verified, used_library_scans) in zip(
+                newapkfilenames, stat_fingerprints,
+                pool.map(_scan_and_verify_apk_job, newapkfiles, itertools.repeat(repodir),
+                         itertools.repeat(ada))):
+            scanned[apkfilename] = (apk, verified), stat_fingerprint
+            library_scans.update(used_library_scans)
+
+        apks = []
+        newapks = collections.OrderedDict()
+        for apkfilename in apkfilenames:
+            if apkfilename not in scanned:
+                apks.append(apkcache[apkfilename])
+                continue
+            logging.debug(_("Processing {apkfilename}").format(apkfilename=apkfilename))
+            (apk, verified), stat_fingerprint = scanned[apkfilename]
+            if apk is None:
+                logging.warning(_("Skipping '{apkfilename}' with invalid signature!")
+                                .format(apkfilename=apkfilename))
+                continue
+            apk['stat_fingerprint'] = stat_fingerprint
+            if _place_scanned_apk(apk, apkfilename, repodir, verified, True) is None:
+                continue
+            iconfilename = "%s.%s" % (apk['packageName'], apk['versionCode'])
+            newapks.setdefault(iconfilename, []).append(len(apks))
+            apks.append(apk)
+
+        groups = list(newapks.values())
+        results = pool.map(_extract_icons_from_apk_files,
+                           [[apks[i] for i in group] for group in groups],
+                           itertools.repeat(repodir))
+        manifest_date_times = dict()
+        for group, result in zip(groups, results):
+            for i, (apk, manifest_date_time) in zip(group, result):
+                apks[i] = apk
+                manifest_date_times[i] = manifest_date_time
+
+    for i in sorted(manifest_date_times):
+        _record_new_apk(apkcache, knownapks, apks[i], manifest_date_times[i], use_date_from_apk)
         cachechanged = True
 
-    return False, apk, cachechanged
+    return apks, cachechanged
 
 
-def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
+def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False, jobs=1, library_scans=None):
     """Processes the apks in the given repo directory.
 
     This also extracts the icons.
@@ -1640,6 +2289,8 @@ def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
     :param knownapks: known apks info
     :param use_date_from_apk: use date from APK (instead of current date)
                               for newly added APKs
+    :param jobs: number of worker processes to use for new APKs
+    :param library_scans: cached native library scans, from get_library_scans()
     :returns: (apks, cachechanged) where apks is a list of apk information,
               and cachechanged is True if the apkcache got changed.
     """
@@ -1654,12 +2305,18 @@ def process_apks(apkcache, repodir, knownapks, use_date_from_apk=False):
         else:
             os.makedirs(icon_dir)
 
+    if library_scans is None:
+        library_scans = get_library_scans(apkcache)
+    if jobs > 1:
+        return process_apks_parallel(apkcache, repodir, knownapks, use_date_from_apk, jobs,
+                                     library_scans)
+
     apks = []
     for apkfile in sorted(glob.glob(os.path.join(repodir, '*.apk'))):
         apkfilename = apkfile[len(repodir) + 1:]
         ada = disabled_algorithms_allowed()
         (skip, apk, cachethis) = process_apk(apkcache, apkfilename, repodir, knownapks,
-                                             use_date_from_apk, ada, True)
+                                             use_date_from_apk, ada, True, library_scans)
         if skip:
             continue
         apks.append(apk)
@@ -1832,23 +2489,25 @@ def apply_info_from_latest_apk(apps, apks):
     Some information from the apks needs to be applied up to the application level.
     When doing this, we use the info from the most recent version's apk.
     We deal with figuring out when the app was added and last updated at the same time.
+
+    :param apks: the APKs, as a list or common.RepoPackages
     """
+    apks = common.get_repo_packages(apks)
     for appid, app in apps.items():
         bestver = UNSET_VERSION_CODE
-        for apk in apks:
-            if apk['packageName'] == appid:
-                if apk['versionCode'] > bestver:
-                    bestver = apk['versionCode']
-                    bestapk = apk
+        for apk in apks.get(appid):
+            if apk['versionCode'] > bestver:
+                bestver = apk['versionCode']
+                bestapk = apk
 
-                if app.NoSourceSince:
-                    apk['antiFeatures'].add('NoSourceSince')
+            if app.NoSourceSince:
+                apk['antiFeatures'].add('NoSourceSince')
 
-                if 'added' in apk:
-                    if not app.added or apk['added'] < app.added:
-                        app.added = apk['added']
-                    if not app.lastUpdated or apk['added'] > app.lastUpdated:
-                        app.lastUpdated = apk['added']
+            if 'added' in apk:
+                if not app.added or apk['added'] < app.added:
+                    app.added = apk['added']
+                if not app.lastUpdated or apk['added'] > app.lastUpdated:
+                    app.lastUpdated = apk['added']
 
         if not app.added:
             logging.debug("Don't know when " + appid + " was added")
@@ -1878,17 +2537,84 @@ def make_categories_txt(repodir, categories):
         f.write(catdata)
 
 
+def _write_compressed_sidecar(source, sidecar):
+    """Write a .gz or .br copy of source, with the same mtime
+
+    The gzip header gets neither a file name nor a timestamp, so the
+    output only depends on the contents, like it does with brotli.
+    """
+    with open(source, 'rb') as fp:
+        data = fp.read()
+    tmpfile = sidecar + '.new'
+    with open(tmpfile, 'wb') as fp:
+        if sidecar.endswith('.gz'):
+            with gzip.GzipFile(filename='', mode='wb', fileobj=fp, compresslevel=9, mtime=0) as gz:
+                gz.write(data)
+        else:
+            fp.write(brotli.compress(data, mode=brotli.MODE_TEXT))
+    stat = os.stat(source)
+    os.utime(tmpfile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmpfile, sidecar)
+
+
+def write_compressed_sidecars(repodir, jobs=1):
+    """Write precompressed .gz and .br copies of the text files in repodir
+
+    Web servers can then send those as they are, e.g. with nginx's
+    gzip_static, instead of compressing the index on every request.
+    Each copy gets the mtime of its source, so it is only written again
+    when the source changed, and copies of removed files are deleted.
+    The .br copies need the optional brotli module.
+
+    :param jobs: number of worker processes to use
+    """
+    extensions = ['.gz']
+    if brotli is not None:
+        extensions.append('.br')
+    todo = []
+    for root, dirs, files in os.walk(repodir):
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            if f.endswith(COMPRESSED_SIDECAR_EXTENSIONS):
+                source = path[:-3]
+                if source.endswith(TEXT_ARTIFACT_EXTENSIONS) and not os.path.exists(source):
+                    os.remove(path)
+                continue
+            if not f.endswith(TEXT_ARTIFACT_EXTENSIONS):
+                continue
+            mtime = os.stat(path).st_mtime_ns
+            for extension in extensions:
+                sidecar = path + extension
+                if not os.path.exists(sidecar) or os.stat(sidecar).st_mtime_ns != mtime:
+                    todo.append((path, sidecar))
+
+    if jobs > 1 and len(todo) > 1:
+        with _get_process_pool(jobs) as pool:
+            list(pool.map(_write_compressed_sidecar, *zip(*todo)))
+    else:
+        for source, sidecar in todo:
+            _write_compressed_sidecar(source, sidecar)
+
+
 def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversions):
+    """Move APKs between the repo and the archive according to the ArchivePolicy
+
+    Unlike the other functions here, this does not take plain lists:
+    both sections have to be a common.RepoPackages, since the APKs are
+    moved between them in place.
+
+    :param apks: the common.RepoPackages of the repo, updated in place
+    :param archapks: the common.RepoPackages of the archive, updated in place
+    """
 
     def filter_apk_list_sorted(apk_list):
         res = []
         currentVersionApk = None
         for apk in apk_list:
-            if apk['packageName'] == appid:
-                if apk['versionCode'] == common.version_code_string_to_int(app.CurrentVersionCode):
-                    currentVersionApk = apk
-                    continue
-                res.append(apk)
+            if apk['versionCode'] == common.version_code_string_to_int(app.CurrentVersionCode):
+                currentVersionApk = apk
+                continue
+            res.append(apk)
 
         # Sort the apk list by version code. First is highest/newest.
         sorted_list = sorted(res, key=lambda apk: apk['versionCode'], reverse=True)
@@ -1907,7 +2633,7 @@ def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversi
         logging.debug(_("Checking archiving for {appid} - apks:{integer}, keepversions:{keep}, archapks:{arch}")
                       .format(appid=appid, integer=len(apks), keep=keepversions, arch=len(archapks)))
 
-        all_app_apks = filter_apk_list_sorted(apks + archapks)
+        all_app_apks = filter_apk_list_sorted(apks.get(appid) + archapks.get(appid))
 
         # determine which apks to keep in repo
         keep = []
@@ -2064,6 +2790,10 @@ def main():
                         help=_("Produce human-readable XML/JSON for index files"))
     parser.add_argument("--clean", action="store_true", default=False,
                         help=_("Clean update - don't uses caches, reprocess all APKs"))
+    parser.add_argument("--verify-hashes", action="store_true", default=False,
+                        help=_("Rehash all files instead of trusting cached hashes of unchanged files"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Number of parallel processes to use for scanning new APKs and writing indexes"))
     parser.add_argument("--nosign", action="store_true", default=False,
                         help=_("When configured for signed indexes, create only unsigned indexes at this stage"))
     parser.add_argument("--use-date-from-apk", action="store_true", default=False,
@@ -2147,7 +2877,9 @@ def main():
     delete_disabled_builds(apps, apkcache, repodirs)
 
     # Scan all apks in the main repo
-    apks, cachechanged = process_apks(apkcache, repodirs[0], knownapks, options.use_date_from_apk)
+    library_scans = get_library_scans(apkcache)
+    apks, cachechanged = process_apks(apkcache, repodirs[0], knownapks,
+                                      options.use_date_from_apk, options.jobs, library_scans)
 
     files, fcachechanged = scan_repo_files(apkcache, repodirs[0], knownapks,
                                            options.use_date_from_apk)
@@ -2172,19 +2904,31 @@ def main():
                 else:
                     logging.warn(msg + '\n\t' + _("Use `fdroid update -c` to create it."))
 
-    copy_triple_t_store_metadata(apps)
-    insert_obbs(repodirs[0], apps, apks)
-    insert_localized_app_metadata(apps)
+    apks = common.RepoPackages(apks)
+
+    if copy_triple_t_store_metadata(apps, apkcache, options.jobs):
+        cachechanged = True
+    if insert_obbs(repodirs[0], apps, apks, apkcache):
+        cachechanged = True
+    if insert_localized_app_metadata(apps, apkcache, options.jobs):
+        cachechanged = True
     translate_per_build_anti_features(apps, apks)
 
     # Scan the archive repo for apks as well
     if len(repodirs) > 1:
-        archapks, cc = process_apks(apkcache, repodirs[1], knownapks, options.use_date_from_apk)
+        archapks, cc = process_apks(apkcache, repodirs[1], knownapks,
+                                    options.use_date_from_apk, options.jobs, library_scans)
         if cc:
             cachechanged = True
     else:
         archapks = []
 
+    # only keep the scans of the native libraries in the APKs in the repo
+    if library_scans.prune(key for apk in itertools.chain(apks, archapks)
+                           for key in apk.get('native_library_scans', ())):
+        cachechanged = True
+    archapks = common.RepoPackages(archapks)
+
     # Apply information from latest apks to the application and update dates
     apply_info_from_latest_apk(apps, apks + archapks)
 
@@ -2197,29 +2941,40 @@ def main():
     # per-app subscription feeds for nightly builds and things like it
     if config['per_app_repos']:
         add_apks_to_per_app_repos(repodirs[0], apks)
+        sections = []
         for appid, app in apps.items():
             repodir = os.path.join(appid, 'fdroid', 'repo')
             appdict = dict()
             appdict[appid] = app
             if os.path.isdir(repodir):
-                index.make(appdict, [appid], apks, repodir, False)
+                sections.append(index.get_index_section(appdict, [appid], apks, repodir, False))
             else:
                 logging.info(_('Skipping index generation for {appid}').format(appid=appid))
+        index.make_sections(sections, options.jobs)
+        if config['make_compressed_sidecars']:
+            for section in sections:
+                write_compressed_sidecars(section[2])
+        metadata.write_description_cache()
         return
 
     if len(repodirs) > 1:
         archive_old_apks(apps, apks, archapks, repodirs[0], repodirs[1], config['archive_older'])
 
-    # Make the index for the main repo...
-    index.make(apps, sortedids, apks, repodirs[0], False)
+    # Gather the index for the main repo...
+    sections = [index.get_index_section(apps, sortedids, apks, repodirs[0], False)]
     make_categories_txt(repodirs[0], categories)
 
-    # If there's an archive repo,  make the index for it. We already scanned it
+    # If there's an archive repo,  gather the index for it. We already scanned it
     # earlier on.
     if len(repodirs) > 1:
-        archived_apps = copy.deepcopy(apps)
+        archived_apps = collections.OrderedDict()
+        for appid, app in apps.items():
+            archived_apps[appid] = metadata.AppOverlay(app)
         apply_info_from_latest_apk(archived_apps, archapks)
-        index.make(archived_apps, sortedids, archapks, repodirs[1], True)
+        sections.append(index.get_index_section(archived_apps, sortedids, archapks, repodirs[1], True))
+
+    # ...then write all of them at once, and sign them
+    index.make_sections(sections, options.jobs)
 
     git_remote = config.get('binary_transparency_remote')
     if git_remote or os.path.isdir(os.path.join('binary_transparency', '.git')):
@@ -2245,8 +3000,13 @@ def main():
             with open(os.path.join(repodirs[0], 'latestapps.dat'), 'w') as f:
                 f.write(data)
 
+    if config['make_compressed_sidecars']:
+        for repodir in repodirs:
+            write_compressed_sidecars(repodir, options.jobs)
+
     if cachechanged:
         write_cache(apkcache)
+    metadata.write_description_cache()
 
     # Update the wiki...
     if options.wiki:
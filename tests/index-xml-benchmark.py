@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+#
+# Compare how index.xml is generated by index.make_v0() with how it
+# used to be generated by building a whole xml.dom.minidom Document.
+# Both ways must produce the same bytes, this checks that and reports
+# the time and peak memory of each.  To run it, do:
+#
+#   cd fdroidserver/tests
+#   ./index-xml-benchmark.py [number of apps]
+
+import collections
+import datetime
+import inspect
+import optparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.dom.minidom import Document
+
+localmodule = os.path.realpath(
+    os.path.join(os.path.dirname(inspect.getfile(inspect.currentframe())), '..'))
+if localmodule not in sys.path:
+    sys.path.insert(0, localmodule)
+
+import fdroidserver.common  # noqa
+import fdroidserver.index  # noqa
+import fdroidserver.metadata  # noqa
+
+
+class DomXmlWriter:
+    """The same interface as index._XmlStreamWriter, but with minidom"""
+
+    def __init__(self, fp, pretty=False):
+        self.fp = fp
+        self.pretty = pretty
+        self.doc = Document()
+        self.elements = [self.doc]
+
+    def _add(self, name, attrs):
+        el = self.doc.createElement(name)
+        for key, value in attrs:
+            el.setAttribute(key, value)
+        self.elements[-1].appendChild(el)
+        return el
+
+    def start(self, name, attrs=()):
+        self.elements.append(self._add(name, attrs))
+
+    def end(self):
+        self.elements.pop()
+        if len(self.elements) == 1:
+            if self.pretty:
+                output = self.doc.toprettyxml(encoding='utf-8')
+            else:
+                output = self.doc.toxml(encoding='utf-8')
+            self.fp.write(output.decode('utf-8'))
+
+    def element(self, name, value, attrs=(), cdata=False):
+        el = self._add(name, attrs)
+        if cdata:
+            el.appendChild(self.doc.createCDATASection(value))
+        else:
+            el.appendChild(self.doc.createTextNode(value))
+
+
+def make_repo(count):
+    apps = collections.OrderedDict()
+    apks = []
+    for i in range(count):
+        appid = 'org.example.app%05d' % i
+        app = fdroidserver.metadata.App()
+        app.id = appid
+        app.Name = 'App <%d> & "friends" ✓' % i
+        app.Summary = 'Does things > other things, #%d' % i
+        app.Description = '<p>This is app %d.</p>\n<ul><li>a & b</li></ul>' % i
+        app.License = 'GPL-3.0-or-later'
+        app.Categories = ['System', 'Internet']
+        app.WebSite = 'https://example.org/%d?a=1&b=2' % i
+        app.SourceCode = 'https://git.example.org/app%d' % i
+        app.IssueTracker = app.SourceCode + '/issues'
+        app.Donate = 'https://donate.example.org/%d' % i
+        app.CurrentVersion = '1.%d' % i
+        app.CurrentVersionCode = '3'
+        app.added = datetime.datetime(2019, 1, 1)
+        app.lastUpdated = datetime.datetime(2019, 2, 1)
+        app.icon = appid + '.3.png'
+        if i % 3 == 0:
+            app.localized = {'en-US': {'name': 'Localized ' + app.Name}, 'de': {'summary': 'Zusammenfassung'}}
+            app.Name = None
+        apps[appid] = app
+        for versionCode in (1, 2, 3):
+            apks.append({
+                'packageName': appid,
+                'versionCode': versionCode,
+                'versionName': '1.%d' % versionCode if versionCode != 2 else '',
+                'apkName': '%s_%d.apk' % (appid, versionCode),
+                'hash': '%064x' % (i * 10 + versionCode),
+                'hashType': 'sha256',
+                'sig': '%032x' % i,
+                'signer': '%064x' % i,
+                'size': 1000000 + versionCode,
+                'minSdkVersion': 14,
+                'targetSdkVersion': 28,
+                'added': datetime.datetime(2018, 12, versionCode),
+                'uses-permission': [['android.permission.INTERNET', None],
+                                    ['android.permission.WRITE_EXTERNAL_STORAGE', 18]],
+                'uses-permission-sdk-23': [['android.permission.CAMERA', None]],
+                'nativecode': ['arm64-v8a', 'armeabi-v7a'],
+                'features': ['android.hardware.camera'],
+                'antiFeatures': set(['NonFreeNet']) if i % 5 == 0 else set(),
+            })
+    return apps, apks
+
+
+def run(writer, apps, apks, repodir, pretty, trace=False):
+    fdroidserver.common.options.pretty = pretty
+    fdroidserver.index._XmlStreamWriter = writer
+    repodict = collections.OrderedDict([
+        ('name', 'Benchmark & "Friends"'),
+        ('icon', 'icon.png'),
+        ('address', 'https://example.org/fdroid/repo'),
+        ('description', 'A repo to benchmark <index.xml>'),
+        ('timestamp', datetime.datetime(2019, 3, 1)),
+        ('version', 21),
+        ('mirrors', ['https://mirror.example.org/fdroid/repo']),
+    ])
+    requestsdict = {'install': ['org.example.app00001'], 'uninstall': []}
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    fdroidserver.index.make_v0(apps, apks, repodir, repodict, requestsdict, dict())
+    result = time.perf_counter() - start
+    if trace:
+        result = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    with open(os.path.join(repodir, 'index.xml'), 'rb') as fp:
+        return fp.read(), result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    parser = optparse.OptionParser()
+    parser.add_option('--pretty', action='store_true', default=False)
+    fdroidserver.common.options, _ignored = parser.parse_args([])
+    fdroidserver.common.options.nosign = True
+    apps, apks = make_repo(count)
+    streamwriter = fdroidserver.index._XmlStreamWriter
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        repodir = os.path.join(tmpdir, 'repo')
+        os.makedirs(os.path.join(repodir, 'icons'))
+        repo_icon = os.path.join(tmpdir, 'icon.png')
+        with open(repo_icon, 'wb') as fp:
+            fp.write(b'not really a PNG')
+        fdroidserver.common.config = {
+            'repo_icon': repo_icon,
+            'repo_pubkey': '308201ee30820157a003020102',
+            'make_current_version_link': False,
+        }
+
+        print('%d apps, %d APKs' % (len(apps), len(apks)))
+        for pretty in (False, True):
+            results = []
+            for name, writer in (('minidom', DomXmlWriter), ('stream', streamwriter)):
+                output, duration = run(writer, apps, apks, repodir, pretty)
+                _ignored, peak = run(writer, apps, apks, repodir, pretty, trace=True)
+                results.append(output)
+                print('%-8s pretty=%-5s %8.3fs %10.1f MiB peak %10d bytes'
+                      % (name, pretty, duration, peak / 1024 / 1024, len(output)))
+            if results[0] != results[1]:
+                print('ERROR: the outputs differ!')
+                sys.exit(1)
+    fdroidserver.index._XmlStreamWriter = streamwriter
+
+
+if __name__ == "__main__":
+    main()